@@ -0,0 +1,229 @@
+import gzip
+import os
+import struct
+
+from .common import INDEX_DIR_NAME, server_key
+from .error import BackupStoreError
+
+# An Anvil region file starts with two 4KiB tables of 1024 entries, one per
+# chunk: where the chunk lives (3 byte sector offset, 1 byte sector count)
+# and when it was last saved. Chunks themselves are a 4 byte length followed
+# by that many bytes, padded out to a whole number of sectors.
+CHUNKS_PER_REGION = 1024
+DELTA_EXT = '.delta'
+DELTA_MAGIC = b'SPMCA1'
+HEADER_SIZE = 8192
+SECTOR_SIZE = 4096
+
+
+def is_region_file(path):
+    return path.endswith('.mca') \
+        and os.path.basename(os.path.dirname(path)) == 'region'
+
+
+def parse_header(header):
+    """
+    Returns the location and timestamp tables of a region header as two
+    lists of 1024 ints. Locations are still packed as offset << 8 | count.
+
+    @param header:
+    @return:
+    """
+    locations = struct.unpack('>1024I', header[:SECTOR_SIZE])
+    timestamps = struct.unpack('>1024I', header[SECTOR_SIZE:HEADER_SIZE])
+    return locations, timestamps
+
+
+def _read_chunk_record(f, location, path):
+    offset, count = location >> 8, location & 0xff
+    f.seek(offset * SECTOR_SIZE)
+    length_bytes = f.read(4)
+    if len(length_bytes) < 4:
+        raise BackupStoreError('Truncated chunk in "{}"'.format(path))
+    length = struct.unpack('>I', length_bytes)[0]
+    if length + 4 > count * SECTOR_SIZE:
+        raise BackupStoreError('Oversized chunk in "{}"'.format(path))
+    return length_bytes + f.read(length)
+
+
+def make_region_delta(path, old_header=None):
+    """
+    Reads the header of the region file at 'path' and returns it along with
+    a delta holding only the chunks whose location or timestamp differ
+    from 'old_header'. With no 'old_header' every chunk goes in.
+
+    @param path:
+    @param old_header:
+    @return:
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE).ljust(HEADER_SIZE, b'\0')
+        locations, timestamps = parse_header(header)
+        if old_header:
+            old_locations, old_timestamps = parse_header(old_header)
+        else:
+            old_locations = old_timestamps = (None,) * CHUNKS_PER_REGION
+        records = []
+        for i in range(CHUNKS_PER_REGION):
+            if not locations[i]:
+                continue
+            if locations[i] == old_locations[i] \
+                    and timestamps[i] == old_timestamps[i]:
+                continue
+            record = _read_chunk_record(f, locations[i], path)
+            records.append(struct.pack('>HI', i, len(record)) + record)
+    data = DELTA_MAGIC + header + struct.pack('>I', len(records)) \
+        + b''.join(records)
+    return header, data
+
+
+def read_region_delta(data):
+    """
+    Splits a delta made by make_region_delta() back into the header it
+    was made from and a dict of chunk index -> chunk record.
+
+    @param data:
+    @return:
+    """
+    if data[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+        raise BackupStoreError('Not a region delta')
+    pos = len(DELTA_MAGIC)
+    header = data[pos:pos + HEADER_SIZE]
+    pos += HEADER_SIZE
+    count = struct.unpack_from('>I', data, pos)[0]
+    pos += 4
+    records = {}
+    for _ in range(count):
+        i, length = struct.unpack_from('>HI', data, pos)
+        pos += 6
+        records[i] = data[pos:pos + length]
+        pos += length
+    return header, records
+
+
+def read_region(path):
+    """
+    Returns every chunk in a region file as a dict of
+    chunk index -> (timestamp, chunk record).
+
+    @param path:
+    @return:
+    """
+    chunks = {}
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE).ljust(HEADER_SIZE, b'\0')
+        locations, timestamps = parse_header(header)
+        for i in range(CHUNKS_PER_REGION):
+            if locations[i]:
+                chunks[i] = (timestamps[i],
+                             _read_chunk_record(f, locations[i], path))
+    return chunks
+
+
+def apply_region_delta(chunks, data):
+    """
+    Applies a delta to 'chunks' (as returned by read_region()), returning
+    the chunks the region held when the delta was made.
+
+    @param chunks:
+    @param data:
+    @return:
+    """
+    header, records = read_region_delta(data)
+    locations, timestamps = parse_header(header)
+    new_chunks = {}
+    for i in range(CHUNKS_PER_REGION):
+        if not locations[i]:
+            continue
+        if i in records:
+            new_chunks[i] = (timestamps[i], records[i])
+        elif i in chunks:
+            new_chunks[i] = (timestamps[i], chunks[i][1])
+    return new_chunks
+
+
+def write_region(path, chunks):
+    """
+    Writes 'chunks' (as returned by read_region()) out as a region file,
+    packing them one after another from the first free sector.
+
+    @param path:
+    @param chunks:
+    @return:
+    """
+    locations = [0] * CHUNKS_PER_REGION
+    timestamps = [0] * CHUNKS_PER_REGION
+    body = []
+    sector = HEADER_SIZE // SECTOR_SIZE
+    for i in sorted(chunks):
+        timestamp, record = chunks[i]
+        count = -(-len(record) // SECTOR_SIZE)
+        locations[i] = sector << 8 | count
+        timestamps[i] = timestamp
+        body.append(record.ljust(count * SECTOR_SIZE, b'\0'))
+        sector += count
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('>1024I', *locations))
+        f.write(struct.pack('>1024I', *timestamps))
+        for b in body:
+            f.write(b)
+    os.replace(tmp_path, path)
+
+
+class RegionState:
+    """
+    The region headers seen by the last region backup, which is what the
+    next one compares against to find changed chunks.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.headers = {}
+
+    def load(self):
+        self.headers = {}
+        try:
+            with gzip.open(self.path, 'rb') as r:
+                data = r.read()
+        except (OSError, EOFError):
+            # No (usable) state means the next backup is a new base.
+            return self
+        pos = 0
+        while pos < len(data):
+            length = struct.unpack_from('>H', data, pos)[0]
+            pos += 2
+            name = data[pos:pos + length].decode()
+            pos += length
+            self.headers[name] = data[pos:pos + HEADER_SIZE]
+            pos += HEADER_SIZE
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with gzip.open(tmp_path, 'wb') as r:
+            for name, header in self.headers.items():
+                encoded = name.encode()
+                r.write(struct.pack('>H', len(encoded)) + encoded + header)
+        os.replace(tmp_path, self.path)
+
+    def make_delta(self, path):
+        """
+        A 'deltas' hook for index.archive_tree(): archives region files as
+        deltas against the last seen header and everything else as is.
+
+        @param path:
+        @return:
+        """
+        if not is_region_file(path):
+            return None
+        header, data = make_region_delta(path, self.headers.get(path))
+        self.headers[path] = header
+        return path + DELTA_EXT, data
+
+
+def get_region_state(backup_dir, server_dir, backup_root):
+    name = '{0}.{1}'.format(server_key(server_dir), backup_root.strip(
+        os.path.sep).replace(os.path.sep, '_'))
+    return RegionState(os.path.join(
+        backup_dir, INDEX_DIR_NAME, '{}.regions'.format(name)))
@@ -1,29 +1,149 @@
 import argparse
 import configparser
+import json
 import logging
 import os
 import sys
 
-from .common import COMPRESSION_CHOICES, DEFAULT_COMPRESSION, \
-    DEFAULT_CONF_FILE, DEFAULT_EXCLUDE_FILES, DEFAULT_SERVER_PORT, \
-    DEFAULT_WORLD_NAME, DESCRIPTION, LOGFMT, MCVERSION, PROGNAME, \
-    VERSION, emit_msg
+from .common import BACKUP_MODE_CHOICES, COMPRESSION_CHOICES, \
+    DEFAULT_BACKUP_MODE, DEFAULT_COMPRESSION, DEFAULT_CONF_FILE, \
+    DEFAULT_EXCLUDE_FILES, DEFAULT_FLEET_JOBS, DEFAULT_JOBS, \
+    DEFAULT_ROLLING_JOBS, DEFAULT_SERVER_PORT, DEFAULT_START_TIMEOUT, \
+    DEFAULT_STOP_TIMEOUT, DEFAULT_WORLD_NAME, DESCRIPTION, GFS_SETTINGS, \
+    LOGFMT, MCVERSION, PROGNAME, VERSION, emit_msg
 from .core import SweetpotatoConfig, read_conf_file, run_server_backup, \
     validate_directories, validate_mem_values, validate_settings
 try:
-    from .daemon import daemon_action
+    from .daemon import daemon_action, run_daemon, run_fleet_metrics
 except ImportError:
     daemon_action = None
-from .error import BackupFileAlreadyExistsError, ConfFileError, \
-    EmptySettingError, NoDirFoundError, ServerAlreadyRunningError, \
-    ServerNotRunningError
-from .screen import is_screen_started
+from .error import BackupFileAlreadyExistsError, BackupInProgressError, \
+    BackupStoreError, ConfFileError, DaemonError, EmptySettingError, \
+    NoDirFoundError, ServerAlreadyRunningError, ServerNotRunningError
+from .exclude import ExcludeMatcher
+from .fleet import read_fleet, rolling_restart, run_fleet_action
+from .logindex import get_log_index, parse_log_query
+from .perf import format_perf
+from .query import query_server
+from .restore import restore_backup
+from .retention import prune_backups
+from .schedule import backup_lock
 from .server import create_server, is_server_running, get_uptime, \
     get_uptime_raw, get_uptime_string, list_players, restart_server, save_all, \
-    send_command, start_server, stop_server
+    server_command, start_server, stop_server
+from .status import get_perf
 from .system import error_and_die
 
 
+def _ask_daemon(args, s):
+    """
+    Hands the chosen action to a running daemon, if there is one and it can
+    do it. Returns False if the action still needs doing here.
+
+    @param args:
+    @param s:
+    @return:
+    """
+    if daemon_action is None:
+        return False
+    if args.json:
+        request = ('status', {})
+    elif args.list:
+        request = ('list', {})
+    elif args.perf:
+        request = ('perf', {})
+    elif args.save_all:
+        request = ('save_all', {})
+    elif args.say:
+        request = ('command', {'command': 'say ' + args.say})
+    elif args.restart or args.start or args.stop:
+        action = 'restart' if args.restart else 'start' if args.start else 'stop'
+        request = (action, {'timeout': None})
+    else:
+        return False
+    action, params = request
+    try:
+        reply = daemon_action(s, action, **params)
+    except (DaemonError, OSError, ValueError) as e:
+        error_and_die(e, quiet=s.quiet)
+    if reply is None:
+        return False
+    result = reply['result']
+    if args.json:
+        if s.fancy:
+            print(json.dumps(result, sort_keys=True, indent=4))
+        else:
+            print(json.dumps(result))
+    elif args.list:
+        if result:
+            for p in result:
+                emit_msg(p, quiet=s.quiet)
+        else:
+            emit_msg('Nobody on right now :(', quiet=s.quiet)
+    elif args.perf:
+        for line in format_perf(result):
+            emit_msg(line, quiet=s.quiet)
+    elif args.save_all:
+        emit_msg('"{}" saved!'.format(s.world_name), quiet=s.quiet)
+    elif not args.say:
+        emit_msg('"{0}" {1}!'.format(
+            s.world_name, 'stopped' if args.stop else action + 'ed'),
+            quiet=s.quiet)
+    return True
+
+
+def _run_fleet(args):
+    """
+    Runs the chosen action on every server in the --fleet and prints what
+    happened to each as one JSON document, exiting non-zero if any failed.
+
+    @param args:
+    @return:
+    """
+    if args.daemon:
+        # A fleet's daemon is only its metrics, each server has its own
+        if daemon_action is None:
+            error_and_die('The daemon needs Python 3.7 or newer', quiet=args.quiet)
+        if not args.metrics_port:
+            error_and_die('--fleet --daemon needs a --metrics-port to serve'
+                          ' the fleet\'s metrics on', quiet=args.quiet)
+        try:
+            servers = read_fleet(args.fleet)
+        except ConfFileError as e:
+            error_and_die(e, quiet=args.quiet)
+        run_fleet_metrics(servers, args.metrics_port)
+        return
+    actions = (('json', 'status'), ('start', 'start'), ('stop', 'stop'),
+               ('restart', 'restart'), ('backup', 'backup'),
+               ('rolling_restart', 'rolling_restart'))
+    action = next((a for arg, a in actions if getattr(args, arg)), None)
+    if action is None:
+        error_and_die('--fleet works with --json, --start, --stop, --restart,'
+                      ' --rolling-restart, --backup and --daemon',
+                      quiet=args.quiet)
+    try:
+        servers = read_fleet(args.fleet)
+    except ConfFileError as e:
+        error_and_die(e, quiet=args.quiet)
+    for s in servers.values():
+        if args.start_timeout is not None:
+            s.start_timeout = args.start_timeout
+        if args.stop_timeout is not None:
+            s.stop_timeout = args.stop_timeout
+    if action == 'rolling_restart':
+        results = rolling_restart(servers,
+                                  args.fleet_jobs or DEFAULT_ROLLING_JOBS)
+    else:
+        results = run_fleet_action(servers, action,
+                                   args.fleet_jobs or DEFAULT_FLEET_JOBS)
+    if args.fancy:
+        print(json.dumps(results, sort_keys=True, indent=4))
+    else:
+        print(json.dumps(results))
+    if not all(r['ok'] for r in results.values()):
+        sys.exit(1)
+
+
 def setup_args(args):
     logging.basicConfig(format=LOGFMT, level=logging.INFO, stream=sys.stdout)
     parser = argparse.ArgumentParser(description=DESCRIPTION, prog=PROGNAME)
@@ -33,6 +153,9 @@ def setup_args(args):
                          help='back up your Minecraft server (live)')
     actions.add_argument('-C', '--create', action='store_true',
                          help='create a server from settings')
+    actions.add_argument('--daemon', action='store_true',
+                         help='run in the foreground, keeping track of the'
+                              ' server and answering the other actions fast')
     actions.add_argument('-R', '--dynmap-fullrender', action='store_true',
                          help="Trigger a fullrender with Dynmap.")
     actions.add_argument('-g', '--genconf', action='store_true',
@@ -41,8 +164,22 @@ def setup_args(args):
                          help='output settings as json')
     actions.add_argument('-l', '--list', action='store_true',
                          help='list logged-in players')
+    actions.add_argument('--log-search', metavar='QUERY',
+                         help='search the server logs, e.g. "player:Notch'
+                              ' type:join limit:1" or "type:lag since:2014-10-01"')
+    actions.add_argument('--perf', action='store_true',
+                         help='show TPS, MSPT and lag spikes from the last'
+                              ' 15 minutes')
+    actions.add_argument('--prune', action='store_true',
+                         help='delete backups not kept by the keep_* settings')
     actions.add_argument('-r', '--restart', action='store_true',
                          help='restart the server')
+    actions.add_argument('--restore', metavar='BACKUP',
+                         help='verify and restore a backup, stopping and'
+                              ' restarting the server around the swap')
+    actions.add_argument('--rolling-restart', action='store_true',
+                         help='restart every server in the --fleet, waiting'
+                              ' for each to come back up before moving on')
     actions.add_argument('-A', '--save-all', '--save', action='store_true',
                          help='Send a "save-all" to the server')
     actions.add_argument('--say', help=argparse.SUPPRESS)
@@ -65,18 +202,47 @@ def setup_args(args):
     settings.add_argument('-d', '--backup-dir',
                           help='the FULL path to your backups folder',
                           metavar='/path/to/backups')
+    settings.add_argument('--backup-mode', choices=BACKUP_MODE_CHOICES,
+                          help='full or differential tarballs, region chunk'
+                               ' deltas or deduplicated chunks.'
+                               ' Default: ' + DEFAULT_BACKUP_MODE)
+    settings.add_argument('--dry-run', action='store_true',
+                          help='with --prune, only show what would be deleted')
     settings.add_argument('-e', '--exclude',
                           help='A space-separated list of files to exclude from backups.'
-                          ' Default: {}'.format(DEFAULT_EXCLUDE_FILES[0]))
+                          ' Accepts gitignore style patterns like "dynmap/" or'
+                          ' "/logs/*.gz". Default: {}'.format(DEFAULT_EXCLUDE_FILES))
     settings.add_argument('-x', '--fancy', action='store_true',
                           help="print json with fancy indentation and sorting")
+    settings.add_argument('--fleet', metavar='PATH',
+                          help='run --json, --start, --stop, --restart,'
+                               ' --rolling-restart or --backup on every'
+                               ' server in a fleet, or --daemon for their'
+                               ' metrics: a directory of conf'
+                               ' files, or a conf file of [Server:<name>]'
+                               ' sections')
+    settings.add_argument('--fleet-jobs', metavar='N', type=int,
+                          help='run a fleet action on N servers at a time.'
+                               ' Default: {0}, or {1} for --rolling-restart'
+                               .format(DEFAULT_FLEET_JOBS, DEFAULT_ROLLING_JOBS))
     settings.add_argument('-F', '--force',
                           help='forces writing of server files,'
                                ' even when they already exist',
                           action='store_true')
+    settings.add_argument('-J', '--jobs', metavar='N', type=int,
+                          help='compress backups using N threads.'
+                               ' Default: {}'.format(DEFAULT_JOBS))
+    for setting, period in zip(GFS_SETTINGS, ('hours', 'days', 'weeks', 'months')):
+        settings.add_argument('--' + setting.replace('_', '-'), metavar='N',
+                              type=int, dest=setting,
+                              help='keep the newest backup from each of the'
+                                   ' last N {}'.format(period))
     settings.add_argument('--level-seed', '--seed', metavar="LEVEL SEED",
                           help='optional and only applied'
                                'during world creation')
+    settings.add_argument('--metrics-port', metavar='PORT', type=int,
+                          help='serve metrics on PORT while running --daemon;'
+                               ' with --fleet, those of every server')
     settings.add_argument('-p', '--port',
                           help='port you wish to run your server on.'
                                ' Default: ' + DEFAULT_SERVER_PORT)
@@ -88,6 +254,17 @@ def setup_args(args):
     settings.add_argument('-S', '--screen', metavar='SCREEN NAME',
                           help='set the name of your screen session.'
                                ' Default: the same as your world')
+    settings.add_argument('--staged', action='store_true',
+                          help='snapshot the server while saving is off,'
+                               ' then compress the snapshot')
+    settings.add_argument('--start-timeout', metavar='SECONDS', type=int,
+                          help='how long a rolling restart waits for a server'
+                               ' to come back up. Default: {}'.format(
+                                   DEFAULT_START_TIMEOUT))
+    settings.add_argument('--stop-timeout', metavar='SECONDS', type=int,
+                          help='how long to wait for the server to stop before'
+                               ' killing it. Default: {}'.format(
+                                   DEFAULT_STOP_TIMEOUT))
     settings.add_argument('-v', '--mc-version', metavar='MC VERSION',
                           help='set the version of minecraft.'
                                ' Default: ' + MCVERSION)
@@ -129,6 +306,12 @@ def setup_args(args):
                         version=_version_string())
 
     args = parser.parse_args(args)
+    if args.fleet:
+        _run_fleet(args)
+        return
+    if args.rolling_restart:
+        error_and_die('--rolling-restart needs a --fleet to restart',
+                      quiet=args.quiet)
     s = SweetpotatoConfig()
 
     # Read a passed-in conf file
@@ -147,18 +330,34 @@ def setup_args(args):
             pass
     if args.backup_dir:
         s.backup_dir = args.backup_dir
+    if args.backup_mode:
+        s.backup_mode = args.backup_mode
     if args.exclude:
         exclude_files_list = []
-        exclude_files_list.append(s.exclude_files)
-        for e in args.exclude.split(" "):
+        if isinstance(s.exclude_files, str):
+            exclude_files_list.append(s.exclude_files)
+        else:
+            exclude_files_list.extend(s.exclude_files)
+        for e in args.exclude.split():
             exclude_files_list.append(e)
             s.exclude_files = exclude_files_list
+        try:
+            ExcludeMatcher(s.exclude_files)
+        except ConfFileError as e:
+            error_and_die(e, quiet=s.quiet)
     if args.fancy:
         s.fancy = True
     if args.force:
         s.force = args.force
     if args.forge:
         s.forge = args.forge
+    if args.jobs is not None:
+        if args.jobs < 1:
+            error_and_die('--jobs must be at least 1', quiet=s.quiet)
+        s.jobs = args.jobs
+    for setting in GFS_SETTINGS:
+        if getattr(args, setting) is not None:
+            setattr(s, setting, getattr(args, setting))
     if args.mb:
         s.mem_format = 'MB'
         s.mem_max = args.mb[1]
@@ -169,6 +368,8 @@ def setup_args(args):
         s.mem_min = args.gb[0]
     if args.level_seed:
         s.level_seed = args.level_seed
+    if args.metrics_port:
+        s.metrics_port = args.metrics_port
     if args.port:
         s.port = args.port
     if args.quiet:
@@ -179,6 +380,12 @@ def setup_args(args):
         s.server_dir = args.server_dir
     if args.screen:
         s.screen_name = args.screen
+    if args.staged:
+        s.staged_backup = True
+    if args.start_timeout is not None:
+        s.start_timeout = args.start_timeout
+    if args.stop_timeout is not None:
+        s.stop_timeout = args.stop_timeout
     if args.playerdata_only:
         s.playerdata_only = True
     if args.verbose:
@@ -215,15 +422,29 @@ def setup_args(args):
         error_and_die('The maximum memory value must be greater'
                       ' than the minimum!')
 
+    if args.daemon:
+        if daemon_action is None:
+            error_and_die('The daemon needs Python 3.7 or newer', quiet=s.quiet)
+        try:
+            run_daemon(s)
+        except DaemonError as e:
+            error_and_die(e, quiet=s.quiet)
+        return
+    if _ask_daemon(args, s):
+        return
+
     running = is_server_running(s.server_dir)
 
     if args.backup:
         try:
-            run_server_backup(s.exclude_files, s, s.quiet, running,
-                              s.world_only, playerdata_only=s.playerdata_only,
-                              verbose_backup=s.verbose_backup)
+            with backup_lock(s.backup_dir, s.world_name):
+                run_server_backup(s.exclude_files, s, s.quiet, running,
+                                  s.world_only, playerdata_only=s.playerdata_only,
+                                  verbose_backup=s.verbose_backup)
         except BackupFileAlreadyExistsError as e:
-            send_command('say Backup Done!', is_screen_started(s.screen_name))
+            server_command(s, 'say Backup Done!')
+            error_and_die(e, quiet=s.quiet)
+        except BackupInProgressError as e:
             error_and_die(e, quiet=s.quiet)
     elif args.create:
         try:
@@ -233,7 +454,7 @@ def setup_args(args):
     elif args.dynmap_fullrender:
         if running:
             emit_msg("Attempting a dynmap fullrender ...", quiet=s.quiet)
-            send_command('dynmap fullrender {}'.format(s.world_name), is_screen_started(s.screen_name))
+            server_command(s, 'dynmap fullrender {}'.format(s.world_name))
         else:
             error_and_die(s.world_name + " is not running!", quiet=s.quiet)
     elif args.genconf:
@@ -244,7 +465,13 @@ def setup_args(args):
         print(s.as_json)
     elif args.list:
         if running:
-            players = list_players(s)
+            stat = query_server(s)
+            if stat:
+                players = ['There are {0}/{1} players online:{2}'.format(
+                    stat['players_online'], stat['max_players'],
+                    ', '.join(stat['players']))] if stat['players'] else None
+            else:
+                players = list_players(s)
             if players:
                 for p in players:
                     emit_msg(p.strip(), quiet=s.quiet)
@@ -260,12 +487,46 @@ def setup_args(args):
         else:
             error_and_die("{} is not running!".format(s.world_name), quiet=s.quiet)
     elif args.say:
-        send_command('say ' + args.say, is_screen_started(s.screen_name))
+        server_command(s, 'say ' + args.say)
+    elif args.log_search:
+        try:
+            query = parse_log_query(args.log_search)
+        except ValueError as e:
+            error_and_die(e, quiet=s.quiet)
+        index = get_log_index(s.backup_dir, s.server_dir).load()
+        if index.update(s.server_dir):
+            index.save()
+        for event in index.search(s.server_dir, **query):
+            print('{0} {1}: {2}'.format(
+                event['time'].strftime('%Y-%m-%d %H:%M:%S'), event['type'],
+                event['message']))
+    elif args.perf:
+        if running:
+            for line in format_perf(get_perf(s)):
+                emit_msg(line, quiet=s.quiet)
+        else:
+            error_and_die(s.world_name + " is not running!", quiet=s.quiet)
+    elif args.prune:
+        policy = {k: getattr(s, k) for k in GFS_SETTINGS}
+        if not any(policy.values()):
+            error_and_die('No keep_hourly, keep_daily, keep_weekly or'
+                          ' keep_monthly settings to prune with!', quiet=s.quiet)
+        try:
+            prune_backups(s.backup_dir, policy, dry_run=args.dry_run,
+                          quiet=s.quiet)
+        except BackupInProgressError as e:
+            error_and_die(e, quiet=s.quiet)
     elif args.restart:
         try:
             restart_server(s, s.quiet)
         except BackupFileAlreadyExistsError as e:
             error_and_die(e, quiet=s.quiet)
+    elif args.restore:
+        try:
+            restore_backup(s, args.restore, world_only=s.world_only,
+                           playerdata_only=s.playerdata_only, quiet=s.quiet)
+        except (BackupStoreError, ServerNotRunningError) as e:
+            error_and_die(e, quiet=s.quiet)
     elif args.start:
         try:
             start_server(s, s.quiet)
@@ -277,7 +538,8 @@ def setup_args(args):
                 s.screen_name,
                 s.server_dir,
                 s.world_name,
-                s.quiet)
+                s.quiet,
+                s.stop_timeout)
         except ServerNotRunningError as e:
             error_and_die(e, quiet=s.quiet)
     # elif args.testing:
@@ -287,6 +549,10 @@ def setup_args(args):
             raw_uptime = get_uptime_raw(s.server_dir, s.world_name, s.quiet)
             u = get_uptime(raw_uptime)
             uptime_string = get_uptime_string(u)
+            stat = query_server(s)
+            if stat:
+                uptime_string += ', {0}/{1} players on {2}'.format(
+                    stat['players_online'], stat['max_players'], stat['version'])
             emit_msg(s.world_name + ' has been up for ' + uptime_string, quiet=s.quiet)
         except ServerNotRunningError as e:
             error_and_die(e, quiet=s.quiet)
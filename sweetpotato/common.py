@@ -1,4 +1,5 @@
 # import collections
+import hashlib
 import logging
 import os
 import sys
@@ -15,24 +16,61 @@ VERSION = '2.1'
 
 LOGFMT = "[%(levelname)s] %(message)s"
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_BACKUP_MODE = 'tar'
+BACKUP_MODE_CHOICES = ['dedup', 'diff', 'region', DEFAULT_BACKUP_MODE]
 DEFAULT_COMPRESSION = 'gz'
 COMPRESSION_CHOICES = ['bz2', DEFAULT_COMPRESSION, 'xz']
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+COMMAND_ACK_TIMEOUT = 120
 DEFAULT_EXCLUDE_FILES = 'level.dat_new'
+DEFAULT_FLEET_JOBS = 4
+DEFAULT_JOBS = 1
+DEFAULT_MAX_DEFERRAL = 60
+DEFAULT_RCON_PORT = 25575
+DEFAULT_ROLLING_JOBS = 1
 DEFAULT_SCREEN_NAME = '{}World'.format(PROGNAME).capitalize()
 DEFAULT_SERVER_PORT = '25565'
+DEFAULT_START_TIMEOUT = 300
+DEFAULT_STOP_TIMEOUT = 60
 DEFAULT_WORLD_NAME = DEFAULT_SCREEN_NAME
 DESCRIPTION = "Manage your Minecraft server on a GNU/Linux system."
 HOME_DIR = os.getenv('HOME')
+INDEX_DIR_NAME = '.index'
 CONFIG_DIR = '{0}/.config/{1}'.format(HOME_DIR, PROGNAME)
 DEFAULT_CONF_FILE = '{0}/{1}.conf'.format(CONFIG_DIR, PROGNAME)
+METRICS_HOST = '127.0.0.1'
+QUERY_HOST = '127.0.0.1'
 PYTHON33_OR_GREATER = sys.version_info.major >= 3 and sys.version_info.minor >= 3
-SERVER_WAIT_TIME = 1
+RCON_HOST = '127.0.0.1'
+SERVER_HOST = '127.0.0.1'
+SERVER_LOG_WAIT = 5
+STATE_DIR = os.path.join(os.getenv('XDG_STATE_HOME') or
+                         os.path.join(HOME_DIR, '.local', 'state'), PROGNAME)
+SERVER_TERM_WAIT = 10
+STAGING_DIR_NAME = '.staging'
+STORE_CHUNK_SIZE = 256 * 1024
+STORE_DIR_NAME = 'store'
+GFS_SETTINGS = ('keep_hourly', 'keep_daily', 'keep_weekly', 'keep_monthly')
 FORGE_DL_URL = 'http://files.minecraftforge.net/maven/net/minecraftforge/forge/{0}/{1}'
 FORGE_JAR_NAME = 'forge-{}-universal.jar'
 VANILLA_DL_URL = 'https://s3.amazonaws.com/Minecraft.Download/versions/{0}/{1}'
 VANILLA_JAR_NAME = 'minecraft_server.{}.jar'
 
 
+def server_key(server_dir):
+    """
+    Returns what a server's state files in a backup_dir's index dir are
+    named after: its dir's name and a hash of where it really is, so two
+    servers in dirs of the same name can share a backup_dir.
+
+    @param server_dir:
+    @return:
+    """
+    real_dir = os.path.realpath(server_dir)
+    return '{0}.{1}'.format(os.path.basename(real_dir), hashlib.sha1(
+        real_dir.encode('utf-8', 'surrogateescape')).hexdigest()[:12])
+
+
 def emit_msg(msg: str, level=logging.INFO, quiet=False, *args, **kwargs) -> None:
     """Logging wrapper."""
     if not quiet:
@@ -0,0 +1,118 @@
+import bz2
+import collections
+import gzip
+import lzma
+import tarfile
+
+from concurrent.futures import ThreadPoolExecutor
+from .common import COMPRESS_BLOCK_SIZE
+
+
+def _compress_bz2(data):
+    return bz2.compress(data, 9)
+
+
+def _compress_gz(data):
+    return gzip.compress(data, 9)
+
+
+def _compress_xz(data):
+    return lzma.compress(data)
+
+
+COMPRESSORS = {
+    'bz2': _compress_bz2,
+    'gz': _compress_gz,
+    'xz': _compress_xz,
+}
+
+
+class ParallelCompressor:
+    """
+    A write-only file object that compresses what's written to it on a pool
+    of worker threads and writes the results to 'fileobj' in order.
+
+    Each block of input becomes its own gzip member, bzip2 stream or xz
+    stream. Those formats all allow streams to be concatenated, so the
+    output is still a plain .gz/.bz2/.xz file that gzip, tar and friends
+    (and Python's own modules) can read.
+
+    zlib, bz2 and lzma all release the GIL while they work, so threads get
+    us every core without having to pickle blocks over to other processes.
+    """
+    def __init__(self, fileobj, compression, jobs,
+                 block_size=COMPRESS_BLOCK_SIZE):
+        self.block_size = block_size
+        self.compress = COMPRESSORS[compression]
+        self.fileobj = fileobj
+        self.jobs = jobs
+        self.pending = collections.deque()
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.buf = bytearray()
+        self.closed = False
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(self.compress, bytes(block)))
+        # Bound how much we hold in memory, each worker gets one block in
+        # flight plus one queued behind it.
+        while len(self.pending) > self.jobs * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.block_size:
+            self._submit(self.buf[:self.block_size])
+            del self.buf[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buf:
+            self._submit(self.buf)
+            self.buf = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.fileobj.close()
+        self.closed = True
+
+    def abort(self):
+        """
+        Closes without writing out what's still being compressed, for when
+        whatever was being written has failed.
+
+        @return:
+        """
+        if self.closed:
+            return
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.buf = bytearray()
+        self.pool.shutdown()
+        self.fileobj.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+def open_parallel_tar(path, compression, jobs):
+    """
+    Returns a tarfile and the ParallelCompressor it writes to, the caller
+    must close both (the tarfile first.)
+
+    @param path:
+    @param compression:
+    @param jobs:
+    @return:
+    """
+    compressor = ParallelCompressor(open(path, 'wb'), compression, jobs)
+    return tarfile.open(fileobj=compressor, mode='w|'), compressor
@@ -0,0 +1,69 @@
+import re
+import time
+
+from .common import COMMAND_ACK_TIMEOUT
+from .error import CommandTimeoutError
+from .events import parse_line
+from .logs import LogFollower, get_latest_log
+from .server import server_commands
+
+# What vanilla prints once each command has actually been carried out, in
+# the wording of both older (1.7/1.8) and newer servers.
+# Only the server itself saying so counts, not a player typing it.
+ACK_THREADS = (None, 'Server thread')
+SAVE_ALL_ACK = r'Saved the (?:game|world)'
+SAVE_OFF_ACK = r'Turned off world auto-saving|Automatic saving is now disabled' \
+    r'|Saving is already turned off'
+SAVE_ON_ACK = r'Turned on world auto-saving|Automatic saving is now enabled' \
+    r'|Saving is already turned on'
+
+
+def _is_ack(ack):
+    def match(line):
+        event = parse_line(line)
+        return event['thread'] in ACK_THREADS \
+            and event['type'] not in ('chat', 'command') \
+            and bool(ack.match(event['message']))
+    return match
+
+
+class CommandPipeline:
+    """
+    A batch of console commands that are sent to the server together, each
+    with an optional regular expression for the line that says it's done:
+
+        CommandPipeline(settings).add('save-all', SAVE_ALL_ACK).run()
+
+    run() only returns once every acknowledgement has been seen, either in
+    a command's RCON reply or in the server log after it was sent.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.commands = []
+
+    def add(self, command, ack=None):
+        self.commands.append((command, re.compile(ack) if ack else None))
+        return self
+
+    def run(self, timeout=COMMAND_ACK_TIMEOUT):
+        """
+        Sends every command in one round trip and waits up to 'timeout'
+        seconds for them all to be acknowledged. Returns the commands'
+        RCON output, a list of Nones if they went through screen.
+
+        @param timeout:
+        @return:
+        """
+        follower = LogFollower(get_latest_log(self.settings.server_dir))
+        outputs = server_commands(self.settings, [c for c, _ in self.commands])
+        deadline = time.monotonic() + timeout
+        for (command, ack), output in zip(self.commands, outputs):
+            if not ack or (output and ack.search(output)):
+                continue
+            # Acknowledgements come in the order the commands went
+            if follower.wait_for(_is_ack(ack),
+                                 max(deadline - time.monotonic(), 0)) is None:
+                raise CommandTimeoutError(
+                    'No acknowledgement of "{0}" from the server after'
+                    ' {1}s'.format(command, timeout))
+        return outputs
@@ -1,19 +1,33 @@
 # TODO: @run_if_bottle decorator and the like
 import configparser
 import json
+import logging
 import os
 import sys
 import tarfile
-
-from datetime import datetime
-from .common import DEFAULT_COMPRESSION, DEFAULT_EXCLUDE_FILES, \
-    DEFAULT_SCREEN_NAME, DEFAULT_SERVER_PORT, DEFAULT_WORLD_NAME, MCVERSION, \
-    PROGNAME, PYTHON33_OR_GREATER, emit_msg
-from .error import ConfFileError, EmptySettingError, NoDirFoundError, \
-    ServerNotRunningError
-from .screen import is_screen_started
-from .server import get_uptime, get_uptime_raw, list_players, \
-    list_players_as_list, send_command
+import time
+
+from datetime import datetime, timedelta
+from .anvil import get_region_state
+from .common import BACKUP_MODE_CHOICES, DEFAULT_BACKUP_MODE, \
+    DEFAULT_COMPRESSION, DEFAULT_EXCLUDE_FILES, DEFAULT_JOBS, \
+    DEFAULT_MAX_DEFERRAL, DEFAULT_RCON_PORT, DEFAULT_SCREEN_NAME, \
+    DEFAULT_SERVER_PORT, DEFAULT_START_TIMEOUT, DEFAULT_STOP_TIMEOUT, DEFAULT_WORLD_NAME, \
+    GFS_SETTINGS, MCVERSION, PROGNAME, PYTHON33_OR_GREATER, emit_msg
+from .compress import open_parallel_tar
+from .console import SAVE_ALL_ACK, SAVE_OFF_ACK, SAVE_ON_ACK, CommandPipeline
+from .error import BackupStoreError, CommandTimeoutError, ConfFileError, \
+    EmptySettingError, NoDirFoundError
+from .exclude import ExcludeMatcher
+from .index import archive_tree, get_index
+from .metrics import record_backup
+from .proc import get_resources
+from .query import query_server
+from .schedule import CronSchedule
+from .server import get_uptime, server_command
+from .snapshot import get_staging_dir, snapshot_tree
+from .status import get_log_roster, get_players
+from .store import MANIFEST_EXT, get_store_dirs, store_backup
 from .system import create_dir, error_and_die, is_forced
 
 
@@ -24,21 +38,39 @@ class SweetpotatoConfig:
 
     def __init__(self):
         self.backup_dir = None
+        self.backup_max_deferral = DEFAULT_MAX_DEFERRAL
+        self.backup_max_lag = None
+        self.backup_max_players = None
+        self.backup_mode = DEFAULT_BACKUP_MODE
+        self.backup_schedule = None
         self.compression = DEFAULT_COMPRESSION
         self.conf_file = None
         self.exclude_files = DEFAULT_EXCLUDE_FILES
         self.fancy = False
         self.force = False
         self.forge = None
+        self.jobs = DEFAULT_JOBS
+        self.keep_daily = None
+        self.keep_hourly = None
+        self.keep_monthly = None
+        self.keep_weekly = None
         self.level_seed = None
         self.mem_format = None
         self.mem_max = None
         self.mem_min = None
+        self.metrics_port = None
         self.mc_version = MCVERSION
         self.port = DEFAULT_SERVER_PORT
+        self.query_port = None
+        self.rcon_password = None
+        self.rcon_port = DEFAULT_RCON_PORT
         self.running = False
         self.screen_name = DEFAULT_SCREEN_NAME
         self.server_dir = None
+        self.staged_backup = False
+        self.start_timeout = DEFAULT_START_TIMEOUT
+        self.stop_timeout = DEFAULT_STOP_TIMEOUT
+        self.tps_command = None
         self.playerdata_only = False
         self.verbose_backup = False
         self.world_name = DEFAULT_WORLD_NAME
@@ -67,26 +99,46 @@ class SweetpotatoConfig:
         return conf.strip()
 
     @property
-    def as_json(self):
+    def as_dict(self):
         # TODO: don't copy?
         self_dict = self.__dict__.copy()
-        try:
-            players = list_players_as_list(list_players(self))
-            raw = get_uptime_raw(self.server_dir, self.world_name, False)
-            u = get_uptime(raw)
+        self_dict.pop('rcon_password')
+        # Status is only ever read, nothing is sent to the server for it
+        if self.running:
+            running = self_dict['running'] = dict(self.running)
+            # Only what's been logged since the last call is read, for both
+            # the players and the lag
+            roster = get_log_roster(self)
+            roster.update()
+            roster.save()
+            stat = query_server(self)
+            if stat:
+                players, source = stat['players'], 'query'
+                running.update(query={k: stat[k] for k in (
+                    'motd', 'version', 'server_mod', 'plugins', 'map',
+                    'players_online', 'max_players')})
+            else:
+                players, source = get_players(self, roster)
+            u = get_uptime(timedelta(seconds=time.time() - running['start_time']))
             uptime = {
                 'days': u[0],
                 'hours': u[1],
                 'minutes': u[2],
                 'seconds': u[3]}
-            self_dict['running'].update(players=players)
-            self_dict['running'].update(uptime=uptime)
-        except ServerNotRunningError:
-            pass
+            running.update(players=players or None, players_source=source)
+            running.update(uptime=uptime)
+            running.update(perf=roster.monitor().summary())
+            # Measuring CPU use means waiting, which is left to the daemon
+            running.update(resources=get_resources(running['pid'], window=None))
+        self_dict['updated'] = time.time()
+        return self_dict
+
+    @property
+    def as_json(self):
         if self.fancy:
-            return json.dumps(self_dict, sort_keys=True, indent=4)
+            return json.dumps(self.as_dict, sort_keys=True, indent=4)
         else:
-            return json.dumps(self_dict)
+            return json.dumps(self.as_dict)
 
     @property
     def as_serverproperties(self):
@@ -159,9 +211,18 @@ view-distance=10
 motd=Welcome to {0}!
         """.format(self.world_name, self.port, self.level_seed or '')
         if self.mc_version == '1.7.10':
-            return vanilla_server_properties_1710
+            server_properties = vanilla_server_properties_1710
         else:
-            return vanilla_server_properties_18
+            server_properties = vanilla_server_properties_18
+        if self.rcon_password:
+            server_properties = server_properties.replace(
+                'enable-rcon=false\n', 'enable-rcon=true\nrcon.port={0}\n'
+                'rcon.password={1}\n'.format(self.rcon_port, self.rcon_password))
+        if self.query_port:
+            server_properties = server_properties.replace(
+                'enable-query=false\n', 'enable-query=true\n'
+                'query.port={}\n'.format(self.query_port))
+        return server_properties
         # TODO: can probably generalize this ...
         # else:
         #     raise UnsupportedVersionError(
@@ -170,10 +231,11 @@ motd=Welcome to {0}!
         #             self.mc_version))
 
 
-def read_conf_file(file, settings):
+def read_conf_file(file, settings, section='Settings'):
     """
     The arg 'file' is a conf file path, and 'settings' is a
-    dict containing your settings.
+    dict containing your settings. The settings are read from 'section',
+    which fleet files have one of per server.
 
     Checks if 'file' is actually a file, if not checks for 'DEFAULT_FILE'.
     If that doesn't exist, we return 'settings' as it was passed in,
@@ -191,14 +253,17 @@ def read_conf_file(file, settings):
         raise ConfFileError(
             'The specified conf file does not exist: {}'.format(file_path))
 
-    section = 'Settings'
     c = configparser.ConfigParser()
     try:
         c.read(file_path)
     except configparser.MissingSectionHeaderError:
         raise ConfFileError(
             "The specified conf file does not have a valid"
-            "'Settings' section")
+            "'{}' section".format(section))
+    if not c.has_section(section):
+        raise ConfFileError(
+            "The specified conf file does not have a '{0}' section: {1}".format(
+                section, file_path))
 
     options = c.options(section)
     options_dict = {}
@@ -207,11 +272,43 @@ def read_conf_file(file, settings):
 
     exclude = c[section].get("exclude_files")
     if exclude:
-        exclude_list = exclude.split(" ")
+        exclude_list = exclude.split()
     else:
         exclude_list = []
     if settings.exclude_files not in exclude_list:
         exclude_list.append(settings.exclude_files)
+    # Caught now rather than once a backup is under way
+    ExcludeMatcher(exclude_list)
+
+    for i in ('backup_max_deferral', 'backup_max_lag', 'backup_max_players',
+              'jobs', 'metrics_port', 'query_port', 'rcon_port',
+              'start_timeout', 'stop_timeout') + GFS_SETTINGS:
+        # Read back as ints, not the strings we got from the file.
+        try:
+            if i in options_dict:
+                options_dict[i] = c[section].getint(i)
+        except ValueError:
+            raise ConfFileError('The "{}" setting must be a number'.format(i))
+    if options_dict.get('jobs', 1) < 1:
+        raise ConfFileError('The "jobs" setting must be at least 1')
+
+    if options_dict.get('backup_mode', DEFAULT_BACKUP_MODE) \
+            not in BACKUP_MODE_CHOICES:
+        raise ConfFileError('The "backup_mode" setting must be one of: {}'.format(
+            ', '.join(BACKUP_MODE_CHOICES)))
+
+    if 'backup_schedule' in options_dict:
+        try:
+            # Some schedules parse fine but never come around, like the 31st
+            # of February
+            CronSchedule(options_dict['backup_schedule']).next_after(
+                datetime.now())
+        except ValueError as e:
+            raise ConfFileError(str(e))
+
+    for b in ('staged_backup',):
+        if b in options_dict:
+            options_dict[b] = c[section].getboolean(b)
 
     fancy = c[section].getboolean('fancy')
     world_only = c[section].getboolean('world_only')
@@ -245,6 +342,21 @@ def reread_settings(old_settings):
     return s
 
 
+def _run_pipeline(settings, quiet, *commands):
+    """
+    Sends 'commands', (command, ack) tuples, as one CommandPipeline. A
+    missing acknowledgement is only warned about, a backup of a world that
+    may not be fully saved is still better than none.
+    """
+    pipeline = CommandPipeline(settings)
+    for command, ack in commands:
+        pipeline.add(command, ack)
+    try:
+        pipeline.run()
+    except CommandTimeoutError as e:
+        emit_msg(e.msg, level=logging.WARN, quiet=quiet)
+
+
 # TODO: tweak the file name
 def run_server_backup(exclude_files: list, settings: SweetpotatoConfig,
                       quiet: bool, running: bool, world_only: bool,
@@ -261,46 +373,81 @@ def run_server_backup(exclude_files: list, settings: SweetpotatoConfig,
     @param verbose_backup:
     @return:
     """
+    begun_at = time.time()
     backup_dir = settings.backup_dir
     # TODO: make this toggle-able
     date_stamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
     if not force:
         force = is_forced(settings)
 
-    screen_name = settings.screen_name
     server_dir = settings.server_dir
     server_dir_name = server_dir.split(os.path.sep)[-1]
     world_name = settings.world_name
     compression = settings.compression
 
     if playerdata_only:
-        backup_file = '{0}_{1}_playerdata.tar.{2}'.format(date_stamp, world_name, compression)
+        backup_root = os.path.join(server_dir_name, world_name, "playerdata")
+    elif world_only:
+        backup_root = os.path.join(server_dir_name, world_name)
+    else:
+        backup_root = server_dir_name
+
+    region_state = None
+    is_diff = False
+    if settings.backup_mode == 'dedup':
+        backup_ext = MANIFEST_EXT
+        backup_dir = get_store_dirs(backup_dir)[1]
+    elif settings.backup_mode == 'diff':
+        index = get_index(backup_dir, server_dir, backup_root)
+        is_diff = bool(index.load().entries)
+        if is_diff:
+            backup_ext = '_diff.tar.' + compression
+        else:
+            # No full backup to be the difference from, so this is one.
+            backup_ext = '.tar.' + compression
+    elif settings.backup_mode == 'region':
+        region_state = get_region_state(
+            backup_dir, server_dir, backup_root).load()
+        if region_state.headers:
+            backup_ext = '_region.tar.' + compression
+        else:
+            # Nothing to compare against, so this starts a new chain.
+            backup_ext = '_region_base.tar.' + compression
+    else:
+        backup_ext = '.tar.' + compression
+    if playerdata_only:
+        backup_file = '{0}_{1}_playerdata{2}'.format(date_stamp, world_name, backup_ext)
     else:
-        backup_file = '{0}_{1}.tar.{2}'.format(date_stamp, world_name, compression)
+        backup_file = '{0}_{1}{2}'.format(date_stamp, world_name, backup_ext)
     full_path_to_backup_file = os.path.join(backup_dir, backup_file)
     backup_made_today = os.path.isfile(full_path_to_backup_file)
 
     def _can_xz():
+        # lzma joined the standard library in 3.3
         if PYTHON33_OR_GREATER:
-            return False
-        else:
             return True
+        else:
+            return False
 
-    def _exclude_me(tarinfo):
-        # TODO: maybe some day don't do whatever it is I do that forces me to use isinstance ...
-        # Excluding just one file
-        if isinstance(exclude_files, str):
-            if tarinfo.name == exclude_files:
-                return None
+    matcher = ExcludeMatcher(exclude_files)
+    server_dir_prefix = server_dir_name + os.path.sep
 
-        # List of files to exclude
-        else:
-            for _file in exclude_files:
-                if _file in tarinfo.name:
-                    return None
-        emit_msg("Adding: " + tarinfo.name, quiet=(not verbose_backup))
+    def _is_excluded(name, is_dir=False):
+        # Patterns are relative to the server dir, our paths start with it.
+        if name.startswith(server_dir_prefix):
+            name = name[len(server_dir_prefix):]
+        return matcher.match(name, is_dir)
+
+    def _exclude_me(tarinfo):
+        if _is_excluded(tarinfo.name, tarinfo.isdir()):
+            return None
+        if verbose_backup:
+            emit_msg("Adding: " + tarinfo.name)
         return tarinfo
 
+    def _keep_me(path, is_dir=False):
+        return not _is_excluded(path, is_dir)
+
     if backup_made_today and not force:
         sys.stdout.flush()
         try:
@@ -310,43 +457,130 @@ def run_server_backup(exclude_files: list, settings: SweetpotatoConfig,
         except IOError:
             pass
 
-    if running and not playerdata_only:
-        send_command('save-all', is_screen_started(screen_name))
-        send_command('save-off', is_screen_started(screen_name))
-        send_command('say Server backing up now',
-                     is_screen_started(screen_name))
-
-    create_dir(backup_dir)
-
-    if not _can_xz() and settings.compression == 'xz':
-        compression = 'gz'
-
-    os.chdir(os.path.join(server_dir, '..'))
-    tar = tarfile.open(full_path_to_backup_file, 'w:{}'.format(compression))
-    emit_msg('Backing up "{}" ... '.format(world_name))
-    if playerdata_only:
-        try:
-            tar.add(os.path.join(server_dir_name, world_name, "playerdata"), filter=_exclude_me)
-        except FileNotFoundError:
-            pass
-    elif world_only:
-        # File "/home/llx/.local/lib/python3.6/site-packages/sweetpotato/core.py", line 332, in run_server_backup
-        #   tar.add(os.path.join(server_dir_name, world_name), filter=_exclude_me)
-        # FileNotFoundError: [Errno 2] No such file or directory: 'MMGA/MMGA/level.dat_new'
-        try:
-            tar.add(os.path.join(server_dir_name, world_name), filter=_exclude_me)
-        except FileNotFoundError:
-            pass
-    else:
-        try:
-            tar.add(server_dir_name, filter=_exclude_me)
-        except FileNotFoundError:
-            pass
-    tar.close()
+    saves_off = running and not playerdata_only
+    if saves_off:
+        # Turn saving off first so nothing is written after the save-all,
+        # then wait until the server says the save really happened.
+        _run_pipeline(settings, quiet,
+                      ('save-off', SAVE_OFF_ACK),
+                      ('save-all', SAVE_ALL_ACK),
+                      ('say Server backing up now', None))
+    started_at = time.time()
 
-    if running and not playerdata_only:
-        send_command('say Backup complete', is_screen_started(screen_name))
-        send_command('save-on', is_screen_started(screen_name))
+    try:
+        create_dir(backup_dir)
+
+        if not _can_xz() and settings.compression == 'xz':
+            compression = 'gz'
+
+        os.chdir(os.path.join(server_dir, '..'))
+        emit_msg('Backing up "{}" ... '.format(world_name))
+        if settings.staged_backup:
+            # Copy what we need while saving is off, then let the server save
+            # again while we compress the copy.
+            snapshot_dir, stats = snapshot_tree(
+                os.getcwd(), backup_root,
+                get_staging_dir(settings.backup_dir, world_name), keep=_keep_me)
+            if saves_off:
+                _run_pipeline(settings, quiet, ('save-on', SAVE_ON_ACK))
+                saves_off = False
+            snapshot_done_at = time.time()
+            emit_msg('Snapshot took {0:.2f}s ({1} files copied, {2} linked)'.format(
+                snapshot_done_at - started_at, stats['copied'], stats['linked']),
+                quiet=quiet)
+            os.chdir(snapshot_dir)
+        else:
+            snapshot_done_at = started_at
+
+        backup_size = None
+        if settings.backup_mode == 'dedup':
+            try:
+                full_path_to_backup_file, stats = store_backup(
+                    settings.backup_dir, os.getcwd(), backup_root, backup_file,
+                    keep=_keep_me)
+                emit_msg('Stored {0} new chunks ({1} of {2} bytes) for {3} files'.format(
+                    stats['new_chunks'], stats['new_bytes'], stats['bytes'],
+                    stats['files']), quiet=quiet)
+                # What this backup added to the store
+                backup_size = stats['new_bytes']
+            except BackupStoreError as e:
+                # Matches the tarball behavior of a missing playerdata dir
+                emit_msg(e.msg, quiet=quiet)
+        else:
+            compressor = None
+            if settings.jobs > 1:
+                tar, compressor = open_parallel_tar(
+                    full_path_to_backup_file, compression, settings.jobs)
+            else:
+                tar = tarfile.open(full_path_to_backup_file, 'w:{}'.format(compression))
+            try:
+                if region_state:
+                    # Region chains get their own index, a tarball made in
+                    # between two region backups isn't part of the chain.
+                    index = get_index(settings.backup_dir, server_dir, backup_root,
+                                      '.region').load()
+                    new_index, stats = archive_tree(
+                        tar, backup_root, index, filter=_exclude_me,
+                        changed_only=bool(region_state.headers),
+                        deltas=region_state.make_delta)
+                else:
+                    index = get_index(settings.backup_dir, server_dir,
+                                      backup_root).load()
+                    new_index, stats = archive_tree(
+                        tar, backup_root, index, filter=_exclude_me,
+                        changed_only=is_diff)
+                tar.close()
+                if compressor:
+                    compressor.close()
+            except BaseException:
+                # No compressing threads left behind, and no truncated
+                # tarball under the backup's name
+                try:
+                    tar.close()
+                except Exception:
+                    pass
+                if compressor:
+                    compressor.abort()
+                try:
+                    os.remove(full_path_to_backup_file)
+                except FileNotFoundError:
+                    pass
+                raise
+            backup_size = os.path.getsize(full_path_to_backup_file)
+            # Only now that the tarball is complete is it safe to move the
+            # index forward. Differential backups are all made against the
+            # last full one, so they leave it where it is.
+            if not is_diff:
+                new_index.save()
+            if region_state:
+                region_state.headers = {k: v for k, v in region_state.headers.items()
+                                        if k in new_index.entries}
+                region_state.save()
+            if settings.backup_mode in ('diff', 'region'):
+                emit_msg('{0} files changed, {1} unchanged, {2} deleted'.format(
+                    stats['added'], stats['unchanged'], stats['deleted']),
+                    quiet=quiet)
+
+        done_at = time.time()
+        if running and not playerdata_only:
+            server_command(settings, 'say Backup complete')
+    finally:
+        # Whatever happened, the server mustn't be left not saving
+        if saves_off:
+            _run_pipeline(settings, quiet, ('save-on', SAVE_ON_ACK))
+    if saves_off:
+        emit_msg('Saving was off for {0:.2f}s'.format(done_at - started_at),
+                 quiet=quiet)
+    if settings.staged_backup:
+        emit_msg('Compression took {0:.2f}s'.format(done_at - snapshot_done_at),
+                 quiet=quiet)
+    finished_at = time.time()
+    if backup_size is not None:
+        # Only backups that stored something count as the last one
+        record_backup(settings.backup_dir, world_name, {
+            'file': full_path_to_backup_file, 'size': backup_size,
+            'started_at': begun_at, 'finished_at': finished_at,
+            'duration': finished_at - begun_at})
 
     if not quiet:
         # TODO: wtf is this if for?!
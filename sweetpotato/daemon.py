@@ -0,0 +1,557 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+from datetime import datetime, timedelta
+from .common import CONFIG_DIR, METRICS_HOST, PROGNAME, emit_msg
+from .core import run_server_backup
+from .error import DaemonError, SweetpotatoIOErrorBase
+from .events import parse_line
+from .java import get_java_procs
+from .logs import LogFollower, get_latest_log
+from .metrics import BackupStats, add_backup_stats, serve_metrics
+from .perf import PERF_POLL_INTERVAL, PerfMonitor, poll_tps
+from .proc import ResourceSampler, procs_snapshot
+from .schedule import DEFER_RETRY, LAG_WINDOW, CronSchedule, backup_lock, \
+    get_deferral_reason, run_nice
+from .screen import is_screen_started
+from .server import get_uptime, is_server_running, restart_server, save_all, \
+    server_command, start_server, stop_server
+from .status import RosterTracker
+
+# How long a client waits on a query. Starting and stopping can take as long
+# as the server does, so those wait for as long as it takes.
+DAEMON_TIMEOUT = 10
+LIFECYCLE_ACTIONS = ('restart', 'start', 'stop')
+# latest.log is followed closely, /proc only checked now and then since
+# the server exiting is noticed straight away where pidfds are supported.
+LOG_POLL_INTERVAL = 0.25
+PROC_POLL_INTERVAL = 2
+
+
+def get_socket_path(settings):
+    """
+    Returns the path of the Unix socket the daemon for 'settings' listens
+    on: one per screen session, in $XDG_RUNTIME_DIR if there is one.
+
+    @param settings:
+    @return:
+    """
+    run_dir = os.getenv('XDG_RUNTIME_DIR') or CONFIG_DIR
+    return os.path.join(run_dir, '{0}.{1}.sock'.format(
+        PROGNAME, settings.screen_name))
+
+
+def _connect(path, timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def daemon_action(settings, action, timeout=DAEMON_TIMEOUT, **params):
+    """
+    Asks the daemon running for 'settings' to do 'action', passing it
+    'params'. Returns its reply, a dict with the 'result' in it, or None if
+    no daemon is running so the caller can do the work itself.
+
+    @param settings:
+    @param action:
+    @param timeout:
+    @param params:
+    @return:
+    """
+    sock = _connect(get_socket_path(settings), timeout)
+    if sock is None:
+        return None
+    request = dict(params, action=action)
+    with sock, sock.makefile('rb') as replies:
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        line = replies.readline()
+    if not line:
+        raise DaemonError('The daemon hung up without replying to "{}"'.format(
+            action))
+    reply = json.loads(line.decode())
+    if not reply['ok']:
+        raise DaemonError(reply['error'])
+    return reply
+
+
+class Daemon:
+    """
+    Owns one server for as long as it runs: keeps its process, screen
+    session and who's online up to date, and answers requests for them on a
+    Unix socket without running anything. Requests are JSON objects, one per
+    line, with an 'action' and its parameters; each gets a JSON reply line
+    with 'ok' and either a 'result' or an 'error'.
+
+    Starting, stopping and restarting are done one at a time, in a worker
+    thread, by the same functions the command line uses. So are scheduled
+    backups, which wait while too many players are on or the server is
+    lagging, for up to backup_max_deferral minutes.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.path = get_socket_path(settings)
+        self.proc = False
+        self.roster = RosterTracker()
+        self.perf = PerfMonitor()
+        self.sampler = None
+        self.resources = None
+        self.lag_events = 0
+        self.lag_ms = 0
+        self.backup_stats = None
+        if settings.backup_dir:
+            self.backup_stats = BackupStats(settings.backup_dir,
+                                            settings.world_name)
+        self.schedule = None
+        if settings.backup_schedule:
+            self.schedule = CronSchedule(settings.backup_schedule)
+        self.updated = None
+        self.follower = None
+        self._pidfd = None
+        self._lifecycle = None
+        self._backup_thread = None
+        self._loop = None
+        self._stopping = None
+        self.handlers = {
+            'command': self.command,
+            'list': self.list_players,
+            'metrics': self.metrics_sample,
+            'perf': self.perf.summary,
+            'ping': self.ping,
+            'restart': self.lifecycle,
+            'save_all': self.save_all,
+            'start': self.lifecycle,
+            'status': self.status,
+            'stop': self.lifecycle,
+        }
+
+    def refresh_process(self):
+        proc = is_server_running(self.settings.server_dir)
+        if (proc and proc['pid']) != (self.proc and self.proc['pid']):
+            self._watch_exit(proc)
+            self.sampler = ResourceSampler(proc['pid']) if proc else None
+            self.resources = None
+            if not proc:
+                self.roster.players.clear()
+            # Warm the screen session up for the next command
+            is_screen_started(self.settings.screen_name)
+        self.proc = proc
+        self.updated = time.time()
+
+    async def sample_resources(self):
+        """
+        Samples the server's resource use in a worker thread, since reading
+        smaps_rollup for a big JVM takes long enough to hold up requests.
+        CPU use is over the time since the last sample.
+
+        @return:
+        """
+        sampler = self.sampler
+        if sampler is None:
+            return
+        resources = await self._loop.run_in_executor(None, sampler.sample)
+        # Unless the server was replaced while it was being sampled
+        if sampler is self.sampler:
+            self.resources = resources
+
+    def _watch_exit(self, proc):
+        if self._pidfd is not None:
+            self._loop.remove_reader(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+        if not proc or not hasattr(os, 'pidfd_open'):
+            return
+        try:
+            self._pidfd = os.pidfd_open(proc['pid'])
+        except OSError:
+            return
+        self._loop.add_reader(self._pidfd, self.refresh_process)
+
+    def handle_event(self, event):
+        """
+        Keeps the roster of who's online and the lag figures up to date
+        with an event from the server log.
+
+        @param event:
+        @return:
+        """
+        self.roster.handle_event(event)
+        if event['type'] == 'lag':
+            self.perf.add_lag(event['ms'], event['ticks'])
+            self.lag_events += 1
+            self.lag_ms += event['ms']
+
+    def recent_lag(self):
+        """
+        Returns how many ms the server has fallen behind by in the last
+        LAG_WINDOW seconds.
+
+        @return:
+        """
+        return self.perf.lag_ms(LAG_WINDOW)
+
+    def read_log(self):
+        for line in self.follower.iter_lines():
+            self.handle_event(parse_line(line))
+
+    async def _every(self, interval, function):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                result = function()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                emit_msg('{0} failed: {1}'.format(function.__name__, e),
+                         level=logging.ERROR)
+
+    def ping(self):
+        return PROGNAME
+
+    def list_players(self):
+        return self.roster.sorted()
+
+    def status(self):
+        """
+        Returns what --json shows, from what the daemon already knows.
+
+        @return:
+        """
+        status = self.settings.__dict__.copy()
+        status.pop('rcon_password')
+        status['running'] = False
+        if self.proc:
+            status['running'] = dict(self.proc)
+            uptime = get_uptime(timedelta(
+                seconds=time.time() - self.proc['start_time']))
+            status['running'].update(
+                players=self.list_players() or None,
+                players_source='log',
+                perf=self.perf.summary(),
+                resources=self.resources,
+                uptime=dict(zip(('days', 'hours', 'minutes', 'seconds'), uptime)))
+        status['updated'] = self.updated
+        return status
+
+    def metrics_sample(self):
+        """
+        Returns this server's metrics for metrics.format_metrics(), all of
+        them from what the daemon already knows.
+
+        @return:
+        """
+        sample = {'up': 1 if self.proc else 0,
+                  'lag_events': self.lag_events,
+                  'lag_milliseconds': self.lag_ms}
+        if self.proc:
+            sample['uptime_seconds'] = time.time() - self.proc['start_time']
+            sample['players_online'] = len(self.roster.players)
+        if self.resources:
+            sample['jvm_cpu_percent'] = self.resources['cpu_percent']
+            sample['jvm_rss_bytes'] = self.resources['rss']
+            sample['jvm_threads'] = self.resources['threads']
+        stats = self.backup_stats.get() if self.backup_stats else None
+        return add_backup_stats(sample, stats)
+
+    def metrics(self):
+        return {self.settings.world_name: self.metrics_sample()}
+
+    def _require_running(self):
+        if not self.proc:
+            raise DaemonError('{} is not running!'.format(self.settings.world_name))
+
+    async def command(self, command):
+        self._require_running()
+        return await self._loop.run_in_executor(
+            None, server_command, self.settings, command)
+
+    async def save_all(self):
+        self._require_running()
+        return await self._loop.run_in_executor(None, save_all, self.settings)
+
+    def _run_lifecycle(self, action):
+        s = self.settings
+        if action == 'start':
+            start_server(s, True)
+        elif action == 'stop':
+            stop_server(s.screen_name, s.server_dir, s.world_name, True,
+                        s.stop_timeout)
+        else:
+            restart_server(s, True)
+
+    async def lifecycle(self, action):
+        async with self._lifecycle:
+            try:
+                await self._loop.run_in_executor(
+                    None, self._run_lifecycle, action)
+            except SystemExit:
+                # error_and_die() has already logged why
+                raise DaemonError('Couldn\'t {0} {1}, see the daemon\'s'
+                                  ' log'.format(action, self.settings.world_name))
+            finally:
+                self.refresh_process()
+        return self.status()['running']
+
+    def _run_backup(self):
+        s = self.settings
+        with backup_lock(s.backup_dir, s.world_name):
+            run_server_backup(s.exclude_files, s, True, self.proc, s.world_only,
+                              playerdata_only=s.playerdata_only,
+                              verbose_backup=s.verbose_backup)
+
+    async def backup(self):
+        async with self._lifecycle:
+            try:
+                await self._loop.run_in_executor(
+                    self._backup_thread, run_nice, self._run_backup)
+            except SweetpotatoIOErrorBase as e:
+                emit_msg('Scheduled backup failed: {}'.format(e.msg),
+                         level=logging.ERROR)
+            except SystemExit:
+                # error_and_die() has already logged why
+                pass
+            except Exception as e:
+                # Say why, and leave the schedule running for the next one
+                emit_msg('Scheduled backup failed: {}'.format(e),
+                         level=logging.ERROR)
+
+    async def run_schedule(self):
+        """
+        Runs a backup every time the backup_schedule comes around, holding
+        it back while get_deferral_reason() has one.
+
+        @return:
+        """
+        while True:
+            due = self.schedule.next_after(datetime.now())
+            await asyncio.sleep((due - datetime.now()).total_seconds())
+            give_up = time.monotonic() + self.settings.backup_max_deferral * 60
+            while True:
+                reason = get_deferral_reason(
+                    self.settings, len(self.roster.players), self.recent_lag())
+                if not reason or time.monotonic() >= give_up:
+                    break
+                emit_msg('Holding back the {0:%H:%M} backup: {1}'.format(
+                    due, reason))
+                await asyncio.sleep(DEFER_RETRY)
+            if reason:
+                emit_msg('Held back the {0:%H:%M} backup for as long as'
+                         ' backup_max_deferral allows, running it anyway'
+                         ' ({1})'.format(due, reason), level=logging.WARN)
+            await self.backup()
+
+    async def run_perf_polls(self):
+        while True:
+            await asyncio.sleep(PERF_POLL_INTERVAL)
+            if not self.proc:
+                continue
+            try:
+                sample = await self._loop.run_in_executor(
+                    None, poll_tps, self.settings)
+            except SweetpotatoIOErrorBase as e:
+                emit_msg('Polling TPS failed: {}'.format(e.msg),
+                         level=logging.WARN)
+                continue
+            if sample:
+                self.perf.add_sample(*sample)
+
+    async def dispatch(self, request):
+        """
+        Runs one request and returns the reply to it.
+
+        @param request:
+        @return:
+        """
+        try:
+            action = request.pop('action')
+            handler = self.handlers[action]
+        except (AttributeError, KeyError):
+            return {'ok': False, 'error': 'Unknown request {}'.format(request)}
+        if action in LIFECYCLE_ACTIONS:
+            request['action'] = action
+        try:
+            result = handler(**request)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except SweetpotatoIOErrorBase as e:
+            return {'ok': False, 'error': str(e.msg)}
+        except Exception as e:
+            emit_msg('"{0}" failed: {1}'.format(action, e), level=logging.ERROR)
+            return {'ok': False, 'error': str(e)}
+        return {'ok': True, 'result': result}
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode())
+                except ValueError:
+                    reply = {'ok': False, 'error': 'Requests must be JSON'}
+                else:
+                    reply = await self.dispatch(request)
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _claim_socket(self):
+        sock = _connect(self.path, DAEMON_TIMEOUT)
+        if sock is not None:
+            sock.close()
+            raise DaemonError('A daemon is already listening on {}'.format(
+                self.path))
+        if os.path.exists(self.path):
+            # Left behind by one that didn't exit cleanly
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._lifecycle = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._claim_socket()
+        # Catch up on who's online from the whole of the current log
+        self.follower = LogFollower(get_latest_log(self.settings.server_dir),
+                                    from_start=True)
+        self.read_log()
+        # That lag is as old as the log, not recent
+        self.perf.lag.clear()
+        self.lag_events = self.lag_ms = 0
+        self.refresh_process()
+        server = await asyncio.start_unix_server(self._serve_client, self.path)
+        os.chmod(self.path, 0o600)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(sig, self._stopping.set)
+            except (RuntimeError, ValueError):
+                # Not the main thread
+                pass
+        tasks = [asyncio.ensure_future(self._every(LOG_POLL_INTERVAL, self.read_log)),
+                 asyncio.ensure_future(self._every(PROC_POLL_INTERVAL,
+                                                   self.refresh_process)),
+                 asyncio.ensure_future(self._every(PROC_POLL_INTERVAL,
+                                                   self.sample_resources))]
+        if self.settings.tps_command:
+            tasks.append(asyncio.ensure_future(self.run_perf_polls()))
+        if self.schedule:
+            # One thread of its own, so only backups run at a lower priority
+            self._backup_thread = concurrent.futures.ThreadPoolExecutor(1)
+            tasks.append(asyncio.ensure_future(self.run_schedule()))
+        metrics_server = None
+        if self.settings.metrics_port:
+            metrics_server = await asyncio.start_server(
+                lambda r, w: serve_metrics(r, w, self.metrics),
+                METRICS_HOST, self.settings.metrics_port)
+        emit_msg('Daemon for "{0}" listening on {1}'.format(
+            self.settings.world_name, self.path),
+            quiet=getattr(self.settings, 'quiet', False))
+        try:
+            await self._stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for s in (server, metrics_server):
+                if s:
+                    s.close()
+                    await s.wait_closed()
+            self._watch_exit(False)
+            os.unlink(self.path)
+            if self._backup_thread:
+                self._backup_thread.shutdown(wait=False)
+
+    def stop(self):
+        """Makes serve() return; safe to call from any thread."""
+        self._loop.call_soon_threadsafe(self._stopping.set)
+
+
+def run_daemon(settings):
+    """
+    Runs the daemon for 'settings' in the foreground until it's sent a
+    SIGINT or SIGTERM.
+
+    @param settings:
+    @return:
+    """
+    asyncio.run(Daemon(settings).serve())
+
+
+class FleetMetrics:
+    """
+    The metrics of every server in a fleet, from read_fleet(). Those with a
+    daemon running are asked for its metrics_sample(); for the rest, only
+    whether they're up and their last backup are known.
+    """
+    def __init__(self, servers):
+        self.servers = servers
+        self.backup_stats = {name: BackupStats(s.backup_dir, s.world_name)
+                             for name, s in servers.items() if s.backup_dir}
+
+    def _sample(self, name, procs):
+        s = self.servers[name]
+        try:
+            reply = daemon_action(s, 'metrics')
+        except (DaemonError, OSError, ValueError) as e:
+            emit_msg('Couldn\'t get the metrics of "{0}": {1}'.format(name, e),
+                     level=logging.WARNING)
+            reply = None
+        if reply is not None:
+            return reply['result']
+        with procs_snapshot(procs):
+            proc = is_server_running(s.server_dir)
+        sample = {'up': 1 if proc else 0}
+        if proc:
+            sample['uptime_seconds'] = time.time() - proc['start_time']
+        stats = self.backup_stats[name].get() if name in self.backup_stats else None
+        return add_backup_stats(sample, stats)
+
+    def samples(self):
+        # One look through /proc for the whole fleet
+        procs = get_java_procs()
+        return {name: self._sample(name, procs) for name in self.servers}
+
+
+async def _serve_fleet_metrics(servers, port):
+    loop = asyncio.get_running_loop()
+    fleet = FleetMetrics(servers)
+
+    async def samples():
+        # Daemons are asked over their sockets, off the event loop
+        return await loop.run_in_executor(None, fleet.samples)
+
+    server = await asyncio.start_server(
+        lambda r, w: serve_metrics(r, w, samples), METRICS_HOST, port)
+    emit_msg('Metrics for {0} servers listening on {1}:{2}'.format(
+        len(servers), METRICS_HOST, port))
+    async with server:
+        await server.serve_forever()
+
+
+def run_fleet_metrics(servers, port):
+    """
+    Serves the metrics of every server in 'servers', from read_fleet(), on
+    'port' until it's sent a SIGINT.
+
+    @param servers:
+    @param port:
+    @return:
+    """
+    try:
+        asyncio.run(_serve_fleet_metrics(servers, port))
+    except KeyboardInterrupt:
+        pass
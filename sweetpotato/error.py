@@ -11,6 +11,21 @@ class BackupFileAlreadyExistsError(SweetpotatoIOErrorBase):
     pass
 
 
+class BackupInProgressError(SweetpotatoIOErrorBase):
+    """Raised when another backup to the same backup dir is running."""
+    pass
+
+
+class BackupStoreError(SweetpotatoIOErrorBase):
+    """Raised when the backup store is missing or holds a corrupt chunk."""
+    pass
+
+
+class CommandTimeoutError(SweetpotatoIOErrorBase):
+    """Raised when the server doesn't acknowledge a command in time."""
+    pass
+
+
 class ConfFileError(SweetpotatoIOErrorBase):
     """
     Raised when a given conf file doesn't exist or have the right section.
@@ -18,6 +33,11 @@ class ConfFileError(SweetpotatoIOErrorBase):
     pass
 
 
+class DaemonError(SweetpotatoIOErrorBase):
+    """Raised when the daemon can't be started or refuses a request."""
+    pass
+
+
 class EmptySettingError(SweetpotatoIOErrorBase):
     """Raised when a required setting value is None."""
     pass
@@ -38,11 +58,26 @@ class NoJarFoundError(SweetpotatoIOErrorBase):
     pass
 
 
+class QueryError(SweetpotatoIOErrorBase):
+    """Raised when a server's Query listener doesn't answer properly."""
+    pass
+
+
+class RconError(SweetpotatoIOErrorBase):
+    """Raised when we can't talk to the server over RCON."""
+    pass
+
+
 class ServerAlreadyRunningError(SweetpotatoIOErrorBase):
     """Raised when the configured server is already running."""
     pass
 
 
+class ServerNotReadyError(SweetpotatoIOErrorBase):
+    """Raised when a server that was started doesn't take connections in time."""
+    pass
+
+
 class ServerNotRunningError(SweetpotatoIOErrorBase):
     """Raised when the server is not running but was expected to be."""
     pass
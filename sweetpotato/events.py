@@ -0,0 +1,235 @@
+import gzip
+import os
+import re
+
+from datetime import datetime, timedelta
+
+# "[12:00:00] [Server thread/INFO]: msg" from vanilla, with an extra
+# "[FML]" style logger name from Forge, or "[12:00:00 INFO]: msg" from
+# Bukkit and friends.
+LINE_RE = re.compile(
+    r'^\[(?P<clock>\d\d:\d\d:\d\d)(?: (?P<short_level>[A-Z]+))?\]'
+    r'(?: \[(?P<thread>[^\]]*)/(?P<level>[A-Z]+)\])?'
+    r'(?: \[(?P<logger>[^\]]+)\])?: (?P<message>.*)$')
+# Rotated logs are named for the day they were started on.
+ROTATED_LOG_RE = re.compile(r'^(?P<date>\d{4}-\d{2}-\d{2})-(?P<n>\d+)\.log\.gz$')
+PLAYER_NAMES_RE = re.compile(r'\s*,\s*')
+
+# (type, a string the message must contain, the regular expression that
+# picks it apart), tried in order. The substring check is much cheaper than
+# the regular expression, so most lines never get to one.
+EVENT_PATTERNS = [
+    ('chat', '<', re.compile(r'^<(?P<player>[^>]+)> (?P<text>.*)$')),
+    ('join', ' joined the game', re.compile(r'^(?P<player>\S+) joined the game$')),
+    ('leave', ' left the game', re.compile(r'^(?P<player>\S+) left the game$')),
+    ('command', ' issued server command: ', re.compile(
+        r'^(?P<player>\S+) issued server command: (?P<command>.*)$')),
+    ('command', ': ', re.compile(r'^\[(?P<player>[^\]:]+): (?P<command>.*)\]$')),
+    ('chat', '] ', re.compile(r'^\[(?P<player>[^\]]+)\] (?P<text>.*)$')),
+    ('lag', 'Can\'t keep up!', re.compile(
+        r'Running (?P<ms>\d+)ms (?:or (?P<ticks>\d+) ticks )?behind'
+        r'(?:, skipping (?P<skipped>\d+) tick)?')),
+    ('save', 'Saved the ', re.compile(r'^Saved the (?:game|world)$')),
+    ('list', ' players online:', re.compile(
+        r'There are (?P<online>\d+)(?:/| of a max of )(?P<max>\d+) players'
+        r' online:(?P<names>.*)$')),
+    ('crash', 'crash report', re.compile(
+        r'crash report has been saved to: (?P<path>.*)$')),
+    ('crash', 'unexpected exception', re.compile(
+        r'^Encountered an unexpected exception')),
+    ('mod_load', ' took ', re.compile(
+        r'^Bar Step: (?P<stage>.+?) - (?P<mod>.+?) took (?P<seconds>[\d.]+)s$')),
+    ('start', 'Done (', re.compile(r'^Done \((?P<seconds>[\d.,]+)s\)!')),
+    ('stop', 'Stopping server', re.compile(r'^Stopping server$')),
+]
+
+
+def clock_seconds(clock):
+    h, m, s = clock.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+def split_player_names(names):
+    return [n for n in PLAYER_NAMES_RE.split(names.strip()) if n]
+
+
+def parse_message(message):
+    """
+    Works out what kind of event a console message is. Returns its type
+    ('other' if it's nothing we know) and a dict of what was picked out of
+    it, like the player's name for a 'join'.
+
+    @param message:
+    @return:
+    """
+    for event_type, needle, regex in EVENT_PATTERNS:
+        if needle not in message:
+            continue
+        m = regex.search(message)
+        if not m:
+            continue
+        data = {k: v for k, v in m.groupdict().items() if v is not None}
+        if event_type == 'lag':
+            data['ms'] = int(data['ms'])
+            data['ticks'] = int(data.pop('ticks', 0) or data.pop('skipped', 0))
+            data.pop('skipped', None)
+        elif event_type == 'list':
+            data['online'] = int(data['online'])
+            data['max'] = int(data['max'])
+            data['players'] = split_player_names(data.pop('names'))
+        elif event_type in ('mod_load', 'start'):
+            data['seconds'] = float(data['seconds'].replace(',', '.'))
+        return event_type, data
+    return 'other', {}
+
+
+def parse_line(line):
+    """
+    Parses one log line into an event dict: its 'type' and 'message', the
+    'clock' time, 'thread' and 'level' it was logged with (None for a line
+    without the usual prefix, like RCON output) and whatever parse_message()
+    picked out of it.
+
+    @param line:
+    @return:
+    """
+    line = line.rstrip('\r\n')
+    m = LINE_RE.match(line)
+    if m:
+        message = m.group('message')
+        event = {'clock': m.group('clock'), 'thread': m.group('thread'),
+                 'level': m.group('level') or m.group('short_level')}
+    else:
+        message = line
+        event = {'clock': None, 'thread': None, 'level': None}
+    event['type'], data = parse_message(message)
+    event['message'] = message
+    event.update(data)
+    return event
+
+
+def read_log(path):
+    """
+    Yields the lines of a log, gzipped or not, one at a time.
+
+    @param path:
+    @return:
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', errors='replace') as log:
+        for line in log:
+            yield line
+
+
+def get_log_start_date(path):
+    """
+    Returns the day a log was started on. Rotated logs have it in their
+    name. For latest.log it's the day it was last written to, less one
+    for every midnight it has seen, found by reading just its timestamps.
+
+    @param path:
+    @return:
+    """
+    m = ROTATED_LOG_RE.match(os.path.basename(path))
+    if m:
+        return datetime.strptime(m.group('date'), '%Y-%m-%d').date()
+    last_written = datetime.fromtimestamp(os.path.getmtime(path)).date()
+    midnights = 0
+    previous = None
+    for line in read_log(path):
+        m = LINE_RE.match(line)
+        if not m:
+            continue
+        seconds = clock_seconds(m.group('clock'))
+        if previous is not None and seconds < previous:
+            midnights += 1
+        previous = seconds
+    return last_written - timedelta(days=midnights)
+
+
+def date_events(events, start_date, previous=None):
+    """
+    Gives each of 'events' (from parse_line()) a 'time' datetime counted
+    from 'start_date', the clock going backwards meaning a new day. Events
+    without a timestamp are skipped. 'previous' is the clock_seconds() of
+    the line before the first one, if that's known.
+
+    @param events:
+    @param start_date:
+    @param previous:
+    @return:
+    """
+    day = datetime(start_date.year, start_date.month, start_date.day)
+    for event in events:
+        if event['clock'] is None:
+            continue
+        seconds = clock_seconds(event['clock'])
+        if previous is not None and seconds < previous:
+            day += timedelta(days=1)
+        previous = seconds
+        event['time'] = day + timedelta(seconds=seconds)
+        yield event
+
+
+def iter_events(lines, start_date, types=None):
+    """
+    Turns 'lines' into dated events with parse_line() and date_events().
+    Only events whose type is in 'types' are yielded if it's given.
+
+    @param lines:
+    @param start_date:
+    @param types:
+    @return:
+    """
+    for event in date_events((parse_line(l) for l in lines), start_date):
+        if not types or event['type'] in types:
+            yield event
+
+
+def iter_log_events(path, types=None):
+    """
+    Yields the events in the log at 'path', see iter_events().
+
+    @param path:
+    @param types:
+    @return:
+    """
+    for event in iter_events(read_log(path), get_log_start_date(path), types):
+        yield event
+
+
+def get_log_files(server_dir):
+    """
+    Returns a server's rotated logs, oldest first, then its latest.log.
+
+    @param server_dir:
+    @return:
+    """
+    logs_dir = os.path.join(server_dir, 'logs')
+    try:
+        names = os.listdir(logs_dir)
+    except FileNotFoundError:
+        return []
+    rotated = []
+    for name in names:
+        m = ROTATED_LOG_RE.match(name)
+        if m:
+            rotated.append((m.group('date'), int(m.group('n')), name))
+    logs = [os.path.join(logs_dir, name) for _, _, name in sorted(rotated)]
+    latest = os.path.join(logs_dir, 'latest.log')
+    if os.path.isfile(latest):
+        logs.append(latest)
+    return logs
+
+
+def iter_server_events(server_dir, types=None):
+    """
+    Yields every event in a server's logs, oldest first.
+
+    @param server_dir:
+    @param types:
+    @return:
+    """
+    for path in get_log_files(server_dir):
+        for event in iter_log_events(path, types):
+            yield event
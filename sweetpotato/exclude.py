@@ -0,0 +1,116 @@
+import re
+
+from .error import ConfFileError
+
+# Patterns starting with this are used as regular expressions as is.
+REGEX_PREFIX = 're:'
+
+
+def _glob_to_re(glob):
+    """
+    Translates one gitignore style glob into a regular expression. '*' and
+    '?' don't match across a '/', '**' does.
+
+    @param glob:
+    @return:
+    """
+    i, n = 0, len(glob)
+    out = ''
+    while i < n:
+        c = glob[i]
+        if glob.startswith('**/', i):
+            out += '(?:.*/)?'
+            i += 3
+            continue
+        elif glob.startswith('**', i):
+            out += '.*'
+            i += 2
+            continue
+        elif c == '*':
+            out += '[^/]*'
+        elif c == '?':
+            out += '[^/]'
+        elif c == '[' and glob.find(']', i + 2) != -1:
+            j = glob.find(']', i + 2)
+            chars = glob[i + 1:j].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            out += '[' + chars + ']'
+            i = j + 1
+            continue
+        else:
+            out += re.escape(c)
+        i += 1
+    return out
+
+
+def _flatten(patterns):
+    if isinstance(patterns, str):
+        return patterns.split()
+    flat = []
+    for p in patterns:
+        flat.extend(_flatten(p))
+    return flat
+
+
+class ExcludeMatcher:
+    """
+    Decides whether a path (relative to the server dir) should be left out
+    of a backup, using gitignore style patterns compiled down to two
+    regular expressions so each path costs one or two regex matches no
+    matter how many patterns there are:
+
+     * 'name' matches a file or directory with that name anywhere
+     * 'some/path' and '/name' match relative to the server dir
+     * a trailing '/' only matches directories
+     * '*', '?', '[abc]' and '**' work like they do for git
+     * 're:<regex>' matches the whole relative path against <regex>
+
+    Directories that match should not be descended into at all. A <regex>
+    that doesn't compile raises ConfFileError.
+    """
+    def __init__(self, patterns):
+        any_res = []
+        dir_res = []
+        for pattern in _flatten(patterns):
+            if pattern.startswith(REGEX_PREFIX):
+                regex = '^(?:{})$'.format(pattern[len(REGEX_PREFIX):])
+                try:
+                    # On its own, so a bad one can be named
+                    re.compile(regex)
+                except re.error as e:
+                    raise ConfFileError(
+                        'Bad exclude pattern "{0}": {1}'.format(pattern, e))
+                any_res.append(regex)
+                continue
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if '/' in pattern:
+                regex = '^' + _glob_to_re(pattern.lstrip('/')) + '$'
+            else:
+                regex = '(?:^|/)' + _glob_to_re(pattern) + '$'
+            if dir_only:
+                dir_res.append(regex)
+            else:
+                any_res.append(regex)
+        self.any_re = self._compile(any_res)
+        self.dir_re = self._compile(any_res + dir_res)
+
+    @staticmethod
+    def _compile(regexes):
+        if regexes:
+            return re.compile('|'.join(regexes))
+        return None
+
+    def match(self, path, is_dir=False):
+        """
+        Returns True if 'path' should be excluded.
+
+        @param path:
+        @param is_dir:
+        @return:
+        """
+        regex = self.dir_re if is_dir else self.any_re
+        return bool(regex and regex.search(path))
@@ -0,0 +1,227 @@
+import concurrent.futures
+import configparser
+import os
+
+from .common import DEFAULT_FLEET_JOBS, DEFAULT_ROLLING_JOBS, \
+    DEFAULT_WORLD_NAME
+from .core import SweetpotatoConfig, read_conf_file, run_server_backup, \
+    validate_settings
+from .error import ConfFileError, EmptySettingError, SweetpotatoIOErrorBase
+from .java import get_java_procs
+from .logs import LogFollower, get_latest_log
+from .proc import procs_snapshot
+from .schedule import backup_lock
+from .server import is_server_running, restart_server, start_server, \
+    stop_server, wait_for_server_ready
+
+try:
+    from .daemon import daemon_action
+except ImportError:
+    daemon_action = None
+
+# What each action other than status reports when it has worked
+DONE = {'backup': 'backed up', 'restart': 'restarted', 'start': 'started',
+        'stop': 'stopped'}
+FLEET_ACTIONS = ('backup', 'restart', 'start', 'status', 'stop')
+# Fleet files have one of these per server, "[Server:survival]" and so on,
+# with anything they share in an ordinary [Settings] section.
+SERVER_SECTION_PREFIX = 'Server:'
+SHARED_SECTION = 'Settings'
+
+
+def _read_fleet_dir(path):
+    servers = {}
+    for name in sorted(os.listdir(path)):
+        conf = os.path.join(path, name)
+        if not name.endswith('.conf') or not os.path.isfile(conf):
+            continue
+        s = SweetpotatoConfig()
+        read_conf_file(conf, s)
+        s.conf_file = conf
+        servers[name[:-len('.conf')]] = s
+    return servers
+
+
+def _read_fleet_file(path):
+    c = configparser.ConfigParser()
+    try:
+        if not c.read(path):
+            raise ConfFileError(
+                'The specified fleet file does not exist: {}'.format(path))
+    except configparser.Error as e:
+        raise ConfFileError('Bad fleet file {0}: {1}'.format(path, e))
+    servers = {}
+    for section in c.sections():
+        if not section.startswith(SERVER_SECTION_PREFIX):
+            continue
+        s = SweetpotatoConfig()
+        if c.has_section(SHARED_SECTION):
+            read_conf_file(path, s)
+        read_conf_file(path, s, section)
+        s.conf_file = path
+        servers[section[len(SERVER_SECTION_PREFIX):]] = s
+    return servers
+
+
+def read_fleet(path):
+    """
+    Reads the servers in a fleet: either a directory of conf files, named
+    after the file, or a single file of [Server:<name>] sections. Returns a
+    dict of server name to its settings.
+
+    @param path:
+    @return:
+    """
+    if os.path.isdir(path):
+        servers = _read_fleet_dir(path)
+    else:
+        servers = _read_fleet_file(path)
+    if not servers:
+        raise ConfFileError('No servers found in {}'.format(path))
+    for name, s in servers.items():
+        if s.world_name != DEFAULT_WORLD_NAME and \
+           s.screen_name == DEFAULT_WORLD_NAME:
+            s.screen_name = s.world_name
+        try:
+            validate_settings(s)
+        except EmptySettingError as e:
+            raise ConfFileError('"{0}": {1}'.format(name, e.msg))
+    return servers
+
+
+def _ask_daemon(settings, action):
+    if daemon_action is None or action == 'backup':
+        return None
+    params = {} if action == 'status' else {'timeout': None}
+    return daemon_action(settings, action, **params)
+
+
+def _run_action(settings, action):
+    if action == 'restart':
+        # Only done once the server is back up, which a daemon doesn't wait
+        # for, so followed from before it goes down
+        follower = LogFollower(get_latest_log(settings.server_dir))
+    reply = _ask_daemon(settings, action)
+    if reply is not None:
+        if action == 'restart':
+            wait_for_server_ready(settings, follower, settings.start_timeout)
+        return reply['result'] if action == 'status' else DONE[action]
+    running = is_server_running(settings.server_dir)
+    if action == 'status':
+        settings.running = running
+        return settings.as_dict
+    elif action == 'backup':
+        with backup_lock(settings.backup_dir, settings.world_name):
+            run_server_backup(settings.exclude_files, settings, True, running,
+                              settings.world_only,
+                              playerdata_only=settings.playerdata_only,
+                              verbose_backup=settings.verbose_backup)
+    elif action == 'restart':
+        restart_server(settings, True, ready_timeout=settings.start_timeout)
+    elif action == 'start':
+        start_server(settings, True)
+    elif action == 'stop':
+        stop_server(settings.screen_name, settings.server_dir,
+                    settings.world_name, True, settings.stop_timeout)
+    return DONE[action]
+
+
+def run_on_server(settings, action, procs):
+    """
+    Runs 'action' on one server of a fleet, with 'procs' standing in for
+    /proc until it's done. Returns a dict with 'ok' and either its 'result'
+    or the 'error' it failed with.
+
+    @param settings:
+    @param action:
+    @param procs:
+    @return:
+    """
+    settings.quiet = True
+    try:
+        with procs_snapshot(procs):
+            result = _run_action(settings, action)
+    except SweetpotatoIOErrorBase as e:
+        return {'ok': False, 'error': str(e.msg)}
+    except (OSError, ValueError) as e:
+        # Talking to its daemon went wrong
+        return {'ok': False, 'error': str(e)}
+    except SystemExit:
+        # error_and_die(), which quiet keeps from saying why
+        return {'ok': False, 'error': 'Couldn\'t {0} "{1}", try it without'
+                                      ' --fleet'.format(action, settings.world_name)}
+    return {'ok': True, 'result': result}
+
+
+def _get_result(future):
+    try:
+        return future.result()
+    except Exception as e:
+        # The worker died or couldn't be handed the job
+        return {'ok': False, 'error': str(e)}
+
+
+def run_fleet_action(servers, action, jobs=DEFAULT_FLEET_JOBS):
+    """
+    Runs 'action' on every server in 'servers', from read_fleet(), at most
+    'jobs' at a time. Java processes are looked for once for the whole
+    fleet, not once per server. Each server gets its own process, since
+    starting and backing up change directory. Returns a dict of server name
+    to run_on_server().
+
+    @param servers:
+    @param action:
+    @param jobs:
+    @return:
+    """
+    if action not in FLEET_ACTIONS:
+        raise ValueError('Not a fleet action: {}'.format(action))
+    procs = get_java_procs()
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, min(jobs, len(servers)))) as pool:
+        futures = {name: pool.submit(run_on_server, s, action, procs)
+                   for name, s in servers.items()}
+        for name, future in futures.items():
+            results[name] = _get_result(future)
+    return results
+
+
+def rolling_restart(servers, jobs=DEFAULT_ROLLING_JOBS):
+    """
+    Restarts every server in 'servers', from read_fleet(), in order and
+    with no more than 'jobs' down at a time: the next one is only started
+    on once one before it is taking connections again. If one doesn't come
+    back within its start_timeout the roll stops there. Those already
+    restarting are seen through, the rest are left running as they are.
+    Java processes are looked for again before each batch, since those
+    restarted so far have new ones. Returns a dict like run_fleet_action()
+    does.
+
+    @param servers:
+    @param jobs:
+    @return:
+    """
+    waiting = list(servers.items())
+    results = {}
+    pending = {}
+    failed = None
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, min(jobs, len(servers)))) as pool:
+        while pending or (waiting and not failed):
+            if waiting and not failed and len(pending) < jobs:
+                procs = get_java_procs()
+            while waiting and not failed and len(pending) < jobs:
+                name, s = waiting.pop(0)
+                pending[pool.submit(run_on_server, s, 'restart', procs)] = name
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                results[name] = _get_result(future)
+                if not results[name]['ok'] and failed is None:
+                    failed = name
+    for name, _ in waiting:
+        results[name] = {'ok': False, 'error': 'Not restarted, the roll'
+                                               ' stopped at "{}"'.format(failed)}
+    return results
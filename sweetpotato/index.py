@@ -0,0 +1,202 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+
+from .common import INDEX_DIR_NAME, server_key
+
+# Where the list of files deleted since the previous backup goes in a
+# differential tarball, outside of the server dir so extracting it by hand
+# doesn't litter the server with it.
+DELETED_MEMBER = '.sweetpotato/deleted'
+# The sha256 of every file in a tarball, so a restore can check them.
+SHA256_MEMBER = '.sweetpotato/sha256'
+
+
+class FileIndex:
+    """
+    Remembers the size, mtime, inode and sha256 of every file that went
+    into the last backup, so the next one can tell what has changed with
+    one stat() per file instead of reading everything.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rt') as i:
+                self.entries = json.load(i)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError):
+            # A broken index just means the next backup has to look at
+            # every file again, not worth dying over.
+            self.entries = {}
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with gzip.open(tmp_path, 'wt') as i:
+            json.dump(self.entries, i)
+        os.replace(tmp_path, self.path)
+
+    def is_unchanged(self, path, st):
+        entry = self.entries.get(path)
+        return entry is not None and entry[0] == st.st_size \
+            and entry[1] == st.st_mtime_ns and entry[2] == st.st_ino
+
+    def get_hash(self, path):
+        entry = self.entries.get(path)
+        return entry[3] if entry else None
+
+
+def get_index(backup_dir, server_dir, backup_root, kind=''):
+    """
+    Returns the (not yet loaded) index for backups of 'backup_root' in
+    'server_dir'.
+
+    Full, world only and playerdata only backups each get their own, and
+    so does each 'kind' of backup chain that must not see the others.
+
+    @param backup_dir:
+    @param server_dir:
+    @param backup_root:
+    @param kind:
+    @return:
+    """
+    name = '{0}.{1}'.format(server_key(server_dir), backup_root.strip(
+        os.path.sep).replace(os.path.sep, '_'))
+    return FileIndex(os.path.join(
+        backup_dir, INDEX_DIR_NAME, '{0}{1}.index'.format(name, kind)))
+
+
+class _HashingReader:
+    """Hashes whatever tarfile reads through it."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def archive_tree(tar, backup_root, index, filter=None, changed_only=False,
+                 deltas=None):
+    """
+    Adds 'backup_root' (relative to the cwd) to 'tar' like tar.add() would,
+    hashing each file on its way in, and returns a new index describing
+    what was archived along with some stats.
+
+    'filter' works like it does for tar.add(), returning None for a
+    directory skips everything under it.
+
+    If 'changed_only' is True, files that 'index' says haven't changed
+    are left out and the paths that disappeared since 'index' was made are
+    listed in a DELETED_MEMBER file, making this a differential backup.
+    The hash of every file (or delta) archived goes in a SHA256_MEMBER file
+    at the end.
+
+    'deltas' is an optional callable that's given each file's path and can
+    return an (arcname, bytes) tuple to archive instead of the file itself,
+    or None to archive it as usual.
+
+    @param tar:
+    @param backup_root:
+    @param index:
+    @param filter:
+    @param changed_only:
+    @param deltas:
+    @return:
+    """
+    new_index = FileIndex(index.path)
+    stats = {'added': 0, 'deleted': 0, 'unchanged': 0}
+    hashes = []
+
+    def _dir_tarinfo(path):
+        tarinfo = tar.gettarinfo(path)
+        if filter:
+            tarinfo = filter(tarinfo)
+        return tarinfo
+
+    try:
+        dir_infos = {backup_root: _dir_tarinfo(backup_root)}
+    except FileNotFoundError:
+        dir_infos = {}
+    if not dir_infos.get(backup_root):
+        return new_index, stats
+
+    for dirpath, dirnames, filenames in os.walk(backup_root):
+        # Directory entries are tiny, so they always go in, that way empty
+        # directories survive a differential backup too.
+        tar.addfile(dir_infos.pop(dirpath))
+        for d in sorted(dirnames):
+            path = os.path.join(dirpath, d)
+            if os.path.islink(path):
+                filenames.append(d)
+                continue
+            try:
+                tarinfo = _dir_tarinfo(path)
+            except FileNotFoundError:
+                continue
+            if tarinfo is not None:
+                dir_infos[path] = tarinfo
+        dirnames[:] = sorted(os.path.basename(p) for p in dir_infos
+                             if os.path.dirname(p) == dirpath)
+
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+                if changed_only and index.is_unchanged(path, st):
+                    new_index.entries[path] = index.entries[path]
+                    stats['unchanged'] += 1
+                    continue
+                tarinfo = tar.gettarinfo(path)
+                if filter:
+                    tarinfo = filter(tarinfo)
+                    if tarinfo is None:
+                        continue
+                delta = deltas(path) if deltas and tarinfo.isreg() else None
+                if delta:
+                    # The delta is what a restore gets to check
+                    arcname, data = delta
+                    _add_bytes(tar, arcname, data)
+                    hashes.append((arcname, hashlib.sha256(data).hexdigest()))
+                    digest = None
+                elif tarinfo.isreg():
+                    with open(path, 'rb') as f:
+                        reader = _HashingReader(f)
+                        tar.addfile(tarinfo, reader)
+                    digest = reader.sha256.hexdigest()
+                    hashes.append((path, digest))
+                else:
+                    tar.addfile(tarinfo)
+                    digest = None
+            except FileNotFoundError:
+                # Deleted by the server while we were walking, e.g. level.dat_new
+                continue
+            new_index.entries[path] = [st.st_size, st.st_mtime_ns, st.st_ino,
+                                       digest]
+            stats['added'] += 1
+
+    deleted = sorted(set(index.entries) - set(new_index.entries))
+    stats['deleted'] = len(deleted)
+    if changed_only and deleted:
+        _add_bytes(tar, DELETED_MEMBER, '\n'.join(deleted).encode() + b'\n')
+    _add_bytes(tar, SHA256_MEMBER, ''.join(
+        '{0}  {1}\n'.format(digest, path) for path, digest in hashes).encode())
+    return new_index, stats
+
+
+def _add_bytes(tar, name, data):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    tar.addfile(tarinfo, io.BytesIO(data))
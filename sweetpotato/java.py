@@ -1,58 +1,16 @@
 import os
-import subprocess
 
 from .common import FORGE_JAR_NAME, VANILLA_JAR_NAME
 from .error import NoJarFoundError
+from .proc import get_procs
 
 
 def get_java_procs():
     """
-    Checks for running Java processes and return the
-    cwd, exe, and pid of any we find.
+    Returns a list of every running Java process, as dicts of pid, comm,
+    cmdline, cwd, exe and start_time read straight from /proc.
     """
-    cwd, exe, pid = None, None, None
-    p = subprocess.Popen(['pgrep', 'java'], stdout=subprocess.PIPE)
-    output = p.communicate()[0]
-
-    if output and len(output.split()) is 1:
-        # One Java process
-        pid = output.decode().strip()
-        c = subprocess.Popen(
-            ['/bin/ls', '-l', '/proc/{0}/cwd'.format(pid)],
-            stdout=subprocess.PIPE)
-        c_out = c.communicate()[0]
-        cwd = c_out.decode().split()[-1]
-        e = subprocess.Popen(
-            ['/bin/ls', '-l', '/proc/{0}/exe'.format(pid)],
-            stdout=subprocess.PIPE)
-        e_out = e.communicate()[0]
-        try:
-            exe = e_out.decode().split()[-1]
-        except IndexError:
-            # process may have stopped/restarted
-            return None
-    elif output and len(output.split()) > 1:
-        # More than one Java process
-        proc_list = []
-        for P in output.decode().split():
-            pid = P
-            c = subprocess.Popen(
-                ['/bin/ls', '-l', '/proc/{0}/cwd'.format(pid)],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            c_out = c.communicate()[0]
-            cwd = c_out.decode().split()[-1]
-            e = subprocess.Popen(
-                ['/bin/ls', '-l', '/proc/{0}/exe'.format(pid)],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            e_out = e.communicate()[0]
-            exe = e_out.decode().split()[-1]
-            proc_list.append((cwd, exe, pid))
-        return proc_list
-
-    if cwd and exe and pid:
-        return cwd, exe, pid
-    else:
-        return None
+    return get_procs('java')
 
 
 def get_jar(settings):
@@ -0,0 +1,232 @@
+import gzip
+import json
+import os
+
+from datetime import datetime, timedelta
+from .common import INDEX_DIR_NAME, server_key
+from .events import EVENT_PATTERNS, clock_seconds, date_events, \
+    get_log_files, get_log_start_date, parse_line
+
+DATE_FMT = '%Y-%m-%d'
+QUERY_TIME_FMTS = (DATE_FMT, '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+TIME_FMT = '%Y-%m-%dT%H:%M:%S'
+EVENT_TYPES = sorted(set(t for t, _, _ in EVENT_PATTERNS))
+
+
+def _open(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def _read_lines(path, entry):
+    """
+    Yields (offset, line) for each complete line of 'path' from
+    entry['offset'] on, moving entry['offset'] past each one. A last line
+    without its newline is still being written and is left for next time.
+    """
+    with _open(path) as f:
+        f.seek(entry['offset'])
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                return
+            offset = entry['offset']
+            entry['offset'] += len(raw)
+            yield offset, raw.decode(errors='replace')
+
+
+class LogIndex:
+    """
+    A compact index of a server's logs: for each log file, the time span it
+    covers, every player named in it, and where each event that isn't
+    'other' is, by type. Times are stored as seconds from the midnight the
+    log started on.
+
+    Rotated logs never change, so they're only read once. latest.log is
+    read from where the last update() stopped until it's rotated.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rt') as i:
+                self.files = json.load(i)
+        except (OSError, ValueError):
+            # Rebuilding is slow but always possible
+            self.files = {}
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with gzip.open(tmp_path, 'wt') as i:
+            json.dump(self.files, i, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def _index_file(self, path, entry):
+        base = datetime.strptime(entry['base'], DATE_FMT)
+        day = datetime.strptime(entry['day'], DATE_FMT)
+        events = (dict(parse_line(line), offset=offset)
+                  for offset, line in _read_lines(path, entry))
+        for event in date_events(events, day, entry['clock']):
+            t = event['time']
+            seconds = int((t - base).total_seconds())
+            if entry['start'] is None:
+                entry['start'] = t.strftime(TIME_FMT)
+            entry['end'] = t.strftime(TIME_FMT)
+            entry['day'] = t.strftime(DATE_FMT)
+            entry['clock'] = clock_seconds(event['clock'])
+            if event['type'] != 'other':
+                entry['events'].setdefault(event['type'], []).append(
+                    [event['offset'], seconds])
+            player = event.get('player')
+            if player:
+                entry['players'].setdefault(player, [seconds, seconds])[1] = seconds
+
+    def update(self, server_dir):
+        """
+        Brings the index up to date with the logs in 'server_dir', reading
+        only what's new. Returns how many log files had to be read.
+
+        @param server_dir:
+        @return:
+        """
+        logs = {os.path.basename(p): p for p in get_log_files(server_dir)}
+        for name in set(self.files) - set(logs):
+            del self.files[name]
+        updated = 0
+        for name, path in sorted(logs.items()):
+            st = os.stat(path)
+            entry = self.files.get(name)
+            if entry and entry['inode'] == st.st_ino \
+                    and entry['size'] == st.st_size:
+                continue
+            if not entry or entry['inode'] != st.st_ino \
+                    or st.st_size < entry['size']:
+                start_date = get_log_start_date(path).strftime(DATE_FMT)
+                entry = {'offset': 0, 'base': start_date, 'day': start_date,
+                         'clock': None, 'start': None, 'end': None,
+                         'players': {}, 'events': {}}
+            entry['inode'] = st.st_ino
+            entry['size'] = st.st_size
+            self._index_file(path, entry)
+            self.files[name] = entry
+            updated += 1
+        return updated
+
+    def _read_events(self, path, hits, base):
+        with _open(path) as f:
+            for offset, seconds in sorted(hits):
+                f.seek(offset)
+                event = parse_line(f.readline().decode(errors='replace'))
+                event['time'] = base + timedelta(seconds=seconds)
+                yield event
+
+    def search(self, server_dir, player=None, types=None, since=None,
+               until=None, text=None, limit=None):
+        """
+        Returns the events that match every one of the criteria given,
+        oldest first: 'player' named in them, of one of 'types', between
+        the 'since' and 'until' datetimes, with 'text' in their message.
+        With 'limit' only the newest that many are returned.
+
+        Only the log files and lines the index points at are read.
+
+        @param server_dir:
+        @param player:
+        @param types:
+        @param since:
+        @param until:
+        @param text:
+        @param limit:
+        @return:
+        """
+        results = []
+        newest_first = sorted(
+            ((e['start'], name) for name, e in self.files.items() if e['start']),
+            reverse=True)
+        for _, name in newest_first:
+            entry = self.files[name]
+            if since and entry['end'] < since.strftime(TIME_FMT):
+                continue
+            if until and entry['start'] > until.strftime(TIME_FMT):
+                continue
+            if player and player not in entry['players']:
+                continue
+            base = datetime.strptime(entry['base'], DATE_FMT)
+            low = (since - base).total_seconds() if since else None
+            high = (until - base).total_seconds() if until else None
+            hits = []
+            for event_type, offsets in entry['events'].items():
+                if types and event_type not in types:
+                    continue
+                hits.extend(h for h in offsets
+                            if (low is None or h[1] >= low)
+                            and (high is None or h[1] <= high))
+            path = os.path.join(server_dir, 'logs', name)
+            events = [e for e in self._read_events(path, hits, base)
+                      if (not player or e.get('player') == player)
+                      and (not text or text in e['message'])]
+            results.extend(reversed(events))
+            if limit and len(results) >= limit:
+                break
+        if limit:
+            results = results[:limit]
+        return list(reversed(results))
+
+
+def get_log_index(backup_dir, server_dir):
+    return LogIndex(os.path.join(
+        backup_dir, INDEX_DIR_NAME, '{}.logs'.format(server_key(server_dir))))
+
+
+def _parse_time(value, end_of_day=False):
+    for fmt in QUERY_TIME_FMTS:
+        try:
+            t = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if end_of_day and fmt == DATE_FMT:
+            t += timedelta(days=1, seconds=-1)
+        return t
+    raise ValueError('"{}" is not a date like 2014-10-20 or'
+                     ' 2014-10-20T23:45'.format(value))
+
+
+def parse_log_query(query):
+    """
+    Turns a --log-search query into keyword arguments for LogIndex.search().
+    A query is made of space separated terms:
+
+        player:NAME  type:join,leave  since:2014-10-01  until:2014-10-31
+        limit:N  and anything else, which the message must contain
+
+    @param query:
+    @return:
+    """
+    kwargs = {}
+    text = []
+    for term in query.split():
+        key, _, value = term.partition(':')
+        if key == 'player':
+            kwargs['player'] = value
+        elif key == 'type':
+            kwargs['types'] = value.split(',')
+            for t in kwargs['types']:
+                if t not in EVENT_TYPES:
+                    raise ValueError('Unknown event type "{0}", try one of: {1}'
+                                     .format(t, ', '.join(EVENT_TYPES)))
+        elif key == 'since':
+            kwargs['since'] = _parse_time(value)
+        elif key == 'until':
+            kwargs['until'] = _parse_time(value, end_of_day=True)
+        elif key == 'limit':
+            try:
+                kwargs['limit'] = int(value)
+            except ValueError:
+                raise ValueError('limit must be a number, not "{}"'.format(value))
+        else:
+            text.append(term)
+    if text:
+        kwargs['text'] = ' '.join(text)
+    return kwargs
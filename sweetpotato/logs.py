@@ -0,0 +1,101 @@
+import collections
+import os
+import re
+import time
+
+LOG_POLL_INTERVAL = 0.05
+# How much of a log is read at once, so catching up on a big one doesn't
+# mean holding all of it in memory.
+LOG_READ_BLOCK = 1024 * 1024
+
+
+def get_latest_log(server_dir):
+    return os.path.join(server_dir, 'logs', 'latest.log')
+
+
+class LogFollower:
+    """
+    Follows a log file like 'tail -F' does: only what's been appended since
+    the last read is read, and when the file is rotated (replaced with a
+    new one) or truncated, reading starts over from the top of the new one.
+
+    By default only lines written after the follower was made are seen.
+    """
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self.offset = 0
+        self.inode = None
+        self.partial = b''
+        self.lines = collections.deque()
+        if not from_start:
+            try:
+                st = os.stat(path)
+                self.offset, self.inode = st.st_size, st.st_ino
+            except FileNotFoundError:
+                pass
+
+    def _read(self):
+        # One block's worth of lines, returns False if there was nothing
+        # new to read
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                self.offset, self.inode, self.partial = 0, st.st_ino, b''
+            if st.st_size == self.offset:
+                return False
+            f.seek(self.offset)
+            block = f.read(LOG_READ_BLOCK)
+        self.offset += len(block)
+        lines = (self.partial + block).split(b'\n')
+        # Only the unfinished last line is carried over to the next block
+        self.partial = lines.pop()
+        self.lines.extend(l.decode(errors='replace') for l in lines)
+        return True
+
+    def iter_lines(self):
+        """
+        Yields every complete line written since the last call, reading
+        the log a block at a time. Lines not got to yet when it's stopped
+        are left for the next call.
+
+        @return:
+        """
+        while True:
+            while self.lines:
+                yield self.lines.popleft()
+            if not self._read():
+                return
+
+    def read_lines(self):
+        """
+        Returns every complete line written since the last call.
+
+        @return:
+        """
+        return list(self.iter_lines())
+
+    def wait_for(self, pattern, timeout):
+        """
+        Waits up to 'timeout' seconds for a line matching the regular
+        expression 'pattern', or that 'pattern' returns true for if it's a
+        function, and returns it, or None if none turned up. Lines before
+        it are skipped, lines after it are left for the next call.
+
+        @param pattern:
+        @param timeout:
+        @return:
+        """
+        if not callable(pattern):
+            pattern = re.compile(pattern).search
+        deadline = time.monotonic() + timeout
+        while True:
+            for line in self.iter_lines():
+                if pattern(line):
+                    return line
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(LOG_POLL_INTERVAL)
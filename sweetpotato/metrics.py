@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from .common import INDEX_DIR_NAME
+
+BACKUP_STATS_NAME = 'last_backup.{}.json'
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+# (name, type, help) for each metric, in the order they're written out.
+# Each server's sample is a dict of metric name to value, None if unknown.
+METRICS = (
+    ('up', 'gauge', 'Whether the server is running.'),
+    ('uptime_seconds', 'gauge', 'How long the server has been running.'),
+    ('players_online', 'gauge', 'How many players are online.'),
+    ('backup_duration_seconds', 'gauge', 'How long the last backup took.'),
+    ('backup_size_bytes', 'gauge', 'How big the last backup was.'),
+    ('last_backup_timestamp_seconds', 'gauge', 'When the last backup finished.'),
+    ('last_backup_age_seconds', 'gauge', 'How long ago the last backup finished.'),
+    ('jvm_cpu_percent', 'gauge', 'CPU used by the server, 100 being one core.'),
+    ('jvm_rss_bytes', 'gauge', 'Memory used by the server.'),
+    ('jvm_threads', 'gauge', 'Threads the server is running.'),
+    ('lag_events', 'counter', 'Times the server logged that it can\'t keep up.'),
+    ('lag_milliseconds', 'counter', 'How far behind the server has fallen.'),
+)
+PREFIX = 'sweetpotato_'
+
+
+def _stats_path(backup_dir, server):
+    return os.path.join(backup_dir, INDEX_DIR_NAME,
+                        BACKUP_STATS_NAME.format(server))
+
+
+def record_backup(backup_dir, server, stats):
+    """
+    Saves 'stats' about the backup of 'server' that just finished to
+    'backup_dir', for the metrics of whichever process is serving them.
+    Each server sharing a backup dir has its own.
+
+    @param backup_dir:
+    @param server:
+    @param stats:
+    @return:
+    """
+    path = _stats_path(backup_dir, server)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class BackupStats:
+    """
+    What record_backup() last saved for a server to a backup dir, only read
+    again when it has changed.
+    """
+    def __init__(self, backup_dir, server):
+        self.path = _stats_path(backup_dir, server)
+        self.mtime = None
+        self.stats = None
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+        if mtime != self.mtime:
+            try:
+                with open(self.path) as f:
+                    self.stats = json.load(f)
+            except (OSError, ValueError):
+                return self.stats
+            self.mtime = mtime
+        return self.stats
+
+
+def add_backup_stats(sample, stats):
+    """
+    Adds the backup metrics from 'stats', a BackupStats.get(), to 'sample'.
+
+    @param sample:
+    @param stats:
+    @return:
+    """
+    if stats:
+        sample['backup_duration_seconds'] = stats['duration']
+        sample['backup_size_bytes'] = stats['size']
+        sample['last_backup_timestamp_seconds'] = stats['finished_at']
+        sample['last_backup_age_seconds'] = time.time() - stats['finished_at']
+    return sample
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metrics(samples):
+    """
+    Writes out 'samples', a dict of server name to its metrics, in the
+    OpenMetrics text format.
+
+    @param samples:
+    @return:
+    """
+    lines = []
+    for name, metric_type, help_text in METRICS:
+        family = PREFIX + name
+        lines.append('# TYPE {0} {1}'.format(family, metric_type))
+        lines.append('# HELP {0} {1}'.format(family, help_text))
+        sample_name = family + '_total' if metric_type == 'counter' else family
+        for server, sample in sorted(samples.items()):
+            value = sample.get(name)
+            if value is None:
+                continue
+            lines.append('{0}{{server="{1}"}} {2}'.format(
+                sample_name, _escape(server), float(value)))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(reader, writer, get_samples):
+    """
+    Answers one HTTP request on an asyncio stream: format_metrics() of
+    get_samples() for GET /metrics, a 404 for anything else. get_samples()
+    may be a coroutine function.
+
+    @param reader:
+    @param writer:
+    @param get_samples:
+    @return:
+    """
+    try:
+        request = (await reader.readline()).decode('latin-1').split()
+        # The headers don't matter, but have to be read past
+        while (await reader.readline()).strip():
+            pass
+        if len(request) >= 2 and request[0] == 'GET' \
+                and request[1].split('?')[0] == '/metrics':
+            status, content_type = '200 OK', CONTENT_TYPE
+            samples = get_samples()
+            if asyncio.iscoroutine(samples):
+                samples = await samples
+            body = format_metrics(samples).encode()
+        else:
+            status, content_type = '404 Not Found', 'text/plain'
+            body = b'Try /metrics\n'
+        writer.write('HTTP/1.0 {0}\r\nContent-Type: {1}\r\n'
+                     'Content-Length: {2}\r\n\r\n'.format(
+                         status, content_type, len(body)).encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,175 @@
+import collections
+import math
+import re
+import time
+
+from .common import SERVER_LOG_WAIT
+from .logs import LogFollower, get_latest_log
+from .server import server_command
+
+# How much history is kept and summed up, in seconds.
+PERF_WINDOW = 900
+# How often the daemon runs the tps_command, in seconds.
+PERF_POLL_INTERVAL = 30
+TICKS_PER_SECOND = 20
+# Older Forge: "Overall : Mean tick time: 12.345 ms. Mean TPS: 20.000"
+# newer Forge: "Overall: 20.000 TPS (12.345 ms/tick)"
+FORGE_TPS_RE = re.compile(
+    r'Overall\s*:\s*(?:Mean tick time: (?P<mspt>[\d.]+) ms\. Mean TPS: (?P<tps>[\d.]+)'
+    r'|(?P<new_tps>[\d.]+) TPS \((?P<new_mspt>[\d.]+) ms/tick\))')
+# Spigot and Paper: "TPS from last 1m, 5m, 15m: 20.0, 19.97, 19.99"
+SPIGOT_TPS_RE = re.compile(r'TPS from last 1m, 5m, 15m: \*?(?P<tps>[\d.]+)')
+TPS_REPLY = r'Overall\s*:.*(?:TPS|ms/tick)|TPS from last'
+# Minecraft's formatting codes, which Spigot colours the numbers with
+FORMATTING_RE = re.compile('§.')
+
+
+def parse_tps(output):
+    """
+    Picks the overall TPS, and the MSPT if it's there, out of what the
+    'tps' or 'forge tps' command printed. Returns (tps, mspt) with mspt
+    None for Spigot, or None if there's no TPS in 'output'.
+
+    @param output:
+    @return:
+    """
+    output = FORMATTING_RE.sub('', output)
+    m = FORGE_TPS_RE.search(output)
+    if m:
+        tps = m.group('tps') or m.group('new_tps')
+        mspt = m.group('mspt') or m.group('new_mspt')
+        return float(tps), float(mspt)
+    m = SPIGOT_TPS_RE.search(output)
+    if m:
+        return float(m.group('tps')), None
+    return None
+
+
+def poll_tps(settings):
+    """
+    Runs the configured tps_command and returns parse_tps() of its output,
+    read from the server log when it wasn't sent over RCON.
+
+    @param settings:
+    @return:
+    """
+    follower = LogFollower(get_latest_log(settings.server_dir))
+    output = server_command(settings, settings.tps_command)
+    if output is None:
+        output = follower.wait_for(TPS_REPLY, SERVER_LOG_WAIT)
+    return parse_tps(output) if output else None
+
+
+def percentile(values, p):
+    """
+    Returns the nearest-rank 'p'th percentile of 'values'.
+
+    @param values:
+    @param p:
+    @return:
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def _series(values):
+    if not values:
+        return None
+    return {'last': values[-1],
+            'min': min(values),
+            'max': max(values),
+            'mean': round(sum(values) / len(values), 2),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99)}
+
+
+class PerfMonitor:
+    """
+    A rolling record of how a server has been performing over the last
+    'window' seconds: TPS and MSPT samples from its tps_command, and the
+    lag spikes it has logged "Can't keep up!" warnings for. Times are unix
+    times, so events from the log can be added as well as live ones.
+    """
+    def __init__(self, window=PERF_WINDOW):
+        self.window = window
+        self.samples = collections.deque()
+        self.lag = collections.deque()
+
+    def _prune(self, now):
+        for series in (self.samples, self.lag):
+            while series and series[0][0] < now - self.window:
+                series.popleft()
+
+    def add_sample(self, tps, mspt, t=None):
+        self.samples.append((t or time.time(), tps, mspt))
+        # A daemon that's never asked for a summary() mustn't grow forever
+        self._prune(time.time())
+
+    def add_lag(self, ms, ticks, t=None):
+        self.lag.append((t or time.time(), ms, ticks))
+        self._prune(time.time())
+
+    def lag_ms(self, seconds, now=None):
+        """
+        Returns how many ms the server has fallen behind by in the last
+        'seconds'.
+
+        @param seconds:
+        @param now:
+        @return:
+        """
+        since = (now or time.time()) - seconds
+        return sum(ms for t, ms, _ in self.lag if t >= since)
+
+    def summary(self, now=None):
+        """
+        Sums up the window: min, max, mean and percentiles of the TPS and
+        MSPT samples (None without any), the lag spikes, and the TPS that
+        the ticks they skipped leave over the whole window.
+
+        @param now:
+        @return:
+        """
+        self._prune(now or time.time())
+        ticks = sum(t for _, _, t in self.lag)
+        return {
+            'window': self.window,
+            'tps': _series([tps for _, tps, _ in self.samples]),
+            'mspt': _series([mspt for _, _, mspt in self.samples
+                             if mspt is not None]),
+            'lag': {'spikes': len(self.lag),
+                    'ms': sum(ms for _, ms, _ in self.lag),
+                    'worst_ms': max((ms for _, ms, _ in self.lag), default=0),
+                    'ticks_skipped': ticks},
+            'estimated_tps': round(
+                max(0, TICKS_PER_SECOND - ticks / self.window), 2),
+        }
+
+
+def format_perf(summary):
+    """
+    Returns a summary() as lines of text for --perf.
+
+    @param summary:
+    @return:
+    """
+    lines = []
+    tps, mspt = summary['tps'], summary['mspt']
+    if tps:
+        lines.append('TPS: {last} (min {min}, median {p50}, mean {mean})'.format(**tps))
+    else:
+        lines.append('TPS: ~{} going by skipped ticks'.format(
+            summary['estimated_tps']))
+    if mspt:
+        lines.append('MSPT: {last} (median {p50}, p95 {p95}, p99 {p99},'
+                     ' max {max})'.format(**mspt))
+    lag = summary['lag']
+    minutes = summary['window'] // 60
+    if lag['spikes']:
+        lines.append('Lag: {0} spikes in the last {1} minutes, {2}ms behind in'
+                     ' all, the worst {3}ms'.format(
+                         lag['spikes'], minutes, lag['ms'], lag['worst_ms']))
+    else:
+        lines.append('Lag: none in the last {} minutes'.format(minutes))
+    return lines
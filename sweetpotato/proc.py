@@ -0,0 +1,244 @@
+import contextlib
+import os
+import select
+import time
+
+PROC_DIR = '/proc'
+# How often to look for a process that we can't get a pidfd for.
+POLL_INTERVAL = 0.1
+# How long get_resources() watches a process's CPU time for, in seconds.
+RESOURCE_SAMPLE_WINDOW = 0.5
+
+_boot_time = None
+_snapshot = None
+
+
+def get_boot_time():
+    """
+    Returns when the system booted as a unix timestamp, read once from
+    /proc/stat.
+
+    @return:
+    """
+    global _boot_time
+    if _boot_time is None:
+        with open(os.path.join(PROC_DIR, 'stat'), 'r') as s:
+            for line in s:
+                if line.startswith('btime '):
+                    _boot_time = int(line.split()[1])
+                    break
+            else:
+                _boot_time = 0
+    return _boot_time
+
+
+def _read(pid, name):
+    with open(os.path.join(PROC_DIR, str(pid), name), 'rb') as f:
+        return f.read()
+
+
+def read_process(pid):
+    """
+    Reads what /proc knows about 'pid' straight from its files, returning
+    a dict of pid, comm, cmdline (a list), cwd, exe and start_time (a unix
+    timestamp), or None if the process is gone.
+
+    'cwd' and 'exe' are None when they can't be read, which is the case for
+    other users' processes unless we're root.
+
+    @param pid:
+    @return:
+    """
+    try:
+        comm = _read(pid, 'comm').decode(errors='replace').rstrip('\n')
+        cmdline = [a.decode(errors='replace')
+                   for a in _read(pid, 'cmdline').split(b'\0') if a]
+        stat = _read(pid, 'stat').decode(errors='replace')
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    # The comm in the middle of stat is in parens and may hold spaces, so
+    # count fields from the last ')'. starttime is the 22nd field overall.
+    fields = stat[stat.rfind(')') + 2:].split()
+    start_time = get_boot_time() \
+        + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+    proc = {'pid': int(pid), 'comm': comm, 'cmdline': cmdline,
+            'start_time': start_time}
+    for link in ('cwd', 'exe'):
+        try:
+            proc[link] = os.readlink(os.path.join(PROC_DIR, str(pid), link))
+        except OSError:
+            proc[link] = None
+    return proc
+
+
+def _read_fields(pid, name):
+    # "Key:   value unit" lines, as in status, io and smaps_rollup
+    fields = {}
+    for line in _read(pid, name).decode(errors='replace').splitlines():
+        key, _, value = line.partition(':')
+        value = value.split()
+        if value and value[0].isdigit():
+            fields[key] = int(value[0])
+    return fields
+
+
+class ResourceSampler:
+    """
+    Reads how much of the machine a process is using from its /proc files.
+    Its CPU use is worked out over the time between one sample() and the
+    next, so the first sample() has none.
+    """
+    def __init__(self, pid):
+        self.pid = int(pid)
+        self.cpu_ticks = None
+        self.sampled_at = None
+
+    def _cpu_ticks(self):
+        stat = _read(self.pid, 'stat').decode(errors='replace')
+        # utime and stime, the 14th and 15th fields, see read_process()
+        fields = stat[stat.rfind(')') + 2:].split()
+        return int(fields[11]) + int(fields[12])
+
+    def sample(self):
+        """
+        Returns a dict of the process's cpu_percent (of one core, so up to
+        100 times the number of cores, like top), rss and pss in bytes,
+        threads, open fds, and io_read_bytes and io_write_bytes, the bytes
+        it has read from and written to storage. Whatever can't be read is
+        None, as most of it is for other users' processes. Returns None if
+        the process is gone.
+
+        @return:
+        """
+        try:
+            now, ticks = time.monotonic(), self._cpu_ticks()
+            status = _read_fields(self.pid, 'status')
+        except (FileNotFoundError, ProcessLookupError):
+            return None
+        cpu_percent = None
+        if self.cpu_ticks is not None and now > self.sampled_at:
+            cpu_percent = round(100 * (ticks - self.cpu_ticks)
+                                / os.sysconf('SC_CLK_TCK')
+                                / (now - self.sampled_at), 1)
+        self.cpu_ticks, self.sampled_at = ticks, now
+        rss = status.get('VmRSS')
+        resources = {'cpu_percent': cpu_percent,
+                     'rss': rss * 1024 if rss is not None else None,
+                     'threads': status.get('Threads'),
+                     'pss': None, 'fds': None,
+                     'io_read_bytes': None, 'io_write_bytes': None}
+        try:
+            # Only there since Linux 4.14
+            resources['pss'] = _read_fields(self.pid, 'smaps_rollup')['Pss'] * 1024
+        except (KeyError, OSError):
+            pass
+        try:
+            resources['fds'] = len(os.listdir(
+                os.path.join(PROC_DIR, str(self.pid), 'fd')))
+        except OSError:
+            pass
+        try:
+            io = _read_fields(self.pid, 'io')
+            resources['io_read_bytes'] = io['read_bytes']
+            resources['io_write_bytes'] = io['write_bytes']
+        except (KeyError, OSError):
+            pass
+        return resources
+
+
+def get_resources(pid, window=RESOURCE_SAMPLE_WINDOW):
+    """
+    Returns ResourceSampler.sample() for 'pid', with its CPU use measured
+    over 'window' seconds, or None if it's gone. With no 'window' it
+    returns straight away, without the CPU use.
+
+    @param pid:
+    @param window:
+    @return:
+    """
+    sampler = ResourceSampler(pid)
+    resources = sampler.sample()
+    if resources is None or window is None:
+        return resources
+    time.sleep(window)
+    return sampler.sample()
+
+
+@contextlib.contextmanager
+def procs_snapshot(procs):
+    """
+    While inside this, get_procs() answers from 'procs', a list it
+    returned earlier, instead of reading /proc again. Lets one scan serve
+    every server a fleet action is run on.
+
+    @param procs:
+    @return:
+    """
+    global _snapshot
+    previous, _snapshot = _snapshot, procs
+    try:
+        yield
+    finally:
+        _snapshot = previous
+
+
+def get_procs(comm=None):
+    """
+    Returns read_process() for every process, or just those whose comm
+    contains 'comm' (like 'pgrep <comm>' would find), ordered by pid.
+
+    @param comm:
+    @return:
+    """
+    if _snapshot is not None:
+        return [p for p in _snapshot if comm is None or comm in p['comm']]
+    procs = []
+    for entry in os.listdir(PROC_DIR):
+        if not entry.isdigit():
+            continue
+        if comm is not None:
+            try:
+                if comm not in _read(entry, 'comm').decode(errors='replace'):
+                    continue
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+        proc = read_process(entry)
+        if proc:
+            procs.append(proc)
+    return sorted(procs, key=lambda p: p['pid'])
+
+
+def _poll_for_exit(pid, deadline):
+    while os.path.exists(os.path.join(PROC_DIR, str(pid))):
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def wait_for_exit(pid, timeout=None):
+    """
+    Waits up to 'timeout' seconds (forever if None) for 'pid', which
+    needn't be our child, to exit. Returns True if it did.
+
+    Uses a pidfd where the kernel (5.3+) and Python (3.9+) have them, so
+    we're woken the moment it exits, and polls /proc otherwise.
+
+    @param pid:
+    @param timeout:
+    @return:
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        fd = os.pidfd_open(int(pid))
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        return _poll_for_exit(pid, deadline)
+    try:
+        p = select.poll()
+        p.register(fd, select.POLLIN)
+        return bool(p.poll(None if timeout is None else timeout * 1000))
+    finally:
+        os.close(fd)
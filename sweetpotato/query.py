@@ -0,0 +1,158 @@
+import os
+import socket
+import struct
+import threading
+import time
+
+from .common import QUERY_HOST
+from .error import QueryError
+
+# Packet types from the GameSpy4 protocol the server's Query listener speaks.
+HANDSHAKE = 9
+STAT = 0
+MAGIC = b'\xfe\xfd'
+QUERY_TIMEOUT = 2
+# The server honours a challenge token for 30 seconds. A little less keeps
+# us from sending one that runs out on the way.
+TOKEN_LIFETIME = 25
+# What a full stat reply's key/value section starts with, and what the
+# player list after it starts with.
+STAT_PADDING = b'splitnum\x00\x80\x00'
+PLAYER_PADDING = b'\x01player_\x00\x00'
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def parse_full_stat(data):
+    """
+    Turns the body of a full stat reply into a dict of motd, version,
+    server_mod and plugins (a list), map, players_online, max_players and
+    players (a list).
+
+    @param data:
+    @return:
+    """
+    if not data.startswith(STAT_PADDING) or PLAYER_PADDING not in data:
+        raise QueryError('Not a full stat reply: {!r}'.format(data[:32]))
+    kv, _, players = data[len(STAT_PADDING):].partition(PLAYER_PADDING)
+    # "key\0value\0...key\0value\0", then an empty key ends it
+    fields = kv.decode('utf-8', errors='replace').split('\0')[:-2]
+    values = dict(zip(fields[::2], fields[1::2]))
+    server_mod, _, plugins = values.get('plugins', '').partition(': ')
+    try:
+        return {
+            'motd': values.get('hostname'),
+            'version': values.get('version'),
+            'server_mod': server_mod or None,
+            'plugins': [p for p in plugins.split('; ') if p],
+            'map': values.get('map'),
+            'players_online': int(values['numplayers']),
+            'max_players': int(values['maxplayers']),
+            'players': [p for p in players.decode(
+                'utf-8', errors='replace').split('\0') if p],
+        }
+    except (KeyError, ValueError) as e:
+        raise QueryError('Bad full stat reply: {}'.format(e))
+
+
+class QueryClient:
+    """
+    Asks a server's Query listener how it's doing. The challenge token the
+    handshake gets is kept while it's good, so after the first full_stat()
+    each one is a single round trip.
+    """
+    def __init__(self, host, port, timeout=QUERY_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        # Only the low four bits of each byte are used by the server
+        self.session_id = os.getpid() & 0x0F0F0F0F
+        self.sock = None
+        self.token = None
+        self.token_expires = 0
+        self.lock = threading.Lock()
+
+    def _request(self, ptype, payload):
+        self.sock.sendto(MAGIC + struct.pack('>Bi', ptype, self.session_id)
+                         + payload, (self.host, self.port))
+        while True:
+            data = self.sock.recv(65535)
+            # Ignore anything that isn't the reply to this request
+            if len(data) >= 5 and data[0] == ptype \
+                    and struct.unpack('>i', data[1:5])[0] == self.session_id:
+                return data[5:]
+
+    def _handshake(self):
+        token = self._request(HANDSHAKE, b'').rstrip(b'\0')
+        self.token = int(token)
+        self.token_expires = time.monotonic() + TOKEN_LIFETIME
+
+    def _full_stat(self):
+        if self.token is None or time.monotonic() >= self.token_expires:
+            self._handshake()
+        data = self._request(STAT, struct.pack('>i', self.token) + b'\0' * 4)
+        return parse_full_stat(data)
+
+    def full_stat(self):
+        """
+        Returns parse_full_stat() of the server's reply. A server that has
+        forgotten our token doesn't reply, so if there's no reply we shake
+        hands again and try once more.
+
+        @return:
+        """
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    self.sock.settimeout(self.timeout)
+                for retry in (True, False):
+                    try:
+                        return self._full_stat()
+                    except socket.timeout:
+                        if not retry or self.token is None:
+                            raise
+                        self.token = None
+            except (OSError, ValueError) as e:
+                self.close()
+                raise QueryError('No Query reply from {0}:{1}: {2}'.format(
+                    self.host, self.port, e))
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.token = None
+
+
+def get_query_client(host, port):
+    """
+    Returns the QueryClient for 'host' and 'port', made the first time it's
+    asked for and reused after that.
+
+    @param host:
+    @param port:
+    @return:
+    """
+    key = (host, int(port))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = QueryClient(host, port)
+        return _clients[key]
+
+
+def query_server(settings):
+    """
+    Returns QueryClient.full_stat() for the configured server, or None if
+    it has no query_port or didn't answer.
+
+    @param settings:
+    @return:
+    """
+    if not settings.query_port:
+        return None
+    try:
+        return get_query_client(QUERY_HOST, settings.query_port).full_stat()
+    except QueryError:
+        return None
@@ -0,0 +1,147 @@
+import socket
+import struct
+import threading
+
+from .error import RconError
+
+# Packet types from the Source RCON protocol that Minecraft implements.
+# Responses come back as RESPONSE_VALUE, and anything the server doesn't
+# know is answered with an "Unknown request" sent under the same id.
+AUTH = 3
+AUTH_RESPONSE = 2
+EXEC_COMMAND = 2
+RESPONSE_VALUE = 0
+# Connecting should be quick, a save-all on a big world may not be.
+CONNECT_TIMEOUT = 10
+REPLY_TIMEOUT = 300
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class RconClient:
+    """
+    One persistent, authenticated RCON connection to a server. command()
+    returns the server's reply, however many packets it was split into.
+    """
+    def __init__(self, host, port, password, timeout=REPLY_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.request_id = 0
+        self.lock = threading.Lock()
+
+    def _send(self, ptype, payload):
+        self.request_id += 1
+        body = struct.pack('<ii', self.request_id, ptype) \
+            + payload.encode('utf-8') + b'\0\0'
+        self.sock.sendall(struct.pack('<i', len(body)) + body)
+        return self.request_id
+
+    def _recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            more = self.sock.recv(size - len(data))
+            if not more:
+                raise RconError('RCON connection closed by the server')
+            data += more
+        return data
+
+    def _recv(self):
+        length = struct.unpack('<i', self._recv_exactly(4))[0]
+        body = self._recv_exactly(length)
+        request_id, ptype = struct.unpack('<ii', body[:8])
+        return request_id, ptype, body[8:-2].decode('utf-8', errors='replace')
+
+    def connect(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 timeout=CONNECT_TIMEOUT)
+            request_id = self._send(AUTH, self.password)
+            reply_id, ptype, _ = self._recv()
+            while ptype != AUTH_RESPONSE:
+                # Some servers send an empty RESPONSE_VALUE first
+                reply_id, ptype, _ = self._recv()
+        except OSError as e:
+            self.close()
+            raise RconError('Can\'t connect to RCON on {0}:{1}: {2}'.format(
+                self.host, self.port, e))
+        if reply_id != request_id:
+            self.close()
+            raise RconError('RCON login to {0}:{1} was refused, check'
+                            ' rcon_password'.format(self.host, self.port))
+        self.sock.settimeout(self.timeout)
+        return self
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+    def _commands(self, commands):
+        request_ids = [self._send(EXEC_COMMAND, c) for c in commands]
+        # The reply to this marks the end of the replies to 'commands'
+        end_id = self._send(RESPONSE_VALUE, '')
+        outputs = dict.fromkeys(request_ids, '')
+        while True:
+            reply_id, ptype, payload = self._recv()
+            if reply_id == end_id:
+                return [outputs[i] for i in request_ids]
+            elif reply_id in outputs:
+                outputs[reply_id] += payload
+
+    def commands(self, commands):
+        """
+        Runs each of 'commands' on the server, writing them all out at once
+        rather than waiting for each reply in turn, and returns a list of
+        their outputs. Reconnects once if the server had dropped the
+        connection since it was last used.
+
+        @param commands:
+        @return:
+        """
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+            for retry in (True, False):
+                try:
+                    return self._commands(commands)
+                except (ConnectionError, RconError) as e:
+                    self.close()
+                    if not retry:
+                        raise RconError('RCON commands {0} failed: {1}'.format(
+                            commands, e))
+                except OSError as e:
+                    # e.g. timed out, the commands may well have run
+                    self.close()
+                    raise RconError('RCON commands {0} failed: {1}'.format(
+                        commands, e))
+                self.connect()
+
+    def command(self, command):
+        """
+        Runs 'command' on the server and returns its output.
+
+        @param command:
+        @return:
+        """
+        return self.commands([command])[0]
+
+
+def get_rcon_client(host, port, password):
+    """
+    Returns the RCON connection for 'host' and 'port', made the first time
+    it's asked for and reused after that.
+
+    @param host:
+    @param port:
+    @param password:
+    @return:
+    """
+    key = (host, int(port), password)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = RconClient(host, port, password)
+        return _clients[key]
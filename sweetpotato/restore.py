@@ -0,0 +1,286 @@
+import collections
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import shutil
+import tarfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from .anvil import DELTA_EXT, apply_region_delta, is_region_file, \
+    read_region, write_region
+from .common import emit_msg
+from .error import BackupStoreError
+from .index import DELETED_MEMBER, SHA256_MEMBER
+from .retention import get_backup_chain
+from .screen import is_screen_started
+from .server import is_server_running, send_command, start_server, \
+    stop_server
+from .store import MANIFEST_EXT, get_store_dirs, read_manifest, \
+    restore_manifest
+
+# From linux/fs.h and fcntl.h, for renameat2()
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+# How much of a file is held at once while it's extracted.
+EXTRACT_BLOCK_SIZE = 1024 * 1024
+# What the tree a restore replaced is kept as, next to the server dir.
+PRE_RESTORE_NAME = '{0}.pre-restore-{1}'
+PRE_RESTORE_DATE_FMT = '%Y-%m-%d-%H%M%S'
+
+
+def _exchange_dirs(live, new):
+    """
+    Swaps the 'live' and 'new' directories, atomically when the kernel and
+    libc support renameat2(RENAME_EXCHANGE). Afterwards 'new' holds what
+    used to be live.
+
+    @param live:
+    @param new:
+    @return:
+    """
+    if not os.path.exists(live):
+        os.rename(new, live)
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 and renameat2(AT_FDCWD, os.fsencode(live), AT_FDCWD,
+                               os.fsencode(new), RENAME_EXCHANGE) == 0:
+        return
+    old = new + '.old'
+    os.rename(live, old)
+    os.rename(new, live)
+    os.rename(old, new)
+
+
+def _in_subtree(name, subtree):
+    return name == subtree or name.startswith(subtree + '/')
+
+
+def _stream_file(fileobj, path):
+    # A block at a time, hashing on the way, so a big file is never held
+    # in memory whole
+    sha256 = hashlib.sha256()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        while True:
+            block = fileobj.read(EXTRACT_BLOCK_SIZE)
+            if not block:
+                break
+            sha256.update(block)
+            f.write(block)
+    return sha256.hexdigest()
+
+
+def _apply_region_delta(path, delta_path):
+    with open(delta_path, 'rb') as f:
+        data = f.read()
+    os.remove(delta_path)
+    if os.path.isfile(path):
+        chunks = read_region(path)
+    else:
+        chunks = {}
+    write_region(path, apply_region_delta(chunks, data))
+
+
+def extract_tar(backup, target_parent, subtree, jobs):
+    """
+    Extracts what's under 'subtree' in the tarball 'backup' into
+    'target_parent'. Files are streamed out as they're decompressed, a
+    block at a time, and hashed on the way.
+
+    Region deltas are applied on top of whatever region file is already
+    in 'target_parent' by up to 'jobs' threads, while decompression goes
+    on, and files listed as deleted are removed from it.
+
+    Every file written, and every region delta applied, is checked against
+    the hashes stored in the backup, a BackupStoreError is raised if
+    anything is missing or doesn't match. Returns the name of the
+    directory the backup was made of.
+
+    @param backup:
+    @param target_parent:
+    @param subtree:
+    @param jobs:
+    @return:
+    """
+    root = None
+    written = {}
+    expected = None
+    deleted = []
+    dirs = []
+    pending = collections.deque()
+
+    def _collect():
+        pending.popleft().result()
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool, \
+            tarfile.open(backup, 'r|*') as tar:
+        for member in tar:
+            name = member.name
+            if name == SHA256_MEMBER:
+                expected = {}
+                for line in tar.extractfile(member).read().decode().splitlines():
+                    digest, path = line.split('  ', 1)
+                    if _in_subtree(path, subtree):
+                        expected[path] = digest
+                continue
+            elif name == DELETED_MEMBER:
+                deleted = tar.extractfile(member).read().decode().splitlines()
+                continue
+            if os.path.isabs(name) or '..' in name.split('/'):
+                continue
+            if root is None and member.isdir():
+                root = name
+            if not _in_subtree(name, subtree):
+                continue
+            dest = os.path.join(target_parent, name)
+            if member.isdir():
+                os.makedirs(dest, exist_ok=True)
+                dirs.append((dest, member))
+            elif member.isreg():
+                written[name] = _stream_file(tar.extractfile(member), dest)
+                if name.endswith(DELTA_EXT) \
+                        and is_region_file(name[:-len(DELTA_EXT)]):
+                    # Checked as it was written out, applied from there
+                    pending.append(pool.submit(
+                        _apply_region_delta, dest[:-len(DELTA_EXT)], dest))
+                    while len(pending) > jobs:
+                        _collect()
+                else:
+                    os.chmod(dest, member.mode)
+                    os.utime(dest, (member.mtime, member.mtime))
+            elif member.issym():
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                os.symlink(member.linkname, dest)
+            elif member.islnk():
+                # The file being linked to has to be written out first
+                while pending:
+                    _collect()
+                os.link(os.path.join(target_parent, member.linkname), dest)
+        while pending:
+            _collect()
+
+    for name in deleted:
+        path = os.path.join(target_parent, name)
+        if _in_subtree(name, subtree) and os.path.isfile(path):
+            os.remove(path)
+    # Directory mtimes last, extracting files into them bumps them
+    for dest, member in reversed(dirs):
+        os.chmod(dest, member.mode)
+        os.utime(dest, (member.mtime, member.mtime))
+
+    if expected is None:
+        emit_msg('"{}" has no checksums, it was not verified'.format(backup))
+    else:
+        missing = set(expected) - set(written)
+        bad = [n for n in written if expected.get(n) != written[n]]
+        if missing or bad:
+            raise BackupStoreError(
+                '"{0}" failed verification: {1} of {2} files missing, {3}'
+                ' corrupt'.format(backup, len(missing), len(expected), len(bad)))
+    return root
+
+
+def _find_backup(backup_dir, backup):
+    if os.path.isfile(backup):
+        return os.path.abspath(backup)
+    for d in (backup_dir, get_store_dirs(backup_dir)[1]):
+        path = os.path.join(d, backup)
+        if os.path.isfile(path):
+            return path
+    raise BackupStoreError('Can\'t find a backup named "{}"'.format(backup))
+
+
+def restore_backup(settings, backup, world_only=False, playerdata_only=False,
+                   quiet=False):
+    """
+    Restores 'backup' (a tarball, differential or region backup, or dedup
+    manifest) over the configured server, or just its world or playerdata.
+
+    Everything is extracted and verified in a temporary directory next to
+    the server first, so the server only has to be stopped for the moment
+    it takes to swap that directory in. It's started back up afterwards if
+    it was running.
+
+    What was swapped out is kept next to the server dir, as
+    <server dir>.pre-restore-<date>, since it holds whatever the backup
+    didn't: excluded files and anything made since. Returns its path, or
+    None if there was nothing there to replace.
+
+    @param settings:
+    @param backup:
+    @param world_only:
+    @param playerdata_only:
+    @param quiet:
+    @return:
+    """
+    server_dir = settings.server_dir.rstrip('/')
+    parent_dir, server_dir_name = os.path.split(server_dir)
+    if playerdata_only:
+        subtree = os.path.join(server_dir_name, settings.world_name,
+                               'playerdata')
+    elif world_only:
+        subtree = os.path.join(server_dir_name, settings.world_name)
+    else:
+        subtree = server_dir_name
+
+    path = _find_backup(settings.backup_dir, backup)
+    tmp_parent = os.path.join(parent_dir, '.{}.restoring'.format(server_dir_name))
+    shutil.rmtree(tmp_parent, ignore_errors=True)
+    os.makedirs(tmp_parent)
+    try:
+        if path.endswith(MANIFEST_EXT):
+            roots = [read_manifest(path)['root']]
+            restore_manifest(path, tmp_parent, quiet=quiet, subtree=subtree,
+                             jobs=max(settings.jobs, 1))
+        else:
+            roots = []
+            for b in get_backup_chain(path):
+                emit_msg('Extracting "{}" ...'.format(b), quiet=quiet)
+                roots.append(extract_tar(b, tmp_parent, subtree,
+                                         max(settings.jobs, 1)))
+        for root in roots:
+            if not root or not _in_subtree(subtree, root.rstrip('/')):
+                # e.g. a world only backup can't be restored over the
+                # whole server without wiping everything else out.
+                raise BackupStoreError(
+                    '"{0}" holds "{1}", which doesn\'t cover "{2}"'.format(
+                        path, root, subtree))
+        new = os.path.join(tmp_parent, subtree)
+        if not os.path.isdir(new):
+            raise BackupStoreError(
+                '"{0}" has nothing for "{1}"'.format(path, subtree))
+
+        running = is_server_running(server_dir)
+        if running:
+            stop_server(settings.screen_name, server_dir, settings.world_name,
+                        quiet, settings.stop_timeout)
+        _exchange_dirs(os.path.join(parent_dir, subtree), new)
+    except BaseException:
+        shutil.rmtree(tmp_parent, ignore_errors=True)
+        raise
+    emit_msg('Restored "{0}" from "{1}"'.format(subtree, path), quiet=quiet)
+
+    kept = None
+    if os.path.lexists(new):
+        kept = os.path.join(parent_dir, PRE_RESTORE_NAME.format(
+            server_dir_name, time.strftime(PRE_RESTORE_DATE_FMT)))
+        rel = subtree[len(server_dir_name):].lstrip('/')
+        old = os.path.join(kept, rel) if rel else kept
+        os.makedirs(os.path.dirname(old), exist_ok=True)
+        os.rename(new, old)
+        emit_msg('What it replaced is in "{}"'.format(kept), quiet=quiet)
+    # Only the empty directories the old tree sat in are left
+    for dirpath, _, _ in os.walk(tmp_parent, topdown=False):
+        os.rmdir(dirpath)
+
+    if running:
+        screen = is_screen_started(settings.screen_name)
+        if screen and subtree == server_dir_name:
+            # The screen's shell is still sitting in the old, deleted dir.
+            send_command(' cd ' + server_dir, screen)
+        start_server(settings, quiet)
+    return kept
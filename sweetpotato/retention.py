@@ -0,0 +1,196 @@
+import os
+import re
+
+from datetime import datetime
+from .common import GFS_SETTINGS, emit_msg
+from .error import BackupStoreError
+from .schedule import backup_lock
+from .store import gc_store, get_store_dirs
+
+# Everything run_server_backup() can make, in one pattern so that a whole
+# backup_dir can be sorted out from a single directory listing.
+BACKUP_RE = re.compile(
+    r'^(?P<date>\d{4}-\d{2}-\d{2}-\d{6})_(?P<name>.+?)'
+    r'(?P<kind>_diff|_region_base|_region)?'
+    r'(?P<ext>\.tar\.(?:bz2|gz|xz)|\.manifest)$')
+DATE_FMT = '%Y-%m-%d-%H%M%S'
+
+
+def _scan(directory):
+    backups = []
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return backups
+    for entry in entries:
+        m = BACKUP_RE.match(entry.name)
+        if not m:
+            continue
+        try:
+            when = datetime.strptime(m.group('date'), DATE_FMT)
+        except ValueError:
+            continue
+        kind = (m.group('kind') or '').lstrip('_')
+        if m.group('ext') == '.manifest':
+            family = 'dedup'
+        elif kind.startswith('region'):
+            family = 'region'
+        else:
+            family = 'tar'
+        backups.append({'path': entry.path, 'time': when, 'kind': kind,
+                        'series': (m.group('name'), family)})
+    return backups
+
+
+def find_backups(backup_dir):
+    """
+    Lists every backup in 'backup_dir' and its dedup store, with the time
+    each was made parsed from its name rather than stat()'d.
+
+    @param backup_dir:
+    @return:
+    """
+    return _scan(backup_dir) + _scan(get_store_dirs(backup_dir)[1])
+
+
+def _period_key(setting, when):
+    if setting == 'keep_hourly':
+        return when.strftime('%Y-%m-%d-%H')
+    elif setting == 'keep_daily':
+        return when.strftime('%Y-%m-%d')
+    elif setting == 'keep_weekly':
+        return when.isocalendar()[:2]
+    elif setting == 'keep_monthly':
+        return when.strftime('%Y-%m')
+
+
+def _is_chain_start(backup):
+    # Differential tarballs chain back to the last full one, region
+    # backups back to the last region base.
+    return backup['kind'] in ('', 'region_base')
+
+
+def _needed(chain):
+    # Each differential tarball holds everything since the full one, so
+    # needs nothing in between. Region backups need every one before them.
+    if chain[-1]['kind'] == 'diff':
+        return chain[:1] + chain[-1:]
+    return chain
+
+
+def select_backups(backups, policy):
+    """
+    Picks which of 'backups' to keep for a grandfather-father-son 'policy',
+    a dict of keep_hourly/keep_daily/keep_weekly/keep_monthly counts. The
+    newest backup in each of the last N hours, days, weeks and months is
+    kept, as is the newest backup overall.
+
+    Backups that a kept backup needs in order to be restored (the full or
+    base backup it was made on top of, and for a region backup everything
+    in between) are kept too.
+
+    @param backups:
+    @param policy:
+    @return:
+    """
+    series = {}
+    for b in backups:
+        series.setdefault(b['series'], []).append(b)
+
+    keep = set()
+    for members in series.values():
+        members.sort(key=lambda b: b['time'], reverse=True)
+        keep.add(members[0]['path'])
+        for setting in GFS_SETTINGS:
+            count = policy.get(setting) or 0
+            seen = set()
+            for b in members:
+                if len(seen) >= count:
+                    break
+                key = _period_key(setting, b['time'])
+                if key not in seen:
+                    seen.add(key)
+                    keep.add(b['path'])
+
+        if members[0]['series'][1] == 'dedup':
+            continue
+        chain = []
+        for b in reversed(members):
+            if _is_chain_start(b):
+                chain = []
+            chain.append(b)
+            if b['path'] in keep:
+                keep.update(c['path'] for c in _needed(chain))
+    return keep
+
+
+def prune_backups(backup_dir, policy, dry_run=False, quiet=False):
+    """
+    Deletes every backup in 'backup_dir' that select_backups() doesn't
+    keep, then any dedup chunks that no longer belong to a backup. Unless
+    it's a dry run that's done holding backup_lock() on the whole dir, a
+    backup being made has chunks no manifest refers to yet.
+
+    Returns the list of backups that were (or with 'dry_run', would be)
+    deleted.
+
+    @param backup_dir:
+    @param policy:
+    @param dry_run:
+    @param quiet:
+    @return:
+    """
+    if dry_run:
+        return _prune_backups(backup_dir, policy, dry_run, quiet)
+    with backup_lock(backup_dir):
+        return _prune_backups(backup_dir, policy, dry_run, quiet)
+
+
+def _prune_backups(backup_dir, policy, dry_run, quiet):
+    backups = find_backups(backup_dir)
+    keep = select_backups(backups, policy)
+    pruned = sorted(b['path'] for b in backups if b['path'] not in keep)
+    for path in pruned:
+        if dry_run:
+            emit_msg('Would delete: ' + path, quiet=quiet)
+        else:
+            emit_msg('Deleting: ' + path, quiet=quiet)
+            os.remove(path)
+    if not dry_run and any(p.endswith('.manifest') for p in pruned):
+        emit_msg('Removed {} unused chunks'.format(gc_store(backup_dir)),
+                 quiet=quiet)
+    emit_msg('Kept {0} backups, {1} {2}'.format(
+        len(keep), 'would prune' if dry_run else 'pruned', len(pruned)),
+        quiet=quiet)
+    return pruned
+
+
+def get_backup_chain(backup_path):
+    """
+    Returns every backup needed to restore 'backup_path' in the order they
+    were made: the full or base backup it was made on top of, then for a
+    region backup each one after that, up to and including 'backup_path'
+    itself.
+
+    @param backup_path:
+    @return:
+    """
+    backup_path = os.path.abspath(backup_path)
+    backups = _scan(os.path.dirname(backup_path))
+    target = [b for b in backups if b['path'] == backup_path]
+    if not target:
+        raise BackupStoreError('"{}" is not a backup'.format(backup_path))
+    target = target[0]
+    if target['series'][1] == 'dedup':
+        return [backup_path]
+    chain = []
+    for b in sorted(backups, key=lambda b: b['time']):
+        if b['series'] != target['series'] or b['time'] > target['time']:
+            continue
+        if _is_chain_start(b):
+            chain = []
+        chain.append(b)
+    if not chain or not _is_chain_start(chain[0]):
+        raise BackupStoreError(
+            'No full or base backup found for "{}"'.format(backup_path))
+    return [b['path'] for b in _needed(chain)]
@@ -0,0 +1,191 @@
+import contextlib
+import fcntl
+import os
+import threading
+
+from datetime import timedelta
+from .common import INDEX_DIR_NAME
+from .error import BackupInProgressError
+
+BACKUP_LOCK_NAME = 'backup.lock'
+# Backups run at this niceness so the server's threads come first.
+BACKUP_NICENESS = 10
+# How often a deferred backup checks again whether it can run.
+DEFER_RETRY = 60
+# How far back lag counts against running a backup, in seconds.
+LAG_WINDOW = 300
+SERVER_LOCK_NAME = 'backup.{}.lock'
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+# (name, lowest, highest) for each of the five fields. Sunday is 0 or 7.
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31),
+               ('month', 1, 12), ('weekday', 0, 7))
+
+
+def _parse_field(field, name, low, high):
+    values = set()
+    for part in field.split(','):
+        span, _, step = part.partition('/')
+        try:
+            step = int(step) if step else 1
+            if span == '*':
+                first, last = low, high
+            elif '-' in span:
+                first, last = (int(v) for v in span.split('-', 1))
+            else:
+                first = int(span)
+                # "5/15" means every 15 from 5 on
+                last = high if step != 1 else first
+        except ValueError:
+            raise ValueError('Bad {0} "{1}" in schedule'.format(name, part))
+        if step < 1 or not low <= first <= last <= high:
+            raise ValueError('The {0} "{1}" is out of range, it must be'
+                             ' within {2}-{3}'.format(name, part, low, high))
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class CronSchedule:
+    """
+    A cron(5) style schedule: "minute hour day month weekday", each field
+    being *, a number, a range like 1-5, a list of those, and any of them
+    with a /step. @hourly, @daily, @weekly and @monthly work too. As with
+    cron, when both day and weekday are given either one matching will do.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError('"{}" is not a schedule like "30 4 * * *"'.format(
+                expression))
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _parse_field(f, *spec) for f, spec in zip(fields, CRON_FIELDS))
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        # As in cron, '*/2' is still a star: the day and weekday must both match
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+
+    def _day_matches(self, t):
+        day = t.day in self.days
+        weekday = t.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def matches(self, t):
+        return t.minute in self.minutes and t.hour in self.hours \
+            and t.month in self.months and self._day_matches(t)
+
+    def next_after(self, t):
+        """
+        Returns the first minute after the datetime 't' the schedule is due
+        at, skipping whole months, days and hours that can't match.
+
+        @param t:
+        @return:
+        """
+        t = t.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Long enough for "0 0 29 2 *" to come around
+        give_up = t + timedelta(days=366 * 8)
+        while t < give_up:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)) \
+                    .replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError('The schedule "{}" never comes around'.format(
+            self.expression))
+
+
+def get_deferral_reason(settings, players, lag_ms):
+    """
+    Says why a backup shouldn't run right now, or returns None if it can:
+    'players' are online and the server has fallen 'lag_ms' behind in the
+    last LAG_WINDOW seconds, against the backup_max_players and
+    backup_max_lag settings.
+
+    @param settings:
+    @param players:
+    @param lag_ms:
+    @return:
+    """
+    if settings.backup_max_players is not None \
+            and players > settings.backup_max_players:
+        return '{} players online'.format(players)
+    if settings.backup_max_lag is not None and lag_ms > settings.backup_max_lag:
+        return 'the server fell {0}ms behind in the last {1} minutes'.format(
+            lag_ms, LAG_WINDOW // 60)
+    return None
+
+
+def _flock(path, operation):
+    lock = open(path, 'w')
+    try:
+        fcntl.flock(lock, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+@contextlib.contextmanager
+def backup_lock(backup_dir, server=None):
+    """
+    Holds the locks that keep backups to 'backup_dir' out of each other's
+    way, raising BackupInProgressError if one it needs is taken. A backup
+    of 'server' shares the lock on the whole dir with the backups of other
+    servers and takes one of its own, so servers that share a backup_dir
+    can back up at the same time but each only once at a time. Without a
+    'server', as for pruning, the whole dir is locked for itself. They're
+    released when the process holding them exits, however that happens.
+
+    @param backup_dir:
+    @param server:
+    @return:
+    """
+    lock_dir = os.path.join(backup_dir, INDEX_DIR_NAME)
+    os.makedirs(lock_dir, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        dir_lock = _flock(os.path.join(lock_dir, BACKUP_LOCK_NAME),
+                          fcntl.LOCK_SH if server else fcntl.LOCK_EX)
+        if dir_lock is None:
+            raise BackupInProgressError(
+                'Another backup to "{}" is still running'.format(backup_dir))
+        stack.enter_context(dir_lock)
+        if server:
+            server_lock = _flock(os.path.join(
+                lock_dir, SERVER_LOCK_NAME.format(server)), fcntl.LOCK_EX)
+            if server_lock is None:
+                raise BackupInProgressError(
+                    'Another backup of "{0}" to "{1}" is still running'.format(
+                        server, backup_dir))
+            stack.enter_context(server_lock)
+        yield
+
+
+def run_nice(function, *args, **kwargs):
+    """
+    Calls 'function' at BACKUP_NICENESS. On Linux niceness is per thread
+    and threads inherit it, so this is meant to be run in a thread of its
+    own, which it leaves that way.
+
+    @param function:
+    @return:
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                       BACKUP_NICENESS)
+    except (AttributeError, OSError):
+        pass
+    return function(*args, **kwargs)
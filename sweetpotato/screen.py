@@ -1,15 +1,58 @@
 import os
+import pwd
 import subprocess
 
+# Where screen keeps its sockets when SCREENDIR isn't set, depending on how
+# it was built. The first one that exists for our user wins.
+SCREEN_DIRS = ('/run/screen', '/var/run/screen', '/tmp/screens', '/tmp/uscreens')
 
-def is_screen_started(screen_name):
+_screen_dir = None
+_sessions = {}
+
+
+def get_screen_dir():
     """
-    Checks the given screen name for a running session,
-    returning the PID and name in a 'PID.NAME' formatted string.
+    Returns the directory screen keeps our user's session sockets in, or
+    None if there isn't one (yet). Once found it's remembered.
 
-    @param screen_name:
     @return:
     """
+    global _screen_dir
+    if _screen_dir is None:
+        if os.getenv('SCREENDIR'):
+            candidates = [os.getenv('SCREENDIR')]
+        else:
+            user = pwd.getpwuid(os.getuid()).pw_name
+            candidates = [os.path.join(d, 'S-' + user) for d in SCREEN_DIRS]
+        for path in candidates:
+            if os.path.isdir(path):
+                _screen_dir = path
+                break
+    return _screen_dir
+
+
+def _is_alive(session):
+    return os.path.exists('/proc/{}'.format(session.split('.', 1)[0]))
+
+
+def _find_session(screen_dir, screen_name):
+    """
+    Looks for 'screen_name' among the sockets in 'screen_dir'. Sockets are
+    named 'PID.NAME', and 'screen_name' may be either the NAME or the whole
+    thing. With more than one live session of that name we can't know which
+    is right, so the oldest (lowest PID) one is used.
+    """
+    matches = []
+    for entry in os.listdir(screen_dir):
+        pid, _, name = entry.partition('.')
+        if not pid.isdigit() or screen_name not in (name, entry):
+            continue
+        if _is_alive(entry):
+            matches.append((int(pid), entry))
+    return min(matches)[1] if matches else False
+
+
+def _screen_ls(screen_name):
     with open(os.devnull, "w") as FNULL:
         proc = subprocess.Popen(
             ['screen', '-ls', '{0}'.format(screen_name)], stdout=subprocess.PIPE, stderr=FNULL)
@@ -35,6 +78,32 @@ def is_screen_started(screen_name):
                     return l
 
 
+def is_screen_started(screen_name):
+    """
+    Checks the given screen name for a running session,
+    returning the PID and name in a 'PID.NAME' formatted string.
+
+    Sessions are found by listing screen's socket dir rather than running
+    'screen -ls', and remembered for as long as their socket is there. Only
+    if there's no socket dir to look in is 'screen -ls' used.
+
+    @param screen_name:
+    @return:
+    """
+    screen_dir = get_screen_dir()
+    if screen_dir is None:
+        return _screen_ls(screen_name)
+    session = _sessions.get(screen_name)
+    if session and os.path.exists(os.path.join(screen_dir, session)):
+        return session
+    session = _find_session(screen_dir, screen_name)
+    if session:
+        _sessions[screen_name] = session
+    else:
+        _sessions.pop(screen_name, None)
+    return session
+
+
 def start_screen(screen_name, server_dir):
     """
     Starts a screen session named 'screen_name' with a cwd of 'server_dir.
@@ -1,17 +1,31 @@
+import logging
 import os
+import signal
+import socket
 import time
 import urllib.error
 import urllib.request
 
 from datetime import datetime
-from .common import FORGE_DL_URL, FORGE_JAR_NAME, SERVER_WAIT_TIME, \
-    VANILLA_DL_URL, VANILLA_JAR_NAME, emit_msg
-from .error import NoJarFoundError, ServerAlreadyRunningError, \
-    ServerNotRunningError, UnsupportedVersionError
+from .common import DEFAULT_START_TIMEOUT, DEFAULT_STOP_TIMEOUT, \
+    FORGE_DL_URL, FORGE_JAR_NAME, RCON_HOST, SERVER_HOST, SERVER_LOG_WAIT, \
+    SERVER_TERM_WAIT, VANILLA_DL_URL, VANILLA_JAR_NAME, emit_msg
+from .error import NoJarFoundError, RconError, ServerAlreadyRunningError, \
+    ServerNotReadyError, ServerNotRunningError, UnsupportedVersionError
+from .events import parse_line, split_player_names
 from .java import get_jar, get_java_procs
+from .logs import LogFollower, get_latest_log
+from .proc import wait_for_exit
+from .query import query_server
+from .rcon import get_rcon_client
 from .screen import is_screen_started, start_screen
 from .system import create_dir, error_and_die, is_forced
 
+# How often a server that's starting is checked on, and how long a TCP
+# probe of its port may take, in seconds.
+READY_POLL_INTERVAL = 1
+READY_PROBE_TIMEOUT = 1
+
 
 def _agree_to_eula(eula_txt, force, quiet):
     """
@@ -125,35 +139,22 @@ def _format_launch_cmd(settings):
 
 def get_uptime_raw(server_dir, world_name, quiet):
     """
-    If the configured server is running, read the server.properties file
-    to get the start time, and return an uptime in hours based on that.
-
-    The time will be slightly inaccurate because the server writes the new
-    date string to your server.properties file towards the end of the
-    startup sequence.
+    If the configured server is running, return how long it has been up for
+    as a datetime.timedelta, going by when its JVM was started according to
+    /proc. That's a little earlier than the server finishing its startup,
+    which on a modded server can take a minute or more.
 
-    On vanilla servers this duration should be slight, but on modded servers
-    the difference might be closer to a minute because the startup is longer.
-
-    If the server is not running, return False.
+    If the server is not running, raise ServerNotRunningError.
 
     @param server_dir:
     @param world_name:
     @param quiet:
     @return:
     """
-    fmt = '%a %b %d %H:%M:%S %Z %Y'
     now = datetime.now()
     server_running = is_server_running(server_dir)
     if server_running:
-        server_properties = os.path.join(server_dir, 'server.properties')
-        with open(server_properties, 'r') as sp:
-            spl = sp.readlines()
-            sp.close()
-        server_start_time_string = spl[1].strip().strip('#')
-        server_start_time = datetime.strptime(server_start_time_string, fmt)
-        uptime = now - server_start_time
-        return uptime
+        return now - datetime.fromtimestamp(server_running['start_time'])
     else:
         raise ServerNotRunningError(
             '{} is not running'.format(world_name))
@@ -214,82 +215,54 @@ def get_uptime_string(uptime):
 
 def is_server_running(server_dir_name):
     """
-    Checks /proc for a java process that has a cwd of 'server_dir_name'.
+    Checks /proc for a java process that has a cwd of 'server_dir_name',
+    comparing fully resolved paths. Returns that process (as described by
+    get_java_procs()) or False.
 
     @param server_dir_name:
     @return:
     """
     if not server_dir_name:
         error_and_die("No server directory name supplied!")
-    java_procs = get_java_procs()
-    server_dir = server_dir_name.rstrip('/')
-    if isinstance(java_procs, tuple):
-        # just one java proc
-        if server_dir in java_procs:
-            proc = {'cwd': java_procs[0],
-                    'exe': java_procs[1],
-                    'pid': java_procs[2]}
+    server_dir = os.path.realpath(server_dir_name)
+    for proc in get_java_procs():
+        if proc['cwd'] and os.path.realpath(proc['cwd']) == server_dir:
             return proc
-        else:
-            return False
-    elif isinstance(java_procs, list):
-        # multiple java procs
-        for p in java_procs:
-            if server_dir in p[0]:
-                proc = {'cwd': p[0],
-                        'exe': p[1],
-                        'pid': p[2]}
-                return proc
     return False
 
 
 def list_players(settings):
     """
     Send a 'list' command to the server and try to read the list of
-    logged-in players.
+    logged-in players from its reply, or from the lines it writes to
+    latest.log. Returns those lines, or None if nobody is on.
 
     @param settings:
     @return:
     """
-    latest_log = os.path.join(
-        settings.server_dir,
-        'logs',
-        'latest.log')
-    running = is_server_running(settings.server_dir)
-    if running:
-        send_command('list', is_screen_started(settings.screen_name))
-
-    def read_latest_log():
-        if running:
-            try:
-                with open(latest_log, 'r') as log:
-                    log_lines = log.readlines()
-                    log.close()
-                    return log_lines
-            except (OSError, IOError):
-                emit_msg('failed to read log oh noes!')  # TODO: set level to error
+    if not is_server_running(settings.server_dir):
         return None
-
-    ll = read_latest_log()
-
-    if ll:
-        try:
-            while 'players online:' not in ll[-2:][0]:
-                ll = read_latest_log()
-            else:
-                player_list = ll[-2:]
-        except TypeError:
-            player_list = None  # oh.
-    else:
-        player_list = ll
-
-    if player_list:
-        if 'There are 0/20 players online' in player_list[0]:
-            return None
-        else:
-            return player_list
-    else:
+    if settings.rcon_password:
+        output = server_command(settings, 'list')
+        if output is not None:
+            # e.g. "There are 1/20 players online:Notch, jeb_", all in one
+            return [output] if list_players_as_list([output]) else None
+
+    follower = LogFollower(get_latest_log(settings.server_dir))
+    send_command('list', is_screen_started(settings.screen_name))
+    header = follower.wait_for(' players online:', SERVER_LOG_WAIT)
+    event = parse_line(header) if header else None
+    if not event or event['type'] != 'list':
+        emit_msg('No reply to "list" in the server log',
+                 level=logging.WARN, quiet=getattr(settings, 'quiet', False))
+        return None
+    if not event['online']:
         return None
+    elif event['players']:
+        # Newer servers put the names on the same line
+        return [header]
+    names = follower.wait_for('', SERVER_LOG_WAIT)
+    return [header, names] if names else None
 
 
 def list_players_as_list(player_list):
@@ -300,20 +273,27 @@ def list_players_as_list(player_list):
     @param player_list:
     @return:
     """
-    if player_list:
-        if 'There are 0/20 players online' in player_list[0]:
-            return None
-        else:
-            return player_list[-2:][1].split(']:')[1].strip().split(',')
-    else:
+    if not player_list:
+        return None
+    event = parse_line(player_list[0])
+    if event['type'] != 'list':
         return None
+    players = event['players']
+    if not players and event['online'] and len(player_list) > 1:
+        # Older servers put the names on the next line
+        players = split_player_names(parse_line(player_list[1])['message'])
+    return players or None
 
 
-def restart_server(settings, quiet):
+def restart_server(settings, quiet, ready_timeout=None):
     """
-    Restarts a configured server.
+    Restarts a configured server. With a 'ready_timeout', waits that many
+    seconds for wait_for_server_ready() before saying it's restarted,
+    rather than returning once the launch command has been typed.
 
     @param settings:
+    @param quiet:
+    @param ready_timeout:
     @return:
     """
     screen_name = settings.screen_name
@@ -331,10 +311,15 @@ def restart_server(settings, quiet):
     if server_running:
         server_pid = server_running.get('pid')
         emit_msg('Restarting "{}" ...'.format(world_name), quiet=quiet)
-        wait_for_server_shutdown(screen_name, server_pid)
+        wait_for_server_shutdown(screen_name, server_pid,
+                                 settings.stop_timeout, quiet)
     else:
         emit_msg('Starting "{}" ...'.format(world_name), quiet=quiet)
+    # Made before the launch so that nothing the new server logs is missed
+    follower = LogFollower(get_latest_log(server_dir))
     send_command(launch_server, is_screen_started(screen_name))
+    if ready_timeout is not None:
+        wait_for_server_ready(settings, follower, ready_timeout)
     emit_msg('"{}" restarted!'.format(world_name), quiet=quiet)
 
 
@@ -342,20 +327,69 @@ def save_all(settings):
     """
     Sends a 'save-all' command to the server.
     """
-    send_command("save-all", is_screen_started(settings.screen_name))
+    server_command(settings, 'save-all')
     return True
 
 
+def server_command(settings, command):
+    """
+    Sends a console command to the configured server, over RCON if an
+    rcon_password is set and through its screen session otherwise.
+
+    Returns what the command printed when it went over RCON, None if it
+    went through screen. If RCON can't be reached, the command is sent
+    through screen instead.
+
+    @param settings:
+    @param command:
+    @return:
+    """
+    return server_commands(settings, [command])[0]
+
+
+def server_commands(settings, commands):
+    """
+    Like server_command(), but sends all of 'commands' in one go and
+    returns a list of their outputs.
+
+    @param settings:
+    @param commands:
+    @return:
+    """
+    if settings.rcon_password:
+        try:
+            return get_rcon_client(RCON_HOST, settings.rcon_port,
+                                   settings.rcon_password).commands(commands)
+        except RconError as e:
+            emit_msg('{}, falling back to screen'.format(e.msg),
+                     level=logging.WARN, quiet=getattr(settings, 'quiet', False))
+    send_commands(commands, is_screen_started(settings.screen_name))
+    return [None] * len(commands)
+
+
 def send_command(command, screen_name):
     """
-    Send a command to the server.
+    Send a command to the server's console by typing it into its screen
+    session. 'screen_name' is the session as is_screen_started() gives it.
 
     @param command:
     @param screen_name:
     @return:
     """
-    cmd_line = 'screen -S {0} -X eval \'stuff "{1}"\015\''.format(
-        is_screen_started(screen_name), command)
+    send_commands([command], screen_name)
+
+
+def send_commands(commands, screen_name):
+    """
+    Types each of 'commands' into the server's screen session, with one
+    call to screen for all of them.
+
+    @param commands:
+    @param screen_name:
+    @return:
+    """
+    cmd_line = 'screen -S {0} -X eval {1}'.format(
+        screen_name, ' '.join('\'stuff "{}"\015\''.format(c) for c in commands))
     os.system(cmd_line)
     # cmd_list = shlex.split(cmd_line)
     # subprocess.call(cmd_list)
@@ -401,23 +435,25 @@ def start_server(settings, quiet):
                 settings.world_name, server_running.get('pid')))
 
 
-def stop_server(screen_name, server_dir, world_name, quiet):
+def stop_server(screen_name, server_dir, world_name, quiet,
+                timeout=DEFAULT_STOP_TIMEOUT):
     """
-    Stops a configured server.
+    Stops a configured server, killing it if it hasn't stopped after
+    'timeout' seconds.
 
     @param screen_name:
     @param server_dir:
     @param world_name:
     @param quiet:
+    @param timeout:
     @return:
     """
-    # TODO: we need a timeout here and an option to kill when that timeout is reached
     server_running = is_server_running(server_dir)
 
     if server_running:
         server_pid = server_running.get('pid')
         emit_msg('Stopping "{}" ...'.format(world_name), quiet=quiet)
-        wait_for_server_shutdown(screen_name, server_pid)
+        wait_for_server_shutdown(screen_name, server_pid, timeout, quiet)
         send_command(' exit', is_screen_started(screen_name))
         emit_msg('"{}" stopped!'.format(world_name), quiet=quiet)
     else:
@@ -425,17 +461,81 @@ def stop_server(screen_name, server_dir, world_name, quiet):
             'Cannot stop "{}" - it is not running!'.format(world_name))
 
 
-def wait_for_server_shutdown(screen_name, server_pid):
+def wait_for_server_shutdown(screen_name, server_pid,
+                             timeout=DEFAULT_STOP_TIMEOUT, quiet=False):
     """
-    In case we've tried to stop before the server has fully started.
+    Sends a single 'stop' and waits for the server to exit. If it's still
+    running after 'timeout' seconds it gets a SIGTERM, then a SIGKILL if
+    that doesn't do it within SERVER_TERM_WAIT seconds either.
 
     @param screen_name:
     @param server_pid:
+    @param timeout:
+    @param quiet:
+    @return:
+    """
+    send_command(' stop', is_screen_started(screen_name))
+    if wait_for_exit(server_pid, timeout):
+        return
+    for sig, wait in ((signal.SIGTERM, SERVER_TERM_WAIT),
+                      (signal.SIGKILL, None)):
+        emit_msg('Server did not stop in time, sending {0} to PID {1}'.format(
+            sig.name, server_pid), level=logging.WARN, quiet=quiet)
+        try:
+            os.kill(int(server_pid), sig)
+        except ProcessLookupError:
+            return
+        if wait_for_exit(server_pid, wait):
+            return
+
+
+def is_port_open(host, port, timeout=READY_PROBE_TIMEOUT):
+    """
+    Returns whether something accepts a TCP connection on 'host' and 'port'.
+
+    @param host:
+    @param port:
+    @param timeout:
+    @return:
+    """
+    try:
+        socket.create_connection((host, int(port)), timeout).close()
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def wait_for_server_ready(settings, follower, timeout=DEFAULT_START_TIMEOUT):
+    """
+    Waits for a server that has just been launched to take connections:
+    for 'follower', a LogFollower of its latest.log made before the launch,
+    to see its "Done (x.xxxs)!" line, or its Query listener to answer,
+    whichever comes first. The server's port is open well before it has
+    finished loading, so that is only gone by when it has neither a log
+    nor a query_port. Returns how many seconds that took, or raises
+    ServerNotReadyError after 'timeout'.
+
+    @param settings:
+    @param follower:
+    @param timeout:
     @return:
     """
-    while os.path.exists("/proc/{}".format(server_pid)):
-        time.sleep(SERVER_WAIT_TIME)
-        send_command(' stop', is_screen_started(screen_name))
+    started = time.monotonic()
+    while True:
+        done = any(parse_line(l)['type'] == 'start'
+                   for l in follower.read_lines())
+        if settings.query_port:
+            done = done or query_server(settings)
+        elif follower.inode is None:
+            # No log has turned up to follow
+            done = is_port_open(SERVER_HOST, settings.port)
+        if done:
+            return time.monotonic() - started
+        if time.monotonic() - started >= timeout:
+            raise ServerNotReadyError(
+                '"{0}" did not come up within {1} seconds'.format(
+                    settings.world_name, timeout))
+        time.sleep(READY_POLL_INTERVAL)
 
 
 def write_server_properties(file, settings, quiet):
@@ -462,11 +562,15 @@ def write_server_properties(file, settings, quiet):
     if os.path.isfile(file):
         f = open(file, 'r')
         f_readlines = f.readlines()
-        # Write a new file if any of the three values we change have changed
+        # Write a new file if any of the values we change have changed
         if not 'level-name={}\n'.format(settings.world_name) in f_readlines \
             or not 'server-port={}\n'.format(settings.port) in f_readlines \
             or not 'level-seed={}\n'.format(settings.level_seed or '') \
-                in f_readlines or settings.force:
+                in f_readlines \
+            or (settings.rcon_password and not 'rcon.password={}\n'.format(
+                settings.rcon_password) in f_readlines) \
+            or (settings.query_port and not 'query.port={}\n'.format(
+                settings.query_port) in f_readlines) or settings.force:
             do_the_write()
         else:
             emit_msg(found_msg, quiet=quiet)
@@ -0,0 +1,103 @@
+import fcntl
+import os
+import shutil
+
+from .common import STAGING_DIR_NAME
+
+# From linux/fs.h, asks the filesystem (btrfs, xfs, ...) to share extents
+# between two files instead of copying the data.
+FICLONE = 0x40049409
+
+
+def _copy_file(src, dst):
+    """
+    Copies 'src' to 'dst', preferring a reflink when the filesystem can do
+    it and falling back to a regular copy when it can't.
+
+    @param src:
+    @param dst:
+    @return:
+    """
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+        return
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+
+
+def get_staging_dir(backup_dir, world_name):
+    # One per world, servers sharing a backup_dir can back up at once
+    return os.path.join(backup_dir, STAGING_DIR_NAME, world_name)
+
+
+def snapshot_tree(parent_dir, backup_root, staging_dir, keep=None):
+    """
+    Makes a point-in-time copy of 'backup_root' (relative to 'parent_dir')
+    in 'staging_dir', which is meant to be done quickly while the server
+    has saving turned off.
+
+    Files that are unchanged (same size and mtime) since the last snapshot
+    are hard linked from it rather than copied, so only files the server
+    has written to since then cost any I/O. Snapshot files are never
+    written to in place, which is what makes sharing them safe.
+
+    'keep' works like it does for store.store_backup().
+
+    Returns the directory holding the new snapshot (to be used like
+    'parent_dir') and a dict of stats.
+
+    @param parent_dir:
+    @param backup_root:
+    @param staging_dir:
+    @param keep:
+    @return:
+    """
+    current = os.path.join(staging_dir, 'snapshot')
+    new = os.path.join(staging_dir, 'snapshot.new')
+    stats = {'copied': 0, 'copied_bytes': 0, 'linked': 0}
+    shutil.rmtree(new, ignore_errors=True)
+    os.makedirs(new)
+
+    top = os.path.join(parent_dir, backup_root)
+    for dirpath, dirnames, filenames in os.walk(top):
+        rel_dir = os.path.relpath(dirpath, parent_dir)
+        os.makedirs(os.path.join(new, rel_dir), exist_ok=True)
+        if keep:
+            dirnames[:] = [d for d in dirnames
+                           if keep(os.path.join(rel_dir, d), True)]
+        for name in filenames + [d for d in dirnames if os.path.islink(
+                os.path.join(dirpath, d))]:
+            rel_path = os.path.join(rel_dir, name)
+            if keep and not keep(rel_path):
+                continue
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(new, rel_path)
+            try:
+                st = os.lstat(src)
+                if os.path.islink(src):
+                    os.symlink(os.readlink(src), dst)
+                    continue
+                prev = os.path.join(current, rel_path)
+                try:
+                    prev_st = os.lstat(prev)
+                    unchanged = prev_st.st_size == st.st_size \
+                        and prev_st.st_mtime_ns == st.st_mtime_ns
+                except FileNotFoundError:
+                    unchanged = False
+                if unchanged:
+                    os.link(prev, dst)
+                    stats['linked'] += 1
+                else:
+                    _copy_file(src, dst)
+                    stats['copied'] += 1
+                    stats['copied_bytes'] += st.st_size
+            except FileNotFoundError:
+                # Deleted by the server while we were walking, e.g. level.dat_new
+                continue
+
+    shutil.rmtree(current, ignore_errors=True)
+    os.rename(new, current)
+    return current, stats
@@ -0,0 +1,234 @@
+import json
+import os
+import tempfile
+import time
+
+from datetime import datetime
+from .common import INDEX_DIR_NAME, RCON_HOST, STATE_DIR, server_key
+from .error import RconError
+from .events import clock_seconds, date_events, get_log_start_date, \
+    parse_line, split_player_names
+from .logs import LogFollower, get_latest_log
+from .perf import PERF_WINDOW, PerfMonitor, poll_tps
+from .rcon import RconClient
+
+# How long a status query waits on RCON before going by the log instead.
+STATUS_RCON_TIMEOUT = 2
+
+
+class RosterTracker:
+    """
+    Keeps track of who's online from a server's log events: joins and
+    leaves, the reply to any 'list' command, and the server starting or
+    stopping.
+    """
+    def __init__(self, players=(), names_next=False):
+        self.players = set(players)
+        self.names_next = names_next
+
+    def handle_event(self, event):
+        """
+        Updates the roster with an event from parse_line().
+
+        @param event:
+        @return:
+        """
+        if self.names_next:
+            self.names_next = False
+            self.players = set(split_player_names(event['message']))
+        elif event['type'] == 'join':
+            self.players.add(event['player'])
+        elif event['type'] == 'leave':
+            self.players.discard(event['player'])
+        elif event['type'] in ('start', 'stop'):
+            self.players.clear()
+        elif event['type'] == 'list':
+            self.players = set(event['players'])
+            # Older servers put the names on the next line
+            self.names_next = event['online'] > 0 and not event['players']
+
+    def sorted(self):
+        return sorted(self.players, key=str.lower)
+
+
+class LogRoster:
+    """
+    A RosterTracker that's saved between runs along with where in
+    latest.log it got to, so each update() only reads what the server has
+    logged since the last one. A new latest.log is read from the top. The
+    lag logged over the last PerfMonitor window is kept with it, for perf().
+    """
+    def __init__(self, path, server_dir):
+        self.path = path
+        self.log = get_latest_log(server_dir)
+        self.tracker = RosterTracker()
+        self.inode = None
+        self.offset = 0
+        self.updated = None
+        self.lag = []
+        # The day and clock_seconds() of the last timestamped line read, to
+        # date the lines after it
+        self.day = None
+        self.clock = None
+
+    def load(self):
+        if not self.path:
+            return self
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            # Rebuilt from the log on the next update()
+            return self
+        self.tracker = RosterTracker(state['players'], state['names_next'])
+        self.inode = state['inode']
+        self.offset = state['offset']
+        self.updated = state['updated']
+        self.lag = state.get('lag', [])
+        if state.get('day'):
+            self.day = datetime.strptime(state['day'], '%Y-%m-%d').date()
+            self.clock = state['clock']
+        return self
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'players': sorted(self.tracker.players),
+                           'names_next': self.tracker.names_next,
+                           'inode': self.inode, 'offset': self.offset,
+                           'updated': self.updated, 'lag': self.lag,
+                           'day': self.day and self.day.isoformat(),
+                           'clock': self.clock}, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _events(self, follower):
+        # Every line goes to the roster, only timestamped ones get dated
+        for line in follower.iter_lines():
+            event = parse_line(line)
+            self.tracker.handle_event(event)
+            yield event
+
+    def update(self):
+        """
+        Reads what's new in latest.log into the roster and returns who's
+        online.
+
+        @return:
+        """
+        try:
+            st = os.stat(self.log)
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                # A new log, which the follower reads from the top, and a
+                # new roster to go with it
+                self.tracker = RosterTracker()
+                self.lag = []
+                self.day = self.clock = None
+        except FileNotFoundError:
+            pass
+        follower = LogFollower(self.log, from_start=True)
+        follower.offset, follower.inode = self.offset, self.inode
+        if self.day is None and os.path.isfile(self.log):
+            self.day = get_log_start_date(self.log)
+        if self.day is not None:
+            # A block of the log at a time, however much there is to catch
+            # up on
+            for event in date_events(self._events(follower), self.day,
+                                     self.clock):
+                self.day = event['time'].date()
+                self.clock = clock_seconds(event['clock'])
+                if event['type'] == 'lag':
+                    self.lag.append((event['time'].timestamp(), event['ms'],
+                                     event['ticks']))
+        # A line that's still being written is read again next time
+        self.offset = follower.offset - len(follower.partial)
+        self.inode = follower.inode
+        self.updated = time.time()
+        since = self.updated - PERF_WINDOW
+        self.lag = [lag for lag in self.lag if lag[0] >= since]
+        return self.tracker.sorted()
+
+    def monitor(self):
+        """
+        Returns a PerfMonitor of the lag read by update().
+
+        @return:
+        """
+        monitor = PerfMonitor()
+        for t, ms, ticks in self.lag:
+            monitor.add_lag(ms, ticks, t)
+        return monitor
+
+
+def get_log_roster(settings):
+    """
+    Returns the LogRoster for 'settings', saved in its backup_dir's index
+    dir, or in STATE_DIR if it has no backup_dir.
+
+    @param settings:
+    @return:
+    """
+    state_dir = STATE_DIR
+    if settings.backup_dir:
+        state_dir = os.path.join(settings.backup_dir, INDEX_DIR_NAME)
+    path = os.path.join(state_dir,
+                        '{}.roster'.format(server_key(settings.server_dir)))
+    return LogRoster(path, settings.server_dir).load()
+
+
+def get_players(settings, roster=None):
+    """
+    Returns who's online and where that came from: RCON's 'list' when an
+    rcon_password is set and RCON answers quickly, the server log
+    otherwise. Nothing is typed into the server's console either way.
+    'roster' is a LogRoster that's already been update()d, if there is one.
+
+    @param settings:
+    @param roster:
+    @return:
+    """
+    if settings.rcon_password:
+        client = RconClient(RCON_HOST, settings.rcon_port,
+                            settings.rcon_password, timeout=STATUS_RCON_TIMEOUT)
+        try:
+            event = parse_line(client.connect().command('list'))
+        except RconError:
+            event = None
+        finally:
+            client.close()
+        if event and event['type'] == 'list':
+            return sorted(event['players'], key=str.lower), 'rcon'
+    if roster is not None:
+        return roster.tracker.sorted(), 'log'
+    roster = get_log_roster(settings)
+    players = roster.update()
+    roster.save()
+    return players, 'log'
+
+
+def get_perf(settings, poll=True):
+    """
+    Returns a PerfMonitor summary() of the lag the server has logged over
+    the last PERF_WINDOW, only reading what's new in latest.log since the
+    last time, and with 'poll', of its tps_command run once if there is
+    one.
+
+    @param settings:
+    @param poll:
+    @return:
+    """
+    roster = get_log_roster(settings)
+    roster.update()
+    roster.save()
+    monitor = roster.monitor()
+    if poll and settings.tps_command:
+        sample = poll_tps(settings)
+        if sample:
+            monitor.add_sample(*sample)
+    return monitor.summary()
@@ -0,0 +1,314 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from .common import STORE_CHUNK_SIZE, STORE_DIR_NAME, emit_msg
+from .error import BackupStoreError
+
+# Chunks are prefixed with one byte saying how the rest is stored, region
+# files are already zlib'd by Minecraft so there's no point in doing it twice.
+CHUNK_RAW = b'r'
+CHUNK_ZLIB = b'z'
+MANIFEST_EXT = '.manifest'
+
+
+def get_store_dirs(backup_dir):
+    """
+    Returns the chunks and manifests directories of the store in 'backup_dir'.
+
+    @param backup_dir:
+    @return:
+    """
+    store_dir = os.path.join(backup_dir, STORE_DIR_NAME)
+    return os.path.join(store_dir, 'chunks'), \
+        os.path.join(store_dir, 'manifests')
+
+
+def _chunk_path(chunks_dir, digest):
+    return os.path.join(chunks_dir, digest[:2], digest)
+
+
+def _write_atomic(path, data):
+    # A temp file of its own, two backups may be writing the same chunk
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_chunk(chunks_dir, data):
+    """
+    Stores 'data' under its sha256 unless the store already has it.
+
+    Returns the hex digest and whether or not the chunk was new.
+
+    @param chunks_dir:
+    @param data:
+    @return:
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = _chunk_path(chunks_dir, digest)
+    if os.path.exists(path):
+        return digest, False
+    compressed = zlib.compress(data, 1)
+    if len(compressed) < len(data):
+        blob = CHUNK_ZLIB + compressed
+    else:
+        blob = CHUNK_RAW + data
+    try:
+        _write_atomic(path, blob)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_atomic(path, blob)
+    return digest, True
+
+
+def read_chunk(chunks_dir, digest):
+    """
+    Reads the chunk 'digest' back out of the store and checks its hash.
+
+    @param chunks_dir:
+    @param digest:
+    @return:
+    """
+    try:
+        with open(_chunk_path(chunks_dir, digest), 'rb') as f:
+            blob = f.read()
+    except FileNotFoundError:
+        raise BackupStoreError('Chunk "{}" is missing!'.format(digest))
+    if blob[:1] == CHUNK_ZLIB:
+        data = zlib.decompress(blob[1:])
+    else:
+        data = blob[1:]
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise BackupStoreError('Chunk "{}" is corrupt!'.format(digest))
+    return data
+
+
+def read_manifest(manifest_path):
+    """
+    Loads a backup manifest written by store_backup().
+
+    @param manifest_path:
+    @return:
+    """
+    try:
+        with gzip.open(manifest_path, 'rt') as m:
+            return json.load(m)
+    except (OSError, ValueError) as e:
+        raise BackupStoreError(
+            'Unable to read manifest "{0}": {1}'.format(manifest_path, e))
+
+
+def write_manifest(manifest_path, manifest):
+    """
+    Writes 'manifest' as gzipped json, atomically.
+
+    @param manifest_path:
+    @param manifest:
+    @return:
+    """
+    data = gzip.compress(json.dumps(manifest).encode())
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    _write_atomic(manifest_path, data)
+
+
+def _store_file(chunks_dir, path, stats):
+    chunks = []
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(STORE_CHUNK_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+            digest, new = write_chunk(chunks_dir, data)
+            if new:
+                stats['new_chunks'] += 1
+                stats['new_bytes'] += len(data)
+            stats['bytes'] += len(data)
+            chunks.append(digest)
+    return chunks, sha256.hexdigest()
+
+
+def store_backup(backup_dir, parent_dir, backup_root, manifest_name,
+                 keep=None):
+    """
+    Backs up 'backup_root' (relative to 'parent_dir') into the chunk store
+    found in 'backup_dir'. Each file is split into fixed size chunks that are
+    stored under their sha256, so chunks that are already in the store
+    from a previous backup are not written again.
+
+    The backup itself is recorded as a small manifest listing every file,
+    its sha256 and the chunks it's made of.
+
+    'keep' is an optional callable that's given a path relative to
+    'parent_dir' and whether it's a directory, and returns False if that
+    path should be left out. When a directory is left out it is not
+    descended into.
+
+    Returns the full path to the manifest and some stats about the run.
+
+    @param backup_dir:
+    @param parent_dir:
+    @param backup_root:
+    @param manifest_name:
+    @param keep:
+    @return:
+    """
+    chunks_dir, manifests_dir = get_store_dirs(backup_dir)
+    manifest_path = os.path.join(manifests_dir, manifest_name)
+    stats = {'bytes': 0, 'files': 0, 'new_bytes': 0, 'new_chunks': 0}
+    manifest = {'root': backup_root, 'dirs': [], 'files': [], 'links': []}
+
+    top = os.path.join(parent_dir, backup_root)
+    if not os.path.isdir(top):
+        raise BackupStoreError('Nothing to back up at "{}"'.format(top))
+    for dirpath, dirnames, filenames in os.walk(top):
+        rel_dir = os.path.relpath(dirpath, parent_dir)
+        st = os.lstat(dirpath)
+        manifest['dirs'].append({'path': rel_dir, 'mode': st.st_mode & 0o7777,
+                                 'mtime': st.st_mtime})
+        if keep:
+            dirnames[:] = [d for d in dirnames
+                           if keep(os.path.join(rel_dir, d), True)]
+        dirnames.sort()
+        for name in sorted(filenames) + [d for d in dirnames if os.path.islink(
+                os.path.join(dirpath, d))]:
+            rel_path = os.path.join(rel_dir, name)
+            if keep and not keep(rel_path):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    manifest['links'].append({'path': rel_path,
+                                              'target': os.readlink(path)})
+                    continue
+                chunks, sha256 = _store_file(chunks_dir, path, stats)
+            except FileNotFoundError:
+                # Deleted by the server while we were walking, e.g. level.dat_new
+                continue
+            stats['files'] += 1
+            manifest['files'].append({'path': rel_path, 'size': st.st_size,
+                                      'mode': st.st_mode & 0o7777,
+                                      'mtime': st.st_mtime, 'chunks': chunks,
+                                      'sha256': sha256})
+
+    write_manifest(manifest_path, manifest)
+    return manifest_path, stats
+
+
+def _in_subtree(path, subtree):
+    return subtree is None or path == subtree \
+        or path.startswith(subtree + os.path.sep)
+
+
+def _restore_file(chunks_dir, target_parent, f):
+    path = os.path.join(target_parent, f['path'])
+    tmp_path = path + '.tmp'
+    sha256 = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as out:
+            for digest in f['chunks']:
+                data = read_chunk(chunks_dir, digest)
+                sha256.update(data)
+                out.write(data)
+        # Manifests from before files were hashed only have their chunks'
+        if sha256.hexdigest() != f.get('sha256', sha256.hexdigest()):
+            raise BackupStoreError('"{}" is corrupt!'.format(f['path']))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.chmod(tmp_path, f['mode'])
+    os.utime(tmp_path, (f['mtime'], f['mtime']))
+    os.replace(tmp_path, path)
+
+
+def restore_manifest(manifest_path, target_parent, quiet=False, subtree=None,
+                     jobs=1):
+    """
+    Rebuilds the files recorded in 'manifest_path' under 'target_parent',
+    or just those under 'subtree', reading every chunk back out of the
+    store it came from. Up to 'jobs' files are rebuilt at once.
+
+    Each chunk is checked against its digest and each file against the
+    sha256 in the manifest, a BackupStoreError is raised if anything is
+    missing or doesn't match. Returns the number of files restored.
+
+    @param manifest_path:
+    @param target_parent:
+    @param quiet:
+    @param subtree:
+    @param jobs:
+    @return:
+    """
+    manifest = read_manifest(manifest_path)
+    chunks_dir = os.path.join(
+        os.path.dirname(os.path.dirname(manifest_path)), 'chunks')
+    dirs = [d for d in manifest['dirs'] if _in_subtree(d['path'], subtree)]
+    files = [f for f in manifest['files'] if _in_subtree(f['path'], subtree)]
+
+    for d in dirs:
+        os.makedirs(os.path.join(target_parent, d['path']), exist_ok=True)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(_restore_file, chunks_dir, target_parent, f)
+                       for f in files]:
+            try:
+                future.result()
+            except BackupStoreError:
+                failed += 1
+    if failed:
+        raise BackupStoreError(
+            '"{0}" failed verification: {1} of {2} files missing chunks or'
+            ' corrupt'.format(manifest_path, failed, len(files)))
+    for link in manifest['links']:
+        if not _in_subtree(link['path'], subtree):
+            continue
+        path = os.path.join(target_parent, link['path'])
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(link['target'], path)
+    # Directory mtimes last, restoring files into them bumps them
+    for d in reversed(dirs):
+        path = os.path.join(target_parent, d['path'])
+        os.chmod(path, d['mode'])
+        os.utime(path, (d['mtime'], d['mtime']))
+    emit_msg('Restored {0} files from "{1}"'.format(
+        len(files), manifest_path), quiet=quiet)
+    return len(files)
+
+
+def gc_store(backup_dir):
+    """
+    Deletes chunks that no manifest in the store refers to anymore.
+
+    Returns the number of chunks deleted.
+
+    @param backup_dir:
+    @return:
+    """
+    chunks_dir, manifests_dir = get_store_dirs(backup_dir)
+    referenced = set()
+    for entry in os.scandir(manifests_dir):
+        if entry.name.endswith(MANIFEST_EXT):
+            for f in read_manifest(entry.path)['files']:
+                referenced.update(f['chunks'])
+    removed = 0
+    for fanout in os.scandir(chunks_dir):
+        if not fanout.is_dir():
+            continue
+        for entry in os.scandir(fanout.path):
+            if entry.name not in referenced:
+                os.remove(entry.path)
+                removed += 1
+    return removed
@@ -3,16 +3,63 @@
 # TODO: run when already running
 # TODO: stop when already stopped
 # TODO: webui when already webui-ing
-# import json
+import asyncio
+import gzip
+import json
 import os
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+import tarfile
 import unittest
-# import urllib.request
+import unittest.mock
+import urllib.request
 
+from datetime import datetime, timedelta
+from sweetpotato.anvil import apply_region_delta, get_region_state, \
+    make_region_delta, read_region, write_region
 from sweetpotato.cli import setup_args
 from sweetpotato.common import MCVERSION
-from sweetpotato.core import SweetpotatoConfig
-from sweetpotato.error import MissingExeError
+from sweetpotato.compress import ParallelCompressor, open_parallel_tar
+from sweetpotato.console import SAVE_ALL_ACK, SAVE_OFF_ACK, SAVE_ON_ACK, \
+    CommandPipeline
+from sweetpotato.core import SweetpotatoConfig, read_conf_file, \
+    run_server_backup
+from sweetpotato.daemon import Daemon, FleetMetrics, daemon_action
+from sweetpotato.error import BackupInProgressError, BackupStoreError, \
+    CommandTimeoutError, ConfFileError, DaemonError, MissingExeError, \
+    QueryError, RconError, ServerNotReadyError
+from sweetpotato.events import iter_server_events, parse_line
+from sweetpotato.exclude import ExcludeMatcher
+from sweetpotato.fleet import read_fleet, rolling_restart, run_fleet_action
+from sweetpotato.index import DELETED_MEMBER, archive_tree, get_index
 from sweetpotato.java import get_jar
+from sweetpotato.logindex import LogIndex, get_log_index, parse_log_query
+from sweetpotato.logs import LogFollower
+from sweetpotato.metrics import BackupStats, format_metrics, record_backup
+from sweetpotato.perf import PerfMonitor, format_perf, parse_tps, percentile
+from sweetpotato.proc import get_procs, get_resources, procs_snapshot, \
+    read_process, wait_for_exit
+from sweetpotato.query import QueryClient, query_server
+from sweetpotato.rcon import RconClient
+from sweetpotato.restore import restore_backup
+from sweetpotato.retention import find_backups, get_backup_chain, \
+    prune_backups
+from sweetpotato.schedule import CronSchedule, backup_lock, get_deferral_reason
+from sweetpotato import screen
+from sweetpotato.server import is_server_running, list_players, \
+    list_players_as_list, server_command, wait_for_server_ready, \
+    wait_for_server_shutdown
+from sweetpotato.snapshot import snapshot_tree
+from sweetpotato.status import get_log_roster, get_perf
+from sweetpotato.store import read_manifest, restore_manifest, \
+    store_backup, write_manifest
 from sweetpotato.system import dependency_check, get_exe_path
 
 
@@ -25,6 +72,7 @@ TEST_MEM_MAX = '1024'
 TEST_MEM_MIN = '512'
 TEST_SERVER_DIR = '/tmp/_sp_test_server'
 TEST_SERVER_DIR2 = '/tmp/_sp_test_server2'
+TEST_STORE_DIR = '/tmp/_sp_test_store'
 TEST_WEBUI_PORT = 8181
 TEST_WORLD_NAME = 'TestWorld'
 TEST_WORLD_NAME2 = 'TestWorld2'
@@ -231,5 +279,1502 @@ class SweetpotatoTests(unittest.TestCase):
             ))
 
 
+class BackupStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+        self.server_dir = os.path.join(TEST_STORE_DIR, 'server', TEST_WORLD_NAME)
+        os.makedirs(os.path.join(self.server_dir, 'region'))
+        with open(os.path.join(self.server_dir, 'region', 'r.0.0.mca'), 'wb') as f:
+            f.write(os.urandom(600 * 1024))
+        with open(os.path.join(self.server_dir, 'level.dat'), 'wb') as f:
+            f.write(b'level')
+        with open(os.path.join(self.server_dir, 'level.dat_new'), 'wb') as f:
+            f.write(b'skip me')
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def test_store_and_restore(self):
+        backup_dir = os.path.join(TEST_STORE_DIR, 'backups')
+        parent = os.path.dirname(self.server_dir)
+        manifest, stats = store_backup(
+            backup_dir, parent, TEST_WORLD_NAME, 'first.manifest',
+            keep=lambda p, is_dir=False: not p.endswith('level.dat_new'))
+        self.assertEqual(stats['files'], 2)
+        self.assertEqual(stats['new_chunks'], 4)
+
+        # Only the changed chunk is written the second time around
+        with open(os.path.join(self.server_dir, 'region', 'r.0.0.mca'), 'r+b') as f:
+            f.write(b'changed')
+        stats = store_backup(backup_dir, parent, TEST_WORLD_NAME, 'second.manifest')[1]
+        self.assertEqual(stats['new_chunks'], 2)
+
+        restored = os.path.join(TEST_STORE_DIR, 'restored')
+        self.assertEqual(restore_manifest(manifest, restored, quiet=True), 2)
+        self.assertFalse(os.path.exists(
+            os.path.join(restored, TEST_WORLD_NAME, 'level.dat_new')))
+        with open(os.path.join(restored, TEST_WORLD_NAME, 'level.dat'), 'rb') as f:
+            self.assertEqual(f.read(), b'level')
+
+    def test_snapshot_links_unchanged_files(self):
+        parent = os.path.dirname(self.server_dir)
+        staging = os.path.join(TEST_STORE_DIR, 'staging')
+        first, stats = snapshot_tree(parent, TEST_WORLD_NAME, staging)
+        self.assertEqual(stats['copied'], 3)
+        level_dat = os.path.join(first, TEST_WORLD_NAME, 'level.dat')
+        inode = os.stat(level_dat).st_ino
+
+        os.utime(os.path.join(self.server_dir, 'region', 'r.0.0.mca'), (0, 0))
+        stats = snapshot_tree(parent, TEST_WORLD_NAME, staging)[1]
+        self.assertEqual((stats['copied'], stats['linked']), (1, 2))
+        self.assertEqual(os.stat(level_dat).st_ino, inode)
+
+    def test_saving_back_on_after_failure(self):
+        s = SweetpotatoConfig()
+        s.server_dir = self.server_dir
+        s.backup_dir = os.path.join(TEST_STORE_DIR, 'backups')
+        s.world_name = TEST_WORLD_NAME
+        with unittest.mock.patch('sweetpotato.core._run_pipeline') as pipeline, \
+                unittest.mock.patch('sweetpotato.core.server_command'), \
+                unittest.mock.patch('sweetpotato.core.archive_tree',
+                                    side_effect=OSError(28, 'No space left')):
+            with self.assertRaises(OSError):
+                run_server_backup(s.exclude_files, s, True, {'pid': 1}, False)
+        self.assertEqual(pipeline.call_args[0][2:], (('save-on', SAVE_ON_ACK),))
+
+    def test_failed_backup_leaves_no_tarball(self):
+        s = SweetpotatoConfig()
+        s.server_dir = self.server_dir
+        s.backup_dir = os.path.join(TEST_STORE_DIR, 'backups')
+        s.world_name = TEST_WORLD_NAME
+        s.jobs = 2
+        opened = []
+
+        def _open(*args):
+            opened.append(open_parallel_tar(*args))
+            return opened[-1]
+
+        with unittest.mock.patch('sweetpotato.core.archive_tree',
+                                 side_effect=OSError(28, 'No space left')), \
+                unittest.mock.patch('sweetpotato.core.open_parallel_tar',
+                                    side_effect=_open):
+            with self.assertRaises(OSError):
+                run_server_backup(s.exclude_files, s, True, False, False)
+        self.assertEqual(os.listdir(s.backup_dir), [])
+        self.assertTrue(opened[0][1].closed)
+
+    def test_diff_is_against_the_full_backup(self):
+        s = SweetpotatoConfig()
+        s.server_dir = self.server_dir
+        s.backup_dir = os.path.join(TEST_STORE_DIR, 'backups')
+        s.world_name = TEST_WORLD_NAME
+        s.backup_mode = 'diff'
+        # Nothing to be the difference from yet
+        run_server_backup(s.exclude_files, s, True, False, False)
+        index = get_index(s.backup_dir, self.server_dir,
+                          os.path.basename(self.server_dir))
+        entries = index.load().entries
+        with open(os.path.join(self.server_dir, 'level.dat'), 'wb') as f:
+            f.write(b'new level')
+        run_server_backup(s.exclude_files, s, True, False, False)
+        names = sorted(n for n in os.listdir(s.backup_dir) if n != '.index')
+        self.assertEqual(len(names), 2)
+        self.assertFalse(names[0].endswith('_diff.tar.gz'))
+        self.assertTrue(names[1].endswith('_diff.tar.gz'))
+        self.assertEqual(index.load().entries, entries)
+
+    def test_servers_in_dirs_of_the_same_name_keep_apart(self):
+        other_dir = os.path.join(TEST_STORE_DIR, 'other', TEST_WORLD_NAME)
+        shutil.copytree(self.server_dir, other_dir)
+        s = SweetpotatoConfig()
+        s.server_dir = self.server_dir
+        s.backup_dir = os.path.join(TEST_STORE_DIR, 'backups')
+        s.world_name = TEST_WORLD_NAME
+        s.backup_mode = 'diff'
+        run_server_backup(s.exclude_files, s, True, False, False)
+        name = os.path.basename(self.server_dir)
+        index = get_index(s.backup_dir, self.server_dir, name)
+        other = get_index(s.backup_dir, other_dir, name)
+        self.assertNotEqual(index.path, other.path)
+        self.assertTrue(index.load().entries)
+        # The other server's first backup still has to be a full one
+        self.assertFalse(other.load().entries)
+        self.assertNotEqual(get_log_index(s.backup_dir, self.server_dir).path,
+                            get_log_index(s.backup_dir, other_dir).path)
+
+    def test_only_stored_backups_are_recorded(self):
+        s = SweetpotatoConfig()
+        s.server_dir = self.server_dir
+        s.backup_dir = os.path.join(TEST_STORE_DIR, 'backups')
+        s.world_name = TEST_WORLD_NAME
+        s.backup_mode = 'dedup'
+        stats = BackupStats(s.backup_dir, TEST_WORLD_NAME)
+        with unittest.mock.patch('sweetpotato.core.store_backup',
+                                 side_effect=BackupStoreError('Nothing to store')):
+            run_server_backup(s.exclude_files, s, True, False, False)
+        self.assertIsNone(stats.get())
+        s.backup_mode = 'full'
+        run_server_backup(s.exclude_files, s, True, False, False)
+        self.assertGreater(stats.get()['size'], 0)
+        self.assertIsNone(BackupStats(s.backup_dir, 'Otherworld').get())
+
+    def test_differential_archive(self):
+        os.chdir(os.path.dirname(self.server_dir))
+        index = get_index(TEST_STORE_DIR, self.server_dir, TEST_WORLD_NAME).load()
+        with tarfile.open(os.path.join(TEST_STORE_DIR, 'full.tar'), 'w') as tar:
+            new_index = archive_tree(tar, TEST_WORLD_NAME, index)[0]
+        new_index.save()
+
+        os.remove(os.path.join(self.server_dir, 'level.dat_new'))
+        with open(os.path.join(self.server_dir, 'level.dat'), 'wb') as f:
+            f.write(b'new level')
+        index = get_index(TEST_STORE_DIR, self.server_dir, TEST_WORLD_NAME).load()
+        self.assertEqual(len(index.entries), 3)
+        with tarfile.open(os.path.join(TEST_STORE_DIR, 'diff.tar'), 'w') as tar:
+            stats = archive_tree(tar, TEST_WORLD_NAME, index, changed_only=True)[1]
+        self.assertEqual((stats['added'], stats['unchanged'], stats['deleted']),
+                         (1, 1, 1))
+        with tarfile.open(os.path.join(TEST_STORE_DIR, 'diff.tar')) as tar:
+            names = tar.getnames()
+            deleted = tar.extractfile(DELETED_MEMBER).read().decode()
+        self.assertIn(os.path.join(TEST_WORLD_NAME, 'level.dat'), names)
+        self.assertNotIn(os.path.join(TEST_WORLD_NAME, 'region', 'r.0.0.mca'), names)
+        self.assertEqual(deleted.strip(), os.path.join(TEST_WORLD_NAME, 'level.dat_new'))
+
+
+class AnvilTests(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs(os.path.join(TEST_STORE_DIR, 'region'), exist_ok=True)
+        self.region = os.path.join(TEST_STORE_DIR, 'region', 'r.0.0.mca')
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def _record(self, data):
+        return len(data).to_bytes(4, 'big') + data
+
+    def test_delta_holds_only_changed_chunks(self):
+        chunks = {i: (1000, self._record(os.urandom(5000))) for i in range(0, 1024, 8)}
+        write_region(self.region, chunks)
+        header, base = make_region_delta(self.region)
+
+        changed = dict(chunks)
+        changed[8] = (2000, self._record(os.urandom(5000)))
+        del changed[1016]
+        write_region(self.region, changed)
+        delta = make_region_delta(self.region, header)[1]
+        self.assertLess(len(delta), 8192 + 5100)
+
+        restored = apply_region_delta(apply_region_delta({}, base), delta)
+        self.assertEqual(restored, changed)
+        self.assertEqual(read_region(self.region), changed)
+
+    def test_region_chain(self):
+        names = ['2018-01-01-000000_W_region_base.tar.gz',
+                 '2018-01-02-000000_W_region.tar.gz',
+                 '2018-01-03-000000_W_region_base.tar.gz',
+                 '2018-01-04-000000_W_region.tar.gz',
+                 '2018-01-05-000000_W_region.tar.gz',
+                 '2018-01-04-000000_W2_region.tar.gz']
+        for n in names:
+            open(os.path.join(TEST_STORE_DIR, n), 'w').close()
+        chain = get_backup_chain(os.path.join(TEST_STORE_DIR, names[3]))
+        self.assertEqual([os.path.basename(c) for c in chain], names[2:4])
+
+
+class RestoreTests(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+        self.parent = os.path.join(TEST_STORE_DIR, 'servers')
+        self.server_dir = os.path.join(self.parent, 'server')
+        self.world_dir = os.path.join(self.server_dir, TEST_WORLD_NAME)
+        os.makedirs(os.path.join(self.world_dir, 'playerdata'))
+        self._write('server.properties', b'level-name=' + TEST_WORLD_NAME.encode())
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'level')
+        self.backup_dir = os.path.join(TEST_STORE_DIR, 'backups')
+        os.makedirs(self.backup_dir)
+        self.s = SweetpotatoConfig()
+        self.s.backup_dir = self.backup_dir
+        self.s.server_dir = self.server_dir
+        self.s.world_name = TEST_WORLD_NAME
+        self.s.jobs = 2
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def _write(self, name, data):
+        with open(os.path.join(self.server_dir, name), 'wb') as f:
+            f.write(data)
+
+    def _read(self, name):
+        with open(os.path.join(self.server_dir, name), 'rb') as f:
+            return f.read()
+
+    def _index(self):
+        return get_index(self.backup_dir, self.server_dir, 'server')
+
+    def _backup(self, name, index, changed_only=False):
+        os.chdir(self.parent)
+        with tarfile.open(os.path.join(self.backup_dir, name), 'w:gz') as tar:
+            new_index = archive_tree(tar, 'server', index,
+                                     changed_only=changed_only)[0]
+        return new_index
+
+    def test_restore_skips_earlier_differentials(self):
+        index = self._backup('2020-01-01-000000_server.tar.gz', self._index())
+        self._write('extra', b'extra')
+        self._backup('2020-01-02-000000_server_diff.tar.gz', index,
+                     changed_only=True)
+        os.remove(os.path.join(self.server_dir, 'extra'))
+        self._backup('2020-01-03-000000_server_diff.tar.gz', index,
+                     changed_only=True)
+        self._write('extra', b'extra')
+        restore_backup(self.s, '2020-01-03-000000_server_diff.tar.gz',
+                       quiet=True)
+        self.assertEqual(sorted(os.listdir(self.server_dir)),
+                         [TEST_WORLD_NAME, 'server.properties'])
+
+    def test_restore_differential_chain(self):
+        index = self._backup('2020-01-01-000000_server.tar.gz', self._index())
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'newer')
+        os.remove(os.path.join(self.server_dir, 'server.properties'))
+        self._backup('2020-01-02-000000_server_diff.tar.gz', index,
+                     changed_only=True)
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'broken')
+        self._write('junk', b'junk')
+
+        kept = restore_backup(self.s, '2020-01-02-000000_server_diff.tar.gz',
+                              quiet=True)
+        self.assertEqual(self._read(os.path.join(TEST_WORLD_NAME, 'level.dat')),
+                         b'newer')
+        self.assertEqual(os.listdir(self.server_dir), [TEST_WORLD_NAME])
+        # What was there before is kept, not thrown away
+        self.assertEqual(sorted(os.listdir(self.parent)),
+                         ['server', os.path.basename(kept)])
+        with open(os.path.join(kept, 'junk'), 'rb') as f:
+            self.assertEqual(f.read(), b'junk')
+
+    def test_world_only_leaves_the_rest(self):
+        self._backup('2020-01-01-000000_server.tar.gz', self._index())
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'broken')
+        self._write('server.properties', b'changed')
+
+        kept = restore_backup(self.s, '2020-01-01-000000_server.tar.gz',
+                              world_only=True, quiet=True)
+        self.assertEqual(self._read(os.path.join(TEST_WORLD_NAME, 'level.dat')),
+                         b'level')
+        self.assertEqual(self._read('server.properties'), b'changed')
+        self.assertEqual(os.listdir(kept), [TEST_WORLD_NAME])
+        with open(os.path.join(kept, TEST_WORLD_NAME, 'level.dat'), 'rb') as f:
+            self.assertEqual(f.read(), b'broken')
+
+    def test_files_are_extracted_in_blocks(self):
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'0123456789' * 10)
+        self._backup('2020-01-01-000000_server.tar.gz', self._index())
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'broken')
+        with unittest.mock.patch('sweetpotato.restore.EXTRACT_BLOCK_SIZE', 7):
+            restore_backup(self.s, '2020-01-01-000000_server.tar.gz', quiet=True)
+        self.assertEqual(self._read(os.path.join(TEST_WORLD_NAME, 'level.dat')),
+                         b'0123456789' * 10)
+
+    def test_corrupt_backup_is_not_restored(self):
+        os.chdir(self.parent)
+        backup = os.path.join(self.backup_dir, '2020-01-01-000000_server.tar.gz')
+        with tarfile.open(backup + '.tmp', 'w') as tar:
+            archive_tree(tar, 'server', self._index())
+        with open(backup + '.tmp', 'rb') as f:
+            data = f.read().replace(b'level\0', b'LEVEL\0')
+        with gzip.open(backup, 'wb') as f:
+            f.write(data)
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'live')
+
+        with self.assertRaises(BackupStoreError):
+            restore_backup(self.s, backup, quiet=True)
+        self.assertEqual(self._read(os.path.join(TEST_WORLD_NAME, 'level.dat')),
+                         b'live')
+
+    def test_corrupt_region_delta_is_not_restored(self):
+        region_dir = os.path.join(self.world_dir, 'region')
+        os.makedirs(region_dir)
+        region = os.path.join(region_dir, 'r.0.0.mca')
+        write_region(region, {0: (1000, (5000).to_bytes(4, 'big') + b'A' * 5000)})
+        os.chdir(self.parent)
+        backup = os.path.join(self.backup_dir,
+                              '2020-01-01-000000_server_region_base.tar.gz')
+        with tarfile.open(backup + '.tmp', 'w') as tar:
+            state = get_region_state(self.backup_dir, self.server_dir, 'server')
+            archive_tree(tar, 'server', self._index(), deltas=state.make_delta)
+        with open(backup + '.tmp', 'rb') as f:
+            data = f.read()
+        with gzip.open(backup, 'wb') as f:
+            f.write(data)
+        restore_backup(self.s, backup, quiet=True)
+        self.assertEqual(read_region(region)[0][1][4:], b'A' * 5000)
+
+        with gzip.open(backup, 'wb') as f:
+            f.write(data.replace(b'A' * 100, b'B' * 100, 1))
+        with self.assertRaises(BackupStoreError):
+            restore_backup(self.s, backup, quiet=True)
+        self.assertEqual(read_region(region)[0][1][4:], b'A' * 5000)
+
+    def test_dedup_restore_is_verified(self):
+        manifest = store_backup(self.backup_dir, self.parent, 'server',
+                                '2020-01-01-000000_server.manifest')[0]
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'live')
+        self._write('server.properties', b'changed')
+        restore_backup(self.s, manifest, world_only=True, quiet=True)
+        self.assertEqual(self._read(os.path.join(TEST_WORLD_NAME, 'level.dat')),
+                         b'level')
+        self.assertEqual(self._read('server.properties'), b'changed')
+
+        files = read_manifest(manifest)
+        for f in files['files']:
+            f['sha256'] = '0' * 64
+        write_manifest(manifest, files)
+        self._write(os.path.join(TEST_WORLD_NAME, 'level.dat'), b'live')
+        with self.assertRaises(BackupStoreError):
+            restore_backup(self.s, manifest, quiet=True)
+        self.assertEqual(self._read(os.path.join(TEST_WORLD_NAME, 'level.dat')),
+                         b'live')
+
+
+class ProcTests(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs(TEST_SERVER_DIR2, exist_ok=True)
+        self.proc = subprocess.Popen(['sleep', '30'], cwd=TEST_SERVER_DIR2)
+        # Wait for the fork to have exec()'d sleep
+        for _ in range(50):
+            if read_process(self.proc.pid)['comm'] == 'sleep':
+                break
+            time.sleep(0.02)
+
+    def tearDown(self):
+        self.proc.kill()
+        self.proc.wait()
+        shutil.rmtree(TEST_SERVER_DIR2, ignore_errors=True)
+
+    def test_read_process(self):
+        proc = read_process(self.proc.pid)
+        self.assertEqual(proc['comm'], 'sleep')
+        self.assertEqual(proc['cmdline'], ['sleep', '30'])
+        self.assertEqual(proc['cwd'], os.path.realpath(TEST_SERVER_DIR2))
+        self.assertLess(abs(proc['start_time'] - time.time()), 5)
+        self.assertIn(self.proc.pid, [p['pid'] for p in get_procs('sleep')])
+
+    def test_server_dir_matches_exactly(self):
+        procs = [read_process(self.proc.pid)]
+        with unittest.mock.patch('sweetpotato.server.get_java_procs',
+                                 return_value=procs):
+            self.assertFalse(is_server_running(TEST_SERVER_DIR2[:-1]))
+            self.assertEqual(is_server_running(TEST_SERVER_DIR2 + '/')['pid'],
+                             self.proc.pid)
+
+    def test_get_resources(self):
+        resources = get_resources(self.proc.pid, 0.1)
+        self.assertEqual(resources['threads'], 1)
+        self.assertLess(resources['cpu_percent'], 50)
+        self.assertGreater(resources['rss'], 0)
+        self.assertGreaterEqual(resources['fds'], 3)
+        self.assertIsNotNone(resources['io_write_bytes'])
+        busy = subprocess.Popen([sys.executable, '-c', 'while True: pass'])
+        try:
+            self.assertGreater(get_resources(busy.pid, 0.3)['cpu_percent'], 20)
+        finally:
+            busy.kill()
+            busy.wait()
+        self.assertIsNone(get_resources(busy.pid))
+        start = time.monotonic()
+        resources = get_resources(self.proc.pid, window=None)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertIsNone(resources['cpu_percent'])
+        self.assertGreater(resources['rss'], 0)
+
+    def test_wait_for_exit(self):
+        start = time.monotonic()
+        self.assertFalse(wait_for_exit(self.proc.pid, 0.2))
+        self.proc.terminate()
+        self.assertTrue(wait_for_exit(self.proc.pid, 5))
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_shutdown_escalates_to_sigkill(self):
+        stubborn = subprocess.Popen([
+            sys.executable, '-c', 'import signal, time;'
+            ' signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(30)'])
+        time.sleep(0.2)
+        with unittest.mock.patch('sweetpotato.server.send_command') as send, \
+                unittest.mock.patch('sweetpotato.server.is_screen_started'), \
+                unittest.mock.patch('sweetpotato.server.SERVER_TERM_WAIT', 0.2):
+            wait_for_server_shutdown('screen', stubborn.pid, 0.2, quiet=True)
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(stubborn.wait(5), -signal.SIGKILL)
+
+
+class _FakeRconHandler(socketserver.BaseRequestHandler):
+    """Just enough of a Minecraft server's RCON to test against."""
+
+    def _recv(self):
+        length = struct.unpack('<i', self.request.recv(4))[0]
+        body = b''
+        while len(body) < length:
+            body += self.request.recv(length - len(body))
+        request_id, ptype = struct.unpack('<ii', body[:8])
+        return request_id, ptype, body[8:-2].decode()
+
+    def _send(self, request_id, ptype, payload):
+        body = struct.pack('<ii', request_id, ptype) + payload.encode() + b'\0\0'
+        self.request.sendall(struct.pack('<i', len(body)) + body)
+
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            try:
+                request_id, ptype, payload = self._recv()
+            except struct.error:
+                return
+            if ptype == 3:
+                ok = payload == 'hunter2'
+                self._send(request_id if ok else -1, 2, '')
+            elif ptype == 2 and payload == 'list':
+                self._send(request_id, 0, 'There are 2/20 players online:Notch, jeb_')
+            elif ptype == 2:
+                # Long output comes back split over several packets
+                self._send(request_id, 0, payload[:4096])
+                self._send(request_id, 0, payload[4096:])
+            else:
+                self._send(request_id, 0, 'Unknown request {}'.format(ptype))
+
+
+class RconTests(unittest.TestCase):
+
+    def setUp(self):
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      _FakeRconHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_command_output_over_one_connection(self):
+        client = RconClient('127.0.0.1', self.port, 'hunter2')
+        self.assertEqual(client.command('say hi'), 'say hi')
+        long_command = 'say ' + 'x' * 5000
+        self.assertEqual(client.command(long_command), long_command)
+        self.assertEqual(self.server.connections, 1)
+        client.close()
+
+    def test_bad_password(self):
+        with self.assertRaises(RconError):
+            RconClient('127.0.0.1', self.port, 'wrong').command('list')
+
+    def test_settings_use_rcon(self):
+        s = SweetpotatoConfig()
+        s.server_dir = TEST_SERVER_DIR
+        s.rcon_password = 'hunter2'
+        s.rcon_port = self.port
+        self.assertEqual(server_command(s, 'save-all'), 'save-all')
+        with unittest.mock.patch('sweetpotato.server.is_server_running',
+                                 return_value={'pid': 1}):
+            players = list_players(s)
+        self.assertEqual(list_players_as_list(players), ['Notch', 'jeb_'])
+        self.assertIn('enable-rcon=true\nrcon.port={}\n'.format(self.port),
+                      s.as_serverproperties)
+
+
+class _FakeQueryHandler(socketserver.BaseRequestHandler):
+    """Just enough of a Minecraft server's Query listener to test against."""
+
+    def handle(self):
+        data, sock = self.request
+        ptype, session = struct.unpack('>Bi', data[2:7])
+        header = struct.pack('>Bi', ptype, session)
+        if ptype == 9:
+            self.server.handshakes += 1
+            sock.sendto(header + str(self.server.token).encode() + b'\0',
+                        self.client_address)
+        elif ptype == 0 and struct.unpack('>i', data[7:11])[0] == self.server.token:
+            self.server.stats += 1
+            sock.sendto(
+                header + b'splitnum\x00\x80\x00hostname\x00A Minecraft Server\x00'
+                b'gametype\x00SMP\x00game_id\x00MINECRAFT\x00version\x001.12.2\x00'
+                b'plugins\x00CraftBukkit on Bukkit 1.12.2: WorldEdit 6.1; Essentials 2.0'
+                b'\x00map\x00world\x00numplayers\x002\x00maxplayers\x0020\x00'
+                b'hostport\x0025565\x00hostip\x00127.0.0.1\x00\x00'
+                b'\x01player_\x00\x00Notch\x00jeb_\x00\x00', self.client_address)
+        # Like the real thing, a stale token gets no reply at all
+
+
+class QueryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socketserver.ThreadingUDPServer(('127.0.0.1', 0),
+                                                      _FakeQueryHandler)
+        self.server.daemon_threads = True
+        self.server.handshakes = self.server.stats = 0
+        self.server.token = 9513307
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_full_stat(self):
+        client = QueryClient('127.0.0.1', self.port, timeout=0.5)
+        stat = client.full_stat()
+        self.assertEqual(stat['motd'], 'A Minecraft Server')
+        self.assertEqual(stat['version'], '1.12.2')
+        self.assertEqual(stat['server_mod'], 'CraftBukkit on Bukkit 1.12.2')
+        self.assertEqual(stat['plugins'], ['WorldEdit 6.1', 'Essentials 2.0'])
+        self.assertEqual((stat['players_online'], stat['max_players']), (2, 20))
+        self.assertEqual(stat['players'], ['Notch', 'jeb_'])
+        # The token is reused, so that's one round trip
+        client.full_stat()
+        self.assertEqual((self.server.handshakes, self.server.stats), (1, 2))
+        # Until the server forgets it
+        self.server.token = 1234
+        self.assertEqual(client.full_stat()['players'], ['Notch', 'jeb_'])
+        self.assertEqual((self.server.handshakes, self.server.stats), (2, 3))
+        client.close()
+
+    def test_settings_use_query(self):
+        s = SweetpotatoConfig()
+        self.assertIsNone(query_server(s))
+        s.query_port = self.port
+        self.assertEqual(query_server(s)['players'], ['Notch', 'jeb_'])
+        self.assertIn('enable-query=true\nquery.port={}\n'.format(self.port),
+                      s.as_serverproperties)
+
+    def test_no_reply(self):
+        self.server.token = None
+        with self.assertRaises(QueryError):
+            QueryClient('127.0.0.1', self.port, timeout=0.2).full_stat()
+
+
+class ScreenTests(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+        os.makedirs(TEST_STORE_DIR)
+        self.env = unittest.mock.patch.dict(os.environ, SCREENDIR=TEST_STORE_DIR)
+        self.env.start()
+        screen._screen_dir = None
+        screen._sessions.clear()
+        self.sockets = []
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+        self.env.stop()
+        screen._screen_dir = None
+        screen._sessions.clear()
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def _session(self, name, pid):
+        s = socket.socket(socket.AF_UNIX)
+        s.bind(os.path.join(TEST_STORE_DIR, '{0}.{1}'.format(pid, name)))
+        self.sockets.append(s)
+        return '{0}.{1}'.format(pid, name)
+
+    def test_resolves_from_socket_dir(self):
+        session = self._session(TEST_WORLD_NAME, os.getpid())
+        self._session(TEST_WORLD_NAME2, os.getpid())
+        self._session(TEST_WORLD_NAME, 999999999)  # dead
+        self.assertEqual(screen.is_screen_started(TEST_WORLD_NAME), session)
+        self.assertEqual(screen.is_screen_started(session), session)
+        self.assertFalse(screen.is_screen_started('NoSuchWorld'))
+
+    def test_session_is_remembered_until_its_socket_goes(self):
+        session = self._session(TEST_WORLD_NAME, os.getpid())
+        self.assertEqual(screen.is_screen_started(TEST_WORLD_NAME), session)
+        with unittest.mock.patch('os.listdir') as listdir:
+            self.assertEqual(screen.is_screen_started(TEST_WORLD_NAME), session)
+            self.assertFalse(listdir.called)
+        os.remove(os.path.join(TEST_STORE_DIR, session))
+        self.assertFalse(screen.is_screen_started(TEST_WORLD_NAME))
+
+
+class CommandPipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+        os.makedirs(os.path.join(TEST_STORE_DIR, 'logs'))
+        self.log = os.path.join(TEST_STORE_DIR, 'logs', 'latest.log')
+        with open(self.log, 'w') as f:
+            f.write('[12:00:00] [Server thread/INFO]: Saved the game\n')
+        self.s = SweetpotatoConfig()
+        self.s.server_dir = TEST_STORE_DIR
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def _server(self, *lines):
+        # Like a server behind screen: nothing back, the log is written later
+        def server_commands(settings, commands):
+            def write():
+                time.sleep(0.1)
+                with open(self.log, 'a') as f:
+                    for line in lines:
+                        f.write('[12:00:01] [Server thread/INFO]: {}\n'.format(line))
+            threading.Thread(target=write).start()
+            return [None] * len(commands)
+        return unittest.mock.patch('sweetpotato.console.server_commands',
+                                   server_commands)
+
+    def test_waits_for_acks_in_order(self):
+        with self._server('Automatic saving is now disabled', 'Saving the game',
+                          'Saved the game'):
+            start = time.monotonic()
+            CommandPipeline(self.s).add('save-off', SAVE_OFF_ACK) \
+                .add('save-all', SAVE_ALL_ACK).add('say hi').run(timeout=5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_old_log_lines_dont_count(self):
+        with self._server('Saving the game'):
+            with self.assertRaises(CommandTimeoutError):
+                CommandPipeline(self.s).add('save-all', SAVE_ALL_ACK).run(timeout=0.3)
+
+    def test_chat_is_not_an_ack(self):
+        with self._server('<Notch> Saved the game', '[Notch: Saved the game]',
+                          '[Server] Saved the game'):
+            with self.assertRaises(CommandTimeoutError):
+                CommandPipeline(self.s).add('save-all', SAVE_ALL_ACK).run(timeout=0.3)
+        with self._server('<Notch> Saved the game', 'Saved the game'):
+            self.assertEqual(CommandPipeline(self.s).add('save-all', SAVE_ALL_ACK)
+                             .run(timeout=5), [None])
+
+    def test_rcon_reply_is_an_ack(self):
+        with unittest.mock.patch('sweetpotato.console.server_commands',
+                                 return_value=['Saved the game']):
+            self.assertEqual(CommandPipeline(self.s).add('save-all', SAVE_ALL_ACK)
+                             .run(timeout=0.1), ['Saved the game'])
+
+
+class LogFollowerTests(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+        os.makedirs(os.path.join(TEST_STORE_DIR, 'logs'))
+        self.log = os.path.join(TEST_STORE_DIR, 'logs', 'latest.log')
+        self._append('old line\n')
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def _append(self, text, mode='a'):
+        with open(self.log, mode) as f:
+            f.write(text)
+
+    def test_reads_only_new_complete_lines(self):
+        follower = LogFollower(self.log)
+        self._append('one\ntw')
+        self.assertEqual(follower.read_lines(), ['one'])
+        self._append('o\n')
+        self.assertEqual(follower.read_lines(), ['two'])
+        self.assertEqual(follower.read_lines(), [])
+
+    def test_rotation_and_truncation(self):
+        follower = LogFollower(self.log)
+        os.rename(self.log, self.log + '.1')
+        self._append('new file\n')
+        self.assertEqual(follower.read_lines(), ['new file'])
+        self._append('x\n', mode='w')
+        self.assertEqual(follower.read_lines(), ['x'])
+
+    def test_wait_for(self):
+        follower = LogFollower(self.log)
+        threading.Timer(0.1, self._append, ['a\nthe line\nafter\n']).start()
+        self.assertEqual(follower.wait_for('the', 5), 'the line')
+        self.assertEqual(follower.read_lines(), ['after'])
+        self.assertIsNone(follower.wait_for('never', 0.1))
+
+    def test_reads_a_block_at_a_time(self):
+        follower = LogFollower(self.log, from_start=True)
+        self._append('a long first line\nsecond\nthe line\nafter\n')
+        with unittest.mock.patch('sweetpotato.logs.LOG_READ_BLOCK', 5):
+            self.assertEqual(follower.wait_for('the', 0), 'the line')
+            # What's after it hasn't all been read yet
+            self.assertLess(follower.offset, os.path.getsize(self.log))
+            self.assertEqual(follower.read_lines(), ['after'])
+        self.assertEqual(follower.partial, b'')
+
+    def test_list_players_from_log(self):
+        s = SweetpotatoConfig()
+        s.server_dir = TEST_STORE_DIR
+
+        def send_command(command, screen):
+            self._append('[13:00:28] [Server thread/INFO]: There are 2/20 players online:\n'
+                         '[13:00:28] [Server thread/INFO]: georgedubya, Notch\n')
+        with unittest.mock.patch('sweetpotato.server.is_server_running',
+                                 return_value={'pid': 1}), \
+                unittest.mock.patch('sweetpotato.server.is_screen_started'), \
+                unittest.mock.patch('sweetpotato.server.send_command', send_command):
+            players = list_players(s)
+        self.assertEqual(len(players), 2)
+        self.assertEqual(list_players_as_list(players), ['georgedubya', 'Notch'])
+        self.assertIsNone(list_players_as_list(
+            ['There are 0 of a max of 20 players online: ']))
+
+
+class LogEventTests(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+        os.makedirs(os.path.join(TEST_STORE_DIR, 'logs'))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def test_parse_line(self):
+        e = parse_line('[13:00:28] [Server thread/INFO]: Notch joined the game\n')
+        self.assertEqual((e['type'], e['player'], e['clock'], e['level']),
+                         ('join', 'Notch', '13:00:28', 'INFO'))
+        e = parse_line('[13:00:29] [Server thread/INFO]: <jeb_> hi there')
+        self.assertEqual((e['type'], e['player'], e['text']), ('chat', 'jeb_', 'hi there'))
+        e = parse_line('[13:01:00] [Server thread/WARN]: Can\'t keep up! Did the system'
+                       ' time change, or is the server overloaded? Running 2044ms'
+                       ' behind, skipping 40 tick(s)')
+        self.assertEqual((e['type'], e['ms'], e['ticks']), ('lag', 2044, 40))
+        e = parse_line('[13:01:00 WARN]: Can\'t keep up! Is the server overloaded?'
+                       ' Running 5000ms or 100 ticks behind')
+        self.assertEqual((e['type'], e['ms'], e['ticks']), ('lag', 5000, 100))
+        e = parse_line('[13:02:00] [Client thread/INFO] [FML]: Bar Step:'
+                       ' PreInitialization - Just Enough Items took 1.250s')
+        self.assertEqual((e['type'], e['mod'], e['seconds']),
+                         ('mod_load', 'Just Enough Items', 1.25))
+        e = parse_line('There are 1 of a max of 20 players online: Notch')
+        self.assertEqual((e['type'], e['online'], e['max'], e['players']),
+                         ('list', 1, 20, ['Notch']))
+        self.assertEqual(parse_line('[13:03:00] [Server thread/INFO]: [Notch: Set the'
+                                    ' time to 1000]')['type'], 'command')
+        self.assertEqual(parse_line('[13:03:00] [Server thread/INFO]: Hello')['type'],
+                         'other')
+
+    def test_events_across_rotated_logs(self):
+        logs = os.path.join(TEST_STORE_DIR, 'logs')
+        with gzip.open(os.path.join(logs, '2020-01-01-1.log.gz'), 'wt') as f:
+            f.write('[23:59:00] [Server thread/INFO]: Notch joined the game\n'
+                    '[00:01:00] [Server thread/INFO]: Notch left the game\n')
+        with open(os.path.join(logs, 'latest.log'), 'w') as f:
+            f.write('[23:00:00] [Server thread/INFO]: jeb_ joined the game\n'
+                    'java.lang.Exception: no timestamp here\n'
+                    '[01:00:00] [Server thread/INFO]: Saved the game\n')
+        last_written = time.mktime((2020, 1, 5, 2, 0, 0, 0, 0, -1))
+        os.utime(os.path.join(logs, 'latest.log'), (last_written, last_written))
+
+        events = list(iter_server_events(TEST_STORE_DIR, types=('join', 'leave')))
+        self.assertEqual([(e['type'], e['player'], e['time'].strftime('%m-%d %H:%M'))
+                          for e in events],
+                         [('join', 'Notch', '01-01 23:59'),
+                          ('leave', 'Notch', '01-02 00:01'),
+                          ('join', 'jeb_', '01-04 23:00')])
+
+
+class LogIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+        self.logs = os.path.join(TEST_STORE_DIR, 'logs')
+        os.makedirs(self.logs)
+        for day in range(1, 4):
+            with gzip.open(os.path.join(self.logs, '2020-01-0{}-1.log.gz'.format(day)),
+                           'wt') as f:
+                for i in range(500):
+                    f.write('[10:00:00] [Server thread/INFO]: Preparing spawn area\n')
+                f.write('[11:00:00] [Server thread/INFO]: Notch joined the game\n')
+                f.write('[11:30:00] [Server thread/WARN]: Can\'t keep up! Is the server'
+                        ' overloaded? Running {}000ms or 40 ticks behind\n'.format(day))
+        self.latest = os.path.join(self.logs, 'latest.log')
+        self._append('[09:00:00] [Server thread/INFO]: jeb_ joined the game\n')
+        self.index = LogIndex(os.path.join(TEST_STORE_DIR, 'idx', 'logs.index'))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def _append(self, text):
+        with open(self.latest, 'a') as f:
+            f.write(text)
+
+    def test_search(self):
+        self.assertEqual(self.index.update(TEST_STORE_DIR), 4)
+        self.index.save()
+        index = LogIndex(self.index.path).load()
+        last_join = index.search(TEST_STORE_DIR, **parse_log_query(
+            'player:Notch type:join limit:1'))
+        self.assertEqual([e['time'].strftime('%m-%d %H:%M') for e in last_join],
+                         ['01-03 11:00'])
+        lag = index.search(TEST_STORE_DIR, **parse_log_query(
+            'type:lag since:2020-01-02 until:2020-01-02'))
+        self.assertEqual([e['ms'] for e in lag], [2000])
+        self.assertEqual(len(index.search(TEST_STORE_DIR, text='joined')), 4)
+        with self.assertRaises(ValueError):
+            parse_log_query('type:nonsense')
+
+    def test_incremental_update(self):
+        self.index.update(TEST_STORE_DIR)
+        self.assertEqual(self.index.update(TEST_STORE_DIR), 0)
+        self._append('[09:10:00] [Server thread/INFO]: jeb_ left the ga')
+        self.assertEqual(self.index.update(TEST_STORE_DIR), 1)
+        self.assertEqual(self.index.search(TEST_STORE_DIR, types=['leave']), [])
+        self._append('me\n')
+        self.index.update(TEST_STORE_DIR)
+        leave = self.index.search(TEST_STORE_DIR, types=['leave'])
+        self.assertEqual([e['player'] for e in leave], ['jeb_'])
+
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.run_dir = os.path.join(TEST_STORE_DIR, 'run')
+        os.makedirs(os.path.join(TEST_STORE_DIR, 'logs'), exist_ok=True)
+        self.log = os.path.join(TEST_STORE_DIR, 'logs', 'latest.log')
+        with open(self.log, 'w') as log:
+            log.write('[12:00:00] [Server thread/INFO]: Done (3.2s)! For help, type "help"\n'
+                      '[12:01:00] [Server thread/INFO]: Notch joined the game\n'
+                      '[12:02:00] [Server thread/INFO]: jeb_ joined the game\n'
+                      '[12:03:00] [Server thread/INFO]: jeb_ left the game\n')
+        self.s = SweetpotatoConfig()
+        self.s.server_dir = TEST_STORE_DIR
+        self.s.backup_dir = TEST_STORE_DIR
+        self.s.quiet = True
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.s.metrics_port = sock.getsockname()[1]
+        self.proc = {'pid': os.getpid(), 'comm': 'java', 'cmdline': ['java'],
+                     'cwd': TEST_STORE_DIR, 'exe': None,
+                     'start_time': time.time() - 90}
+        patches = [
+            unittest.mock.patch.dict(os.environ, XDG_RUNTIME_DIR=self.run_dir),
+            unittest.mock.patch('sweetpotato.daemon.is_server_running',
+                                return_value=self.proc),
+            unittest.mock.patch('sweetpotato.daemon.is_screen_started'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.daemon = Daemon(self.s)
+        self.thread = threading.Thread(target=asyncio.run,
+                                       args=(self.daemon.serve(),))
+        self.thread.start()
+        deadline = time.monotonic() + 5
+        while daemon_action(self.s, 'ping') is None \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.stop()
+        self.thread.join()
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def test_status_from_log(self):
+        status = daemon_action(self.s, 'status')['result']
+        self.assertEqual(status['running']['pid'], os.getpid())
+        self.assertEqual(status['running']['players'], ['Notch'])
+        self.assertEqual(status['running']['uptime']['minutes'], 1)
+        self.assertNotIn('rcon_password', status)
+
+    def test_roster_follows_log(self):
+        with open(self.log, 'a') as log:
+            log.write('[12:04:00] [Server thread/INFO]: Dinnerbone joined the game\n')
+        deadline = time.monotonic() + 5
+        while daemon_action(self.s, 'list')['result'] != ['Dinnerbone', 'Notch']:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_recent_lag(self):
+        # What's already in the log at startup doesn't count
+        self.daemon.handle_event(parse_line(
+            "[12:05:00] [Server thread/WARN]: Can't keep up! Is the server"
+            " overloaded? Running 2500ms or 50 ticks behind"))
+        self.assertEqual(self.daemon.recent_lag(), 2500)
+        self.daemon.perf.lag[0] = (time.time() - 301, 2500, 50)
+        self.assertEqual(self.daemon.recent_lag(), 0)
+
+    def test_metrics(self):
+        record_backup(TEST_STORE_DIR, self.s.world_name,
+                      {'file': 'x.tar.gz', 'size': 1024,
+                       'started_at': time.time() - 30,
+                       'finished_at': time.time() - 20, 'duration': 10.0})
+        url = 'http://127.0.0.1:{}/metrics'.format(self.s.metrics_port)
+        with urllib.request.urlopen(url) as response:
+            self.assertTrue(response.headers['Content-Type'].startswith(
+                'application/openmetrics-text'))
+            metrics = response.read().decode()
+        self.assertIn('sweetpotato_up{server="Sweetpotatoworld"} 1.0\n', metrics)
+        self.assertIn('sweetpotato_players_online{server="Sweetpotatoworld"} 1.0\n',
+                      metrics)
+        self.assertIn('sweetpotato_backup_size_bytes{server="Sweetpotatoworld"} 1024.0\n',
+                      metrics)
+        self.assertIn('sweetpotato_lag_events_total{server="Sweetpotatoworld"} 0.0\n',
+                      metrics)
+        self.assertTrue(metrics.endswith('# EOF\n'))
+
+    def test_fleet_metrics(self):
+        lobby = SweetpotatoConfig()
+        lobby.world_name = lobby.screen_name = 'Lobby'
+        lobby.server_dir = lobby.backup_dir = TEST_STORE_DIR
+        record_backup(TEST_STORE_DIR, 'Lobby',
+                      {'file': 'x.tar.gz', 'size': 2048,
+                       'started_at': time.time() - 30,
+                       'finished_at': time.time() - 20, 'duration': 10.0})
+        samples = FleetMetrics({'lobby': lobby, 'survival': self.s}).samples()
+        # From the daemon
+        self.assertEqual(samples['survival']['players_online'], 1)
+        self.assertNotIn('backup_size_bytes', samples['survival'])
+        # Without one
+        self.assertEqual(samples['lobby']['up'], 1)
+        self.assertEqual(samples['lobby']['backup_size_bytes'], 2048)
+        self.assertNotIn('players_online', samples['lobby'])
+
+    def test_command(self):
+        with unittest.mock.patch('sweetpotato.daemon.server_command',
+                                 return_value='Hi') as command:
+            reply = daemon_action(self.s, 'command', command='say Hi')
+        self.assertEqual(reply['result'], 'Hi')
+        command.assert_called_once_with(self.s, 'say Hi')
+
+    def test_errors(self):
+        self.assertRaises(DaemonError, daemon_action, self.s, 'bogus')
+        self.daemon.proc = False
+        self.assertRaises(DaemonError, daemon_action, self.s, 'save_all')
+
+    def test_resources_sampled_off_the_loop(self):
+        threads = []
+
+        def sample():
+            threads.append(threading.current_thread())
+            return {'rss': 1024}
+
+        with unittest.mock.patch.object(self.daemon.sampler, 'sample',
+                                        side_effect=sample):
+            asyncio.run_coroutine_threadsafe(
+                self.daemon.sample_resources(), self.daemon._loop).result(5)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], self.thread)
+        self.assertEqual(self.daemon.resources, {'rss': 1024})
+
+    def test_backup_failure_is_logged(self):
+        with unittest.mock.patch(
+                'sweetpotato.daemon.run_server_backup',
+                side_effect=OSError(28, 'No space left on device')), \
+                unittest.mock.patch('sweetpotato.daemon.emit_msg') as emit:
+            asyncio.run_coroutine_threadsafe(
+                self.daemon.backup(), self.daemon._loop).result(5)
+        self.assertIn('No space left', emit.call_args[0][0])
+
+    def test_no_daemon(self):
+        s = SweetpotatoConfig()
+        s.screen_name = 'NoSuchWorld'
+        self.assertIsNone(daemon_action(s, 'status'))
+
+
+class MetricsTests(unittest.TestCase):
+    def test_format_metrics(self):
+        metrics = format_metrics({'b"ad': {'up': 0, 'lag_events': 2},
+                                  'World': {'up': 1, 'jvm_rss_bytes': None}})
+        lines = metrics.splitlines()
+        self.assertEqual(lines[:4], [
+            '# TYPE sweetpotato_up gauge',
+            '# HELP sweetpotato_up Whether the server is running.',
+            'sweetpotato_up{server="World"} 1.0',
+            'sweetpotato_up{server="b\\"ad"} 0.0'])
+        self.assertIn('sweetpotato_lag_events_total{server="b\\"ad"} 2.0', lines)
+        self.assertNotIn('sweetpotato_jvm_rss_bytes{', metrics)
+        self.assertEqual(lines[-1], '# EOF')
+
+
+class PerfTests(unittest.TestCase):
+    def test_parse_tps(self):
+        self.assertEqual(parse_tps(
+            'Dim  0 : Mean tick time: 3.120 ms. Mean TPS: 20.000\n'
+            'Overall : Mean tick time: 41.250 ms. Mean TPS: 19.400'), (19.4, 41.25))
+        self.assertEqual(parse_tps('Overall: 18.500 TPS (54.054 ms/tick)'),
+                         (18.5, 54.054))
+        self.assertEqual(parse_tps(
+            '§6TPS from last 1m, 5m, 15m: §a*20.0, §a19.97, §a19.99'), (20.0, None))
+        self.assertIsNone(parse_tps('Unknown command'))
+
+    def test_summary(self):
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        monitor = PerfMonitor(window=60)
+        now = time.time()
+        monitor.add_lag(9000, 180, now - 120)
+        monitor.add_lag(3000, 60, now - 10)
+        for mspt in (10.0, 20.0, 30.0, 80.0):
+            monitor.add_sample(20.0, mspt, now)
+        summary = monitor.summary(now)
+        self.assertEqual(summary['lag'], {'spikes': 1, 'ms': 3000,
+                                          'worst_ms': 3000, 'ticks_skipped': 60})
+        self.assertEqual(summary['estimated_tps'], 19.0)
+        self.assertEqual(summary['mspt']['p50'], 20.0)
+        self.assertEqual(summary['mspt']['max'], 80.0)
+        self.assertEqual(len(format_perf(summary)), 3)
+
+    def test_monitor_stays_within_window(self):
+        monitor = PerfMonitor(window=60)
+        now = time.time()
+        for ago in range(600, 0, -10):
+            monitor.add_sample(20.0, 50.0, now - ago)
+            monitor.add_lag(2500, 50, now - ago)
+        # Without a summary() ever being asked for
+        self.assertLessEqual(len(monitor.samples), 6)
+        self.assertLessEqual(len(monitor.lag), 6)
+
+    def test_get_perf_from_log(self):
+        os.makedirs(os.path.join(TEST_STORE_DIR, 'logs'))
+        with open(os.path.join(TEST_STORE_DIR, 'logs', 'latest.log'), 'w') as log:
+            log.write("[{}] [Server thread/WARN]: Can't keep up! Is the server"
+                      " overloaded? Running 2500ms or 50 ticks behind\n".format(
+                          time.strftime('%H:%M:%S')))
+        s = SweetpotatoConfig()
+        s.server_dir = TEST_STORE_DIR
+        state_dir = os.path.join(TEST_STORE_DIR, 'state')
+        try:
+            with unittest.mock.patch('sweetpotato.status.STATE_DIR', state_dir):
+                summary = get_perf(s)
+                # Without a backup_dir, how far it got is kept in STATE_DIR
+                roster = get_log_roster(s)
+            self.assertTrue(os.path.isfile(roster.path))
+            self.assertEqual(os.path.dirname(roster.path), state_dir)
+            self.assertEqual(roster.offset, os.path.getsize(
+                os.path.join(TEST_STORE_DIR, 'logs', 'latest.log')))
+        finally:
+            shutil.rmtree(TEST_STORE_DIR)
+        self.assertEqual(summary['lag']['ms'], 2500)
+        self.assertIsNone(summary['tps'])
+
+
+class ScheduleTests(unittest.TestCase):
+    def test_next_after(self):
+        t = datetime(2014, 10, 20, 23, 45, 30)
+        self.assertEqual(CronSchedule('30 4 * * *').next_after(t),
+                         datetime(2014, 10, 21, 4, 30))
+        self.assertEqual(CronSchedule('*/15 * * * *').next_after(t),
+                         datetime(2014, 10, 21, 0, 0))
+        self.assertEqual(CronSchedule('0 3 * * 0').next_after(t),
+                         datetime(2014, 10, 26, 3, 0))
+        self.assertEqual(CronSchedule('@monthly').next_after(t),
+                         datetime(2014, 11, 1, 0, 0))
+        self.assertEqual(CronSchedule('0 0 29 2 *').next_after(t),
+                         datetime(2016, 2, 29, 0, 0))
+        # Either the day or the weekday will do when both are given
+        self.assertEqual(CronSchedule('0 12 1 * 2').next_after(t),
+                         datetime(2014, 10, 21, 12, 0))
+        # Unless one of them is a star, stepped or not
+        self.assertEqual(CronSchedule('0 3 */2 * 1').next_after(t),
+                         datetime(2014, 10, 27, 3, 0))
+
+    def test_bad_schedules(self):
+        for expression in ('* * * *', '60 * * * *', '1-x * * * *',
+                           '*/0 * * * *', '0 0 31 2 *'):
+            with self.assertRaises(ValueError):
+                CronSchedule(expression).next_after(datetime(2014, 1, 1))
+
+    def test_conf_schedule_must_come_around(self):
+        os.makedirs(TEST_STORE_DIR)
+        self.addCleanup(shutil.rmtree, TEST_STORE_DIR)
+        conf = os.path.join(TEST_STORE_DIR, 'test.conf')
+        with open(conf, 'w') as f:
+            f.write('[Settings]\nbackup_schedule = 0 0 31 2 *\n')
+        with self.assertRaises(ConfFileError):
+            read_conf_file(conf, SweetpotatoConfig())
+
+    def test_conf_backup_mode_must_be_known(self):
+        os.makedirs(TEST_STORE_DIR)
+        self.addCleanup(shutil.rmtree, TEST_STORE_DIR)
+        conf = os.path.join(TEST_STORE_DIR, 'test.conf')
+        with open(conf, 'w') as f:
+            f.write('[Settings]\nbackup_mode = incremental\n')
+        with self.assertRaises(ConfFileError):
+            read_conf_file(conf, SweetpotatoConfig())
+
+    def test_deferral(self):
+        s = SweetpotatoConfig()
+        self.assertIsNone(get_deferral_reason(s, 50, 10000))
+        s.backup_max_players = 5
+        s.backup_max_lag = 2000
+        self.assertIsNone(get_deferral_reason(s, 5, 2000))
+        self.assertIn('6 players', get_deferral_reason(s, 6, 0))
+        self.assertIn('2001ms', get_deferral_reason(s, 0, 2001))
+
+    def test_backup_lock(self):
+        with backup_lock(TEST_STORE_DIR):
+            with self.assertRaises(BackupInProgressError):
+                with backup_lock(TEST_STORE_DIR):
+                    pass
+        with backup_lock(TEST_STORE_DIR):
+            pass
+        # Servers sharing a backup_dir only keep out of their own way
+        with backup_lock(TEST_STORE_DIR, 'Lobby'):
+            with backup_lock(TEST_STORE_DIR, 'Survival'):
+                pass
+            with self.assertRaises(BackupInProgressError):
+                with backup_lock(TEST_STORE_DIR, 'Lobby'):
+                    pass
+            with self.assertRaises(BackupInProgressError):
+                with backup_lock(TEST_STORE_DIR):
+                    pass
+        shutil.rmtree(TEST_STORE_DIR)
+
+
+class StatusTests(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(os.path.join(TEST_STORE_DIR, 'logs'))
+        self.log = os.path.join(TEST_STORE_DIR, 'logs', 'latest.log')
+        self.s = SweetpotatoConfig()
+        self.s.server_dir = TEST_STORE_DIR
+        self.s.backup_dir = TEST_STORE_DIR
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR)
+
+    def _append(self, text):
+        with open(self.log, 'a') as log:
+            log.write(text)
+
+    def _roster(self):
+        roster = get_log_roster(self.s)
+        players = roster.update()
+        roster.save()
+        return players
+
+    def test_roster_is_incremental(self):
+        self._append('[12:00:00] [Server thread/INFO]: Notch joined the game\n'
+                     '[12:01:00] [Server thread/INFO]: jeb_ joined the game\n'
+                     '[12:02:00] [Server thread/INFO]: Dinner')
+        self.assertEqual(self._roster(), ['jeb_', 'Notch'])
+        self._append('bone joined the game\n'
+                     '[12:03:00] [Server thread/INFO]: Notch left the game\n')
+        with unittest.mock.patch('sweetpotato.status.parse_line',
+                                 side_effect=parse_line) as parse:
+            self.assertEqual(self._roster(), ['Dinnerbone', 'jeb_'])
+        self.assertEqual(parse.call_count, 2)
+        # A new latest.log starts the roster over
+        os.unlink(self.log)
+        self._append('[00:00:01] [Server thread/INFO]: Done (3.2s)!\n')
+        self.assertEqual(self._roster(), [])
+
+    def test_lag_is_incremental(self):
+        now = datetime.now()
+        for minutes in (20, 5):
+            self._append('[{}] [Server thread/WARN]: Can\'t keep up! Is the server'
+                         ' overloaded? Running 2500ms or 50 ticks behind\n'.format(
+                             (now - timedelta(minutes=minutes)).strftime('%H:%M:%S')))
+        roster = get_log_roster(self.s)
+        roster.update()
+        roster.save()
+        # The one from 20 minutes ago is out of the window
+        self.assertEqual(roster.monitor().summary()['lag']['spikes'], 1)
+        self._append('[{}] [Server thread/WARN]: Can\'t keep up! Is the server'
+                     ' overloaded? Running 4000ms or 80 ticks behind\n'.format(
+                         now.strftime('%H:%M:%S')))
+        roster = get_log_roster(self.s)
+        with unittest.mock.patch('sweetpotato.status.parse_line',
+                                 side_effect=parse_line) as parse:
+            roster.update()
+        self.assertEqual(parse.call_count, 1)
+        lag = roster.monitor().summary()['lag']
+        self.assertEqual((lag['spikes'], lag['ms'], lag['worst_ms']), (2, 6500, 4000))
+
+    def test_json_sends_nothing(self):
+        self._append('[12:00:00] [Server thread/INFO]: Notch joined the game\n')
+        self.s.running = {'pid': os.getpid(), 'start_time': time.time() - 3600}
+        with unittest.mock.patch('sweetpotato.server.send_commands') as send, \
+                unittest.mock.patch('sweetpotato.perf.poll_tps') as poll:
+            status = json.loads(self.s.as_json)
+        send.assert_not_called()
+        poll.assert_not_called()
+        self.assertEqual(status['running']['players'], ['Notch'])
+        self.assertEqual(status['running']['players_source'], 'log')
+        self.assertEqual(status['running']['uptime']['hours'], 1)
+        self.assertLess(time.time() - status['updated'], 5)
+
+
+class FleetTests(unittest.TestCase):
+    def setUp(self):
+        self.servers = {}
+        for name in ('lobby', 'survival'):
+            server_dir = os.path.join(TEST_STORE_DIR, name)
+            os.makedirs(os.path.join(server_dir, 'logs'))
+            self.servers[name] = server_dir
+        self.fleet = os.path.join(TEST_STORE_DIR, 'fleet.conf')
+        with open(self.fleet, 'w') as f:
+            f.write('[Settings]\nbackup_dir = {0}\nstop_timeout = 5\n'
+                    '[Server:lobby]\nserver_dir = {1}\nworld_name = Lobby\n'
+                    '[Server:survival]\nserver_dir = {2}\n'
+                    'world_name = Survival\nscreen_name = smp\n'
+                    'stop_timeout = 30\n'.format(
+                        TEST_STORE_DIR, self.servers['lobby'],
+                        self.servers['survival']))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR)
+
+    def test_read_fleet_file(self):
+        servers = read_fleet(self.fleet)
+        self.assertEqual(sorted(servers), ['lobby', 'survival'])
+        lobby, survival = servers['lobby'], servers['survival']
+        self.assertEqual(lobby.server_dir, self.servers['lobby'])
+        self.assertEqual(lobby.backup_dir, TEST_STORE_DIR)
+        self.assertEqual(lobby.screen_name, 'Lobby')
+        self.assertEqual(lobby.stop_timeout, 5)
+        self.assertEqual(survival.screen_name, 'smp')
+        self.assertEqual(survival.stop_timeout, 30)
+
+    def test_read_fleet_dir(self):
+        fleet_dir = os.path.join(TEST_STORE_DIR, 'fleet.d')
+        os.makedirs(fleet_dir)
+        for name, server_dir in self.servers.items():
+            with open(os.path.join(fleet_dir, name + '.conf'), 'w') as f:
+                f.write('[Settings]\nserver_dir = {0}\nworld_name = {1}\n'
+                        .format(server_dir, name.capitalize()))
+        servers = read_fleet(fleet_dir)
+        self.assertEqual(sorted(servers), ['lobby', 'survival'])
+        self.assertEqual(servers['survival'].world_name, 'Survival')
+        os.unlink(os.path.join(fleet_dir, 'lobby.conf'))
+        os.unlink(os.path.join(fleet_dir, 'survival.conf'))
+        with self.assertRaises(ConfFileError):
+            read_fleet(fleet_dir)
+
+    def test_procs_snapshot(self):
+        proc = {'pid': os.getpid(), 'comm': 'java', 'cmdline': ['java'],
+                'cwd': self.servers['lobby'], 'exe': None,
+                'start_time': time.time()}
+        with procs_snapshot([proc]):
+            self.assertEqual(get_procs('java'), [proc])
+            self.assertEqual(get_procs('python'), [])
+        self.assertNotIn(proc, get_procs('java'))
+
+    def test_fleet_status(self):
+        servers = read_fleet(self.fleet)
+        proc = {'pid': os.getpid(), 'comm': 'java', 'cmdline': ['java'],
+                'cwd': self.servers['survival'], 'exe': None,
+                'start_time': time.time() - 60}
+        with unittest.mock.patch('sweetpotato.fleet.get_java_procs',
+                                 return_value=[proc]) as scan:
+            results = run_fleet_action(servers, 'status', jobs=2)
+        self.assertEqual(scan.call_count, 1)
+        self.assertTrue(all(r['ok'] for r in results.values()))
+        self.assertFalse(results['lobby']['result']['running'])
+        running = results['survival']['result']['running']
+        self.assertEqual(running['pid'], os.getpid())
+        self.assertEqual(running['players'], None)
+        json.dumps(results)
+
+    def test_fleet_backup_shared_backup_dir(self):
+        servers = read_fleet(self.fleet)
+        with unittest.mock.patch('sweetpotato.fleet.get_java_procs',
+                                 return_value=[]):
+            results = run_fleet_action(servers, 'backup', jobs=2)
+        self.assertEqual(results, {'lobby': {'ok': True, 'result': 'backed up'},
+                                   'survival': {'ok': True, 'result': 'backed up'}})
+        backups = sorted(n for n in os.listdir(TEST_STORE_DIR)
+                         if n.endswith('.tar.gz'))
+        self.assertEqual(len(backups), 2)
+        self.assertTrue(backups[0].endswith('_Lobby.tar.gz'))
+
+    def test_fleet_stop_not_running(self):
+        servers = read_fleet(self.fleet)
+        with unittest.mock.patch('sweetpotato.fleet.get_java_procs',
+                                 return_value=[]):
+            results = run_fleet_action(servers, 'stop', jobs=1)
+        self.assertFalse(results['lobby']['ok'])
+        self.assertIn('not running', results['survival']['error'])
+
+    def test_rolling_restart_stops_at_failure(self):
+        servers = read_fleet(self.fleet)
+        extra = os.path.join(TEST_STORE_DIR, 'creative')
+        os.makedirs(extra)
+        servers['creative'] = SweetpotatoConfig()
+        servers['creative'].server_dir = extra
+
+        def restart(settings, quiet, ready_timeout=None):
+            if settings.world_name == 'Survival':
+                raise ServerNotReadyError('"Survival" did not come up')
+
+        with unittest.mock.patch('sweetpotato.fleet.get_java_procs',
+                                 return_value=[]) as scan, \
+                unittest.mock.patch('sweetpotato.fleet.restart_server',
+                                    side_effect=restart):
+            results = rolling_restart(servers, jobs=1)
+        # Once for each batch that was started
+        self.assertEqual(scan.call_count, 2)
+        self.assertEqual(results['lobby'], {'ok': True, 'result': 'restarted'})
+        self.assertFalse(results['survival']['ok'])
+        self.assertIn('did not come up', results['survival']['error'])
+        self.assertIn('stopped at "survival"', results['creative']['error'])
+
+    def test_wait_for_server_ready(self):
+        s = read_fleet(self.fleet)['lobby']
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            s.port = sock.getsockname()[1]
+        log = os.path.join(self.servers['lobby'], 'logs', 'latest.log')
+        follower = LogFollower(log)
+        with self.assertRaises(ServerNotReadyError):
+            wait_for_server_ready(s, follower, timeout=0)
+        with open(log, 'a') as f:
+            f.write('[12:00:00] [Server thread/INFO]: Done (3.2s)!\n')
+        self.assertLess(wait_for_server_ready(s, follower, timeout=0), 1)
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(1)
+            s.port = sock.getsockname()[1]
+            # The port opens before the world has loaded, so it only counts
+            # without a log or Query to go by
+            with self.assertRaises(ServerNotReadyError):
+                wait_for_server_ready(s, follower, timeout=0)
+            no_log = LogFollower(os.path.join(TEST_STORE_DIR, 'no.log'))
+            self.assertLess(wait_for_server_ready(s, no_log, timeout=0), 1)
+            s.query_port = 25565
+            with unittest.mock.patch('sweetpotato.server.query_server',
+                                     return_value=None):
+                with self.assertRaises(ServerNotReadyError):
+                    wait_for_server_ready(s, no_log, timeout=0)
+            with unittest.mock.patch('sweetpotato.server.query_server',
+                                     return_value={'players': []}):
+                self.assertLess(wait_for_server_ready(s, no_log, timeout=0), 1)
+
+
+class ExcludeMatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = ExcludeMatcher([
+            'level.dat_new', 'dynmap/', '/logs/*.gz', '**/cache/*.tmp',
+            're:crash-reports/crash-\\d+\\.txt'])
+
+    def test_basename_anywhere(self):
+        self.assertTrue(self.matcher.match('World/level.dat_new'))
+        self.assertFalse(self.matcher.match('World/level.dat'))
+
+    def test_directory_only(self):
+        self.assertTrue(self.matcher.match('plugins/dynmap', is_dir=True))
+        self.assertFalse(self.matcher.match('plugins/dynmap'))
+
+    def test_anchored(self):
+        self.assertTrue(self.matcher.match('logs/2018-01-01-1.log.gz'))
+        self.assertFalse(self.matcher.match('mods/logs/old.gz'))
+        self.assertFalse(self.matcher.match('logs/sub/old.gz'))
+
+    def test_double_star_and_regex(self):
+        self.assertTrue(self.matcher.match('cache/a.tmp'))
+        self.assertTrue(self.matcher.match('mods/x/cache/a.tmp'))
+        self.assertTrue(self.matcher.match('crash-reports/crash-123.txt'))
+        self.assertFalse(self.matcher.match('crash-reports/crash-1x.txt'))
+
+    def test_single_string(self):
+        self.assertTrue(ExcludeMatcher('level.dat_new').match('W/level.dat_new'))
+
+    def test_bad_regex(self):
+        with self.assertRaises(ConfFileError) as cm:
+            ExcludeMatcher(['dynmap/', 're:crash-(reports'])
+        self.assertIn('re:crash-(reports', cm.exception.msg)
+        os.makedirs(TEST_STORE_DIR)
+        self.addCleanup(shutil.rmtree, TEST_STORE_DIR)
+        conf = os.path.join(TEST_STORE_DIR, 'test.conf')
+        with open(conf, 'w') as f:
+            f.write('[Settings]\nexclude_files = re:*.tmp\n')
+        with self.assertRaises(ConfFileError):
+            read_conf_file(conf, SweetpotatoConfig())
+
+
+class RetentionTests(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs(TEST_STORE_DIR, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def _touch(self, *names):
+        for n in names:
+            open(os.path.join(TEST_STORE_DIR, n), 'w').close()
+
+    def test_gfs(self):
+        # 48 hourly backups over two days
+        for day in (1, 2):
+            for hour in range(24):
+                self._touch('2018-01-0{0}-{1:02}0000_W.tar.gz'.format(day, hour))
+        self._touch('not-a-backup.txt')
+        self.assertEqual(len(find_backups(TEST_STORE_DIR)), 48)
+        pruned = prune_backups(TEST_STORE_DIR, {'keep_hourly': 3, 'keep_daily': 2},
+                               quiet=True)
+        self.assertEqual(len(pruned), 44)
+        # .index holds the lock pruning takes
+        left = sorted(n for n in os.listdir(TEST_STORE_DIR) if n != '.index')
+        self.assertEqual(left, ['2018-01-01-230000_W.tar.gz',
+                                '2018-01-02-210000_W.tar.gz',
+                                '2018-01-02-220000_W.tar.gz',
+                                '2018-01-02-230000_W.tar.gz',
+                                'not-a-backup.txt'])
+
+    def test_chains_are_kept_whole(self):
+        self._touch('2018-01-01-000000_W.tar.gz',
+                    '2018-01-01-010000_W_diff.tar.gz',
+                    '2018-01-01-020000_W_diff.tar.gz',
+                    '2018-01-01-000000_W_region_base.tar.gz',
+                    '2018-01-01-010000_W_region.tar.gz',
+                    '2018-01-01-020000_W_region.tar.gz')
+        pruned = prune_backups(TEST_STORE_DIR, {'keep_hourly': 1},
+                               dry_run=True, quiet=True)
+        # A differential backup only needs the full one it was made from
+        self.assertEqual([os.path.basename(p) for p in pruned],
+                         ['2018-01-01-010000_W_diff.tar.gz'])
+
+    def test_not_while_backing_up(self):
+        self._touch('2018-01-01-000000_W.tar.gz', '2018-01-01-010000_W.tar.gz')
+        with backup_lock(TEST_STORE_DIR, 'W'):
+            with self.assertRaises(BackupInProgressError):
+                prune_backups(TEST_STORE_DIR, {'keep_hourly': 1}, quiet=True)
+        self.assertEqual(len(find_backups(TEST_STORE_DIR)), 2)
+
+
+class ParallelCompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs(TEST_STORE_DIR, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_STORE_DIR, ignore_errors=True)
+
+    def test_parallel_tar_is_readable(self):
+        src = os.path.join(TEST_STORE_DIR, 'region.mca')
+        data = os.urandom(1024 * 1024) + b'\0' * 3 * 1024 * 1024
+        with open(src, 'wb') as f:
+            f.write(data)
+        for compression in ('bz2', 'gz', 'xz'):
+            path = os.path.join(TEST_STORE_DIR, 'test.tar.' + compression)
+            tar, compressor = open_parallel_tar(path, compression, 4)
+            compressor.block_size = 512 * 1024
+            tar.add(src, arcname='region.mca')
+            tar.close()
+            compressor.close()
+            with tarfile.open(path, 'r:' + compression) as t:
+                self.assertEqual(t.extractfile('region.mca').read(), data)
+
+    def test_blocks_stay_in_order(self):
+        path = os.path.join(TEST_STORE_DIR, 'ordered.gz')
+        with ParallelCompressor(open(path, 'wb'), 'gz', 8, block_size=10) as c:
+            for i in range(1000):
+                c.write(str(i).encode())
+        with gzip.open(path) as g:
+            self.assertEqual(g.read(), ''.join(str(i) for i in range(1000)).encode())
+
+    def test_conf_jobs_must_be_at_least_one(self):
+        conf = os.path.join(TEST_STORE_DIR, 'test.conf')
+        with open(conf, 'w') as f:
+            f.write('[Settings]\njobs = 0\n')
+        with self.assertRaises(ConfFileError):
+            read_conf_file(conf, SweetpotatoConfig())
+
+
 if __name__ == '__main__':
     unittest.main()